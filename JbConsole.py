@@ -27,7 +27,8 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 ##############################################################################
-import sys, pickle
+import sys, os, pickle, time, random, bisect
+PythonException = Exception     # from java.lang import * hides it
 from java.lang import *
 from javax.swing import *
 from java.awt.event import *
@@ -36,20 +37,34 @@ from javax.swing.event import *
 from javax.swing.tree import *
 from javax.swing.table import *
 from java.util.prefs import Preferences
+from java.util.concurrent import Executors, ThreadFactory
+import jarray
 import fbutil
 
 APP_NAME = 'JbConsole'
 __version__ = '0.2.1'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.jbconsole', 'cache')
 files = ('root', 'server', 'database', 'domain', 'object', 'function', 
     'generators', 'generator', 'procedures', 'procedure', 
     'systemtables', 'systemtable', 'tables', 'table', 
-    'trigger', 'trigger_inact', 'view', 'down', 'key', 'column',)
+    'trigger', 'trigger_inact', 'view', 'down', 'key', 'column',
+    'left', 'right', 'search',)
 icons = dict(zip(files, [ImageIcon('./res/' + f + '.png') for f in files]))
 
 PK_COLOR = Color(0xFF, 0xFF, 0x80)
 FK_COLOR = Color(0x00, 0xFF, 0x00)
 PK_FK_COLOR = Color(0xC0, 0xFF, 0x80)
 UK_COLOR = Color(0x80, 0x80, 0x80)
+WARNING_COLOR = Color(0xFF, 0xA0, 0xA0)
+
+RESULT_PAGE_SIZE = 200      # rows fetched per page in Interactive SQL
+RESULT_MAX_PAGES = 50       # pages kept in memory per result
+AUTOSIZE_HEAD_ROWS = 100    # rows measured from the top of a table
+AUTOSIZE_TAIL_ROWS = 20     # rows measured from the bottom
+AUTOSIZE_RANDOM_ROWS = 50   # rows measured at random in between
+AUTOSIZE_MAX_WIDTH = 400    # pixels
+AUTOSIZE_PADDING = 8        # pixels around the text of a cell
+MONITOR_TOP_N = 50          # statements shown by the activity monitor
 
 def head_titles(h):
     return [s.title().replace('_', ' ') for s in h]
@@ -83,7 +98,11 @@ menu = [
         None,
         ['OPEN_DB', 'Open Database', KeyEvent.VK_O],
         ['CLOSE_DB', 'Close Database', KeyEvent.VK_C],
+        ['REFRESH_DB', 'Refresh Metadata', KeyEvent.VK_R],
         ['ISQL', 'Interactive SQL', KeyEvent.VK_I],
+        ['INDEX_HEALTH', 'Index Health', KeyEvent.VK_H],
+        ['EXTRACT_DDL', 'Extract DDL', KeyEvent.VK_L],
+        ['COMPARE_DB', 'Compare Schema', KeyEvent.VK_P],
         None,
         ['TABLE_INFO', 'Table', KeyEvent.VK_T, [
             ['TABLE_CONSTRAINTS', 'Show Constraints', KeyEvent.VK_C],
@@ -93,38 +112,114 @@ menu = [
         ],
         ['VIEW_SOURCE', 'View Source', KeyEvent.VK_V],
         ['SHOW_GRANT', 'Show Grant Users', KeyEvent.VK_U],
+        ['EXPORT_DATA', 'Export Data', KeyEvent.VK_X],
+        ['IMPORT_DATA', 'Import Data', KeyEvent.VK_M],
       ]
     ],
     ['HELP', 'Help', KeyEvent.VK_H, [
+        ['DIAGNOSTICS', 'Diagnostics', KeyEvent.VK_D],
         ['ABOUT', 'About', KeyEvent.VK_A],
       ]
     ]
 ]
 
 
+def sample_rows(row_count, head=AUTOSIZE_HEAD_ROWS, tail=AUTOSIZE_TAIL_ROWS,
+                                                random_rows=AUTOSIZE_RANDOM_ROWS):
+    if row_count <= head + tail + random_rows:
+        return range(row_count)
+    rows = range(head) + range(row_count - tail, row_count)
+    rows += random.sample(xrange(head, row_count - tail), random_rows)
+    return rows
+
 def adjust_column_width(table):
+    """Size columns to fit their header and a sample of rows.
+
+    Text widths come from the FontMetrics of the table, not from the cell
+    renderers, so the cost does not depend on the number of rows.
+    """
+    fm = table.getFontMetrics(table.getFont())
+    header = table.getTableHeader()
+    header_fm = header.getFontMetrics(header.getFont())
     columnModel = table.getColumnModel()
+    rows = sample_rows(table.getRowCount())
     for col in range(table.getColumnCount()):
-        maxwidth = 0
-        for row in range(table.getRowCount()):
-            rend = table.getCellRenderer(row, col)
-            width = rend.getTableCellRendererComponent(table,
-                    table.getValueAt(row, col), False, False, row, col
-                    ).getPreferredSize().width
-            if maxwidth < width:
-                maxwidth = width
-        columnModel.getColumn(col).setPreferredWidth(maxwidth)
+        maxwidth = header_fm.stringWidth(unicode(table.getColumnName(col)))
+        for row in rows:
+            v = table.getValueAt(row, col)
+            if v is not None:
+                maxwidth = max(maxwidth, fm.stringWidth(unicode(v)))
+        columnModel.getColumn(col).setPreferredWidth(
+                        min(maxwidth + AUTOSIZE_PADDING, AUTOSIZE_MAX_WIDTH))
+
+
+class Call(Runnable):
+    """Runnable calling func(*args), for invokeLater() and executors."""
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def run(self):
+        self.func(*self.args)
+
+
+class DaemonThreadFactory(ThreadFactory):
+    def newThread(self, r):
+        t = Thread(r)
+        t.setDaemon(True)
+        return t
+
+
+class BackgroundTask(SwingWorker):
+    """Run func(*args) off the event thread.
+
+    Then on_done(result) or on_error(exception) is called on the event
+    thread. While is_current() returns False the task is stale: it is
+    skipped if it has not started yet and its result is dropped.
+    """
+    def __init__(self, func, args=(), on_done=None, on_error=None,
+                                                            is_current=None):
+        self.func = func
+        self.args = args
+        self.on_done = on_done
+        self.on_error = on_error
+        self.is_current = is_current
+        self.result = None
+        self.error = None
+
+    def current(self):
+        return not self.is_current or self.is_current()
+
+    def doInBackground(self):
+        if self.current():
+            try:
+                self.result = self.func(*self.args)
+            except (PythonException, Exception), e:
+                self.error = e
+        return None
+
+    def done(self):
+        if not self.current():
+            return
+        if self.error:
+            if self.on_error:
+                self.on_error(self.error)
+        elif self.on_done:
+            self.on_done(self.result)
 
 
 class ConnParam(object):   # Keep connection parameter without hostname.
+    query_timeout = 0       # for parameters pickled by older versions
+
     def __init__(self, path, user, password = None, charset='UNICODE_FSS',
-                                        port = 3050, save_password=False):
+                        port = 3050, save_password=False, query_timeout=0):
         self.path = path
         self.user = user
         self.password = password
         self.charset = charset
         self.port = port
         self.save_password = save_password
+        self.query_timeout = query_timeout
 
 def dialog_layout(dlg, parent):
     p_size = parent.getSize()
@@ -136,16 +231,300 @@ def dialog_layout(dlg, parent):
     if y < 0: y = 0
     dlg.setLocation(x, y)
 
+class ResultTableModel(AbstractTableModel):
+    """TableModel reading a query result page by page from an open cursor.
+
+    Only the pages the table asks for are held, at most max_pages of them
+    (least recently used first out). A page that was dropped is read again
+    by re-executing the query and skipping up to it. All cursor work runs
+    on the model's own thread; cells not read yet show LOADING.
+    """
+    LOADING = '...'
+
+    def __init__(self, db, sql,
+                    page_size=RESULT_PAGE_SIZE, max_pages=RESULT_MAX_PAGES):
+        self.db = db
+        self.sql = sql
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.head = []
+        self.pages = {}         # page number -> ColumnarResult
+        self.lru = []           # page numbers, most recently used last
+        self.loading = {}       # page numbers requested but not arrived
+        self.row_count = 0
+        self.exhausted = False
+        self.closed = False
+        self.started = time.time()
+        self.elapsed = None     # seconds until the last row was read
+        self.on_ready = None
+        self.on_error = None
+        # Touched by the worker thread only
+        self.cursor = None
+        self.next_page = 0      # page number the open cursor returns next
+        self.executor = Executors.newSingleThreadExecutor(
+                                                        DaemonThreadFactory())
+
+    def start(self, on_ready, on_error):
+        """Execute the query in the background.
+
+        on_ready() is called on the event thread once the first page
+        arrived, on_error(e) if the query failed.
+        """
+        self.on_ready = on_ready
+        self.on_error = on_error
+        self.request(0)
+
+    def request(self, n):
+        if self.closed or self.loading.has_key(n):
+            return
+        self.loading[n] = True
+        self.executor.execute(BackgroundTask(self._load, (n, ),
+                                            self._loaded, self._failed))
+
+    # Worker thread
+    def _open(self):
+        self._close_cursor()
+        self.cursor = self.db.iter_execute(self.sql, fetch_size=self.page_size,
+                    batch_size=self.page_size, columnar=True, tag='user SQL')
+        self.head = self.cursor.next()
+        self.next_page = 0
+
+    def _next_page(self):
+        page = ()
+        if self.cursor:
+            try:
+                page = self.cursor.next()
+            except StopIteration:
+                self.cursor = None
+        self.next_page += 1
+        if len(page) < self.page_size:
+            self._close_cursor()
+            if not self.exhausted:
+                self.elapsed = time.time() - self.started
+            self.exhausted = True
+        return page
+
+    def _load(self, n):
+        if self.closed:
+            return None
+        if not self.cursor or n < self.next_page:
+            self._open()
+        while self.next_page < n:
+            self._next_page()
+        return (n, self._next_page())
+
+    def _close_cursor(self):
+        if self.cursor:
+            self.cursor.close()
+            self.cursor = None
+
+    # Event thread
+    def _loaded(self, result):
+        if not result or self.closed:
+            return
+        n, page = result
+        del self.loading[n]
+        if self.on_ready:
+            on_ready = self.on_ready
+            self.on_ready = None
+            self.fireTableStructureChanged()
+            on_ready()
+        self.pages[n] = page
+        self.lru.append(n)
+        while len(self.lru) > self.max_pages:
+            del self.pages[self.lru.pop(0)]
+        first = n * self.page_size
+        last = first + len(page)
+        if last > self.row_count:       # Rows never seen before
+            first = max(first, self.row_count)
+            self.row_count = last
+            self.fireTableRowsInserted(first, last - 1)
+        elif page:
+            self.fireTableRowsUpdated(first, last - 1)
+
+    def _failed(self, e):
+        self.loading.clear()
+        if self.closed and not self.on_ready:   # Stopped while scrolling
+            return
+        if self.on_error:
+            self.on_error(e)
+
+    def busy(self):
+        return len(self.loading) > 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.executor.execute(Call(self._close_cursor))
+        self.executor.shutdown()
+
+    def getRowCount(self):
+        return self.row_count
+
+    def getColumnCount(self):
+        return len(self.head)
+
+    def getColumnName(self, col):
+        return head_titles(self.head)[col]
+
+    def getValueAt(self, row, col):
+        if not self.exhausted and row >= self.row_count - self.page_size:
+            # Reading the last known page: read ahead the next one.
+            self.request(self.row_count // self.page_size)
+        n = row // self.page_size
+        page = self.pages.get(n)
+        if page is None:
+            self.request(n)
+            return self.LOADING
+        self.lru.remove(n)
+        self.lru.append(n)
+        return page.format_value(row % self.page_size, col)
+
+
+class PageTableModel(AbstractTableModel):
+    "TableModel showing the ColumnarResult page of a KeysetPager."
+    def __init__(self):
+        self.head = []
+        self.page = None
+
+    def set_page(self, head, page):
+        structure_changed = head != self.head
+        self.head = head
+        self.page = page
+        if structure_changed:
+            self.fireTableStructureChanged()
+        else:
+            self.fireTableDataChanged()
+
+    def getRowCount(self):
+        if self.page is None:
+            return 0
+        return len(self.page)
+
+    def getColumnCount(self):
+        return len(self.head)
+
+    def getColumnName(self, col):
+        return head_titles(self.head)[col]
+
+    def getValueAt(self, row, col):
+        return self.page.format_value(row, col)
+
+
+class DataPanel(JPanel, ActionListener):
+    """Data tab of a table or view, browsed a page at a time.
+
+    Pages are read by a fbutil.KeysetPager in a task of their own, on a
+    query lane connection so a long read does not hold up the metadata
+    thread; the first one when load() is called, that is when the tab
+    is shown.
+    """
+    def __init__(self, frame, db, table_name):
+        JPanel.__init__(self, BorderLayout())
+        self.frame = frame
+        self.db = db.for_lane(fbutil.QUERY_LANE)
+        self.table_name = table_name
+        self.pager = None
+        self.buttons = {}
+
+        bar = JToolBar()
+        for ac, label in (('FIRST', 'First'), ('PREV', icons['left']),
+                        ('NEXT', icons['right']), ('LAST', 'Last')):
+            b = JButton(label)
+            b.setActionCommand(ac)
+            b.addActionListener(self)
+            b.setEnabled(False)
+            bar.add(b)
+            self.buttons[ac] = b
+        self.status = JLabel(' ')
+        bar.add(self.status)
+        self.add(bar, BorderLayout.NORTH)
+
+        self.model = PageTableModel()
+        self.table = JTable(self.model)
+        self.table.setAutoResizeMode(JTable.AUTO_RESIZE_OFF)
+        self.add(JScrollPane(self.table))
+
+    def load(self):
+        if not self.pager:
+            self.read_page('FIRST')
+
+    def read_page(self, ac):
+        for b in self.buttons.values():
+            b.setEnabled(False)
+        self.status.setText(' Loading ...')
+        BackgroundTask(self._read, (ac, ), self.page_read,
+                                                self.read_failed).execute()
+
+    def _read(self, ac):
+        "Runs off the event thread."
+        if not self.pager:
+            self.pager = fbutil.KeysetPager(self.db, self.table_name)
+        pager = self.pager
+        {'FIRST': pager.first, 'PREV': pager.prev,
+            'NEXT': pager.next, 'LAST': pager.last}[ac]()
+        return pager
+
+    def page_read(self, pager):
+        first_page = not self.model.head
+        self.model.set_page(pager.head, pager.page)
+        if first_page:
+            adjust_column_width(self.table)
+        if pager.page_no is None:
+            s = ' Last page'
+        else:
+            s = ' Page %d' % (pager.page_no + 1)
+        if pager.keys:
+            s += '  (by %s)' % ', '.join(pager.keys)
+        else:
+            s += '  (no primary key, FIRST/SKIP)'
+        self.status.setText(s)
+        self.buttons['FIRST'].setEnabled(not pager.at_start)
+        self.buttons['PREV'].setEnabled(not pager.at_start)
+        self.buttons['NEXT'].setEnabled(not pager.at_end)
+        self.buttons['LAST'].setEnabled(bool(pager.keys) and not pager.at_end)
+
+    def read_failed(self, e):
+        if self.pager:
+            self.page_read(self.pager)     # Buttons for the page still shown
+        self.status.setText(' ' + str(e))
+
+    def actionPerformed(self, ae):
+        self.read_page(ae.getActionCommand())
+
+
 class SqlDialog(JDialog, ActionListener):
     def __init__(self, parent, db):
         JDialog.__init__(self, parent, "Interactive SQL", True)
         self.db = db
+        self.model = None
         self.setDefaultCloseOperation(JFrame.DISPOSE_ON_CLOSE)
+        self.windowClosed = self.close_model
         bar = JToolBar()
         b = JButton(icons['down'])
+        b.setActionCommand('EXECUTE')
+        b.addActionListener(self)
+        bar.add(b)
+        self.stop_button = JButton('Stop')
+        self.stop_button.setActionCommand('STOP')
+        self.stop_button.addActionListener(self)
+        self.stop_button.setEnabled(False)
+        bar.add(self.stop_button)
+        b = JButton('Export')
+        b.setActionCommand('EXPORT')
+        b.addActionListener(self)
+        bar.add(b)
+        b = JButton('Explain')
+        b.setActionCommand('EXPLAIN')
         b.addActionListener(self)
         bar.add(b)
+        bar.addSeparator()
+        self.status = JLabel(' ')
+        bar.add(self.status)
         self.add(bar, BorderLayout.NORTH)
+        self.timer = Timer(200, self)
+        self.timer.setActionCommand('PROGRESS')
         self.text = JTextArea()
         self.text.setRows(5)
         self.split = JSplitPane(JSplitPane.VERTICAL_SPLIT, True, 
@@ -155,15 +534,711 @@ class SqlDialog(JDialog, ActionListener):
         dialog_layout(self, parent)
         self.setVisible(True)
 
+    def close_model(self, e=None):
+        self.timer.stop()
+        if self.model:
+            self.model.close()
+            self.model = None
+
+    def show_result(self):
+        self.split.setBottomComponent(JScrollPane(JTable(self.model)))
+
+    def show_error(self, e):
+        self.show_progress()
+        self.close_model()
+        self.stop_button.setEnabled(False)
+        text = JTextArea(str(e))
+        text.setEditable(False)
+        self.split.setBottomComponent(JScrollPane(text))
+
+    def show_plan(self, result):
+        plan, h, d = result
+        text = JTextArea(plan or 'No plan')
+        text.setEditable(False)
+        table = JTable(d, head_titles(h))
+        table.setDefaultRenderer(Object, WarningTableCellRenderer())
+        panel = JPanel(BorderLayout())
+        panel.add(text, BorderLayout.NORTH)
+        panel.add(JScrollPane(table))
+        self.split.setBottomComponent(panel)
+        adjust_column_width(table)
+        warnings = len([r for r in d if r[-1]])
+        self.status.setText(' Plan, %d warnings' % warnings)
+
+    def show_progress(self):
+        m = self.model
+        if not m:
+            return
+        if m.elapsed is not None:
+            self.status.setText(' %d rows  %.1f s' % (m.row_count, m.elapsed))
+        elif m.closed:
+            self.status.setText(' %d rows fetched, stopped' % (m.row_count, ))
+        else:
+            self.status.setText(' %d rows fetched  %.1f s' % (
+                                    m.row_count, time.time() - m.started))
+            return
+        self.stop_button.setEnabled(False)
+        self.timer.stop()
+
     def actionPerformed(self, ae):
-        try:
-            h, d = self.db.execute(self.text.getText())
+        ac = ae.getActionCommand()
+        if ac == 'EXECUTE':
+            self.close_model()
+            self.split.setBottomComponent(JLabel(' Executing ...'))
+            self.model = ResultTableModel(self.db, self.text.getText())
+            self.model.start(self.show_result, self.show_error)
+            self.stop_button.setEnabled(True)
+            self.timer.start()
+        elif ac == 'STOP':     # Cancel the running fetch, close the cursor
+            if self.model:
+                if self.model.busy():
+                    self.db.cancel()
+                self.model.close()
+                self.show_progress()
+        elif ac == 'PROGRESS':
+            self.show_progress()
+        elif ac == 'EXPORT':
+            dlg = ExportDialog(self, self.db, sql=self.text.getText())
+        elif ac == 'EXPLAIN':          # Prepare only, nothing is executed
+            self.close_model()
+            self.stop_button.setEnabled(False)
+            self.split.setBottomComponent(JLabel(' Preparing ...'))
+            BackgroundTask(self.db.explain, (self.text.getText(), ),
+                                    self.show_plan, self.show_error).execute()
+
+
+class ExportDialog(JDialog, ActionListener):
+    "Export a query or a table to a file, with progress and cancel."
+    def __init__(self, parent, db, sql=None, table_name=None):
+        JDialog.__init__(self, parent, "Export", True)
+        self.db = db
+        self.sql = sql
+        self.table_name = table_name
+        self.exporter = None
+        self.setDefaultCloseOperation(JFrame.DO_NOTHING_ON_CLOSE)
+        self.windowClosing = self.close
+        self.setResizable(False)
+        self.setLayout(GridLayout(4, 1))
+
+        pathPanel = JPanel()
+        pathPanel.setLayout(BoxLayout(pathPanel, BoxLayout.X_AXIS))
+        pathPanel.add(JLabel(' File: '))
+        self._text_path = JTextField(40)
+        self._text_path.setMaximumSize(self._text_path.getPreferredSize())
+        pathPanel.add(self._text_path)
+        b = JButton("...")
+        b.setActionCommand("FILE_CHOOSER")
+        b.addActionListener(self)
+        pathPanel.add(b)
+
+        miscPanel = JPanel()
+        miscPanel.setLayout(BoxLayout(miscPanel, BoxLayout.X_AXIS))
+        miscPanel.add(JLabel(' Format: '))
+        self._combo_format = JComboBox([fbutil.CSV, fbutil.JSON_LINES])
+        self._combo_format.setMaximumSize(
+                    self._combo_format.getPreferredSize())
+        miscPanel.add(self._combo_format)
+        self._check_gzip = JCheckBox('gzip')
+        miscPanel.add(self._check_gzip)
+        miscPanel.add(JLabel(' Fetch Size: '))
+        self._text_fetch = JTextField(6)
+        self._text_fetch.setMaximumSize(self._text_fetch.getPreferredSize())
+        self._text_fetch.setText(str(fbutil.EXPORT_FETCH_SIZE))
+        miscPanel.add(self._text_fetch)
+
+        self.status = JLabel(' ')
+
+        buttonPanel = JPanel()
+        self.ok_button = JButton("OK")
+        self.ok_button.setActionCommand("OK")
+        self.ok_button.addActionListener(self)
+        buttonPanel.add(self.ok_button)
+        self.cancel_button = JButton("CANCEL")
+        self.cancel_button.setActionCommand("CANCEL")
+        self.cancel_button.addActionListener(self)
+        buttonPanel.add(self.cancel_button)
+
+        self.timer = Timer(500, self)
+        self.timer.setActionCommand('PROGRESS')
+
+        self.add(pathPanel)
+        self.add(miscPanel)
+        self.add(self.status)
+        self.add(buttonPanel)
+        self.pack()
+        dialog_layout(self, parent)
+        self.setVisible(True)
+
+    def show_progress(self):
+        e = self.exporter
+        elapsed = max(time.time() - e.started, 0.001)
+        self.status.setText(' %d rows  %d rows/s  %.1f MB  %.1f s' % (e.rows,
+                    e.rows / elapsed, e.bytes / 1048576.0, elapsed))
+
+    def finished(self, rows):
+        self.timer.stop()
+        self.show_progress()
+        if self.exporter.cancelled:
+            self.status.setText(self.status.getText() + '  cancelled')
+        self.exporter = None
+        self.cancel_button.setText('CLOSE')
+
+    def failed(self, e):
+        self.timer.stop()
+        self.exporter = None
+        self.status.setText(' ' + str(e))
+        self.cancel_button.setText('CLOSE')
+
+    def close(self, e=None):
+        if self.exporter:
+            self.exporter.cancel()
+        else:
+            self.setVisible(False)
+            self.dispose()
+
+    def actionPerformed(self, ae):
+        ac = ae.getActionCommand()
+        if ac == 'OK' and self._text_path.getText():
+            kw = {'format': self._combo_format.getSelectedItem(),
+                  'compress': self._check_gzip.isSelected(),
+                  'fetch_size': int(self._text_fetch.getText())}
+            if self.table_name:
+                self.exporter = fbutil.Exporter.export_table(self.db,
+                            self.table_name, self._text_path.getText(), **kw)
+            else:
+                self.exporter = fbutil.Exporter(self.db, self.sql,
+                            self._text_path.getText(), **kw)
+            self.ok_button.setEnabled(False)
+            BackgroundTask(self.exporter.run, (),
+                                self.finished, self.failed).execute()
+            self.timer.start()
+        elif ac == 'CANCEL':
+            self.close()
+        elif ac == 'PROGRESS':
+            if self.exporter and self.exporter.started:
+                self.show_progress()
+        elif ac == 'FILE_CHOOSER':
+            dlg = JFileChooser()
+            if dlg.showSaveDialog(self) == JFileChooser.APPROVE_OPTION:
+                self._text_path.setText(dlg.getSelectedFile().getPath())
+
+
+class ExtractDdlDialog(JDialog, ActionListener):
+    "Extract the DDL script of a database to a file, with progress."
+    def __init__(self, parent, db):
+        JDialog.__init__(self, parent, "Extract DDL", True)
+        self.db = db
+        self.extractor = None
+        self.setDefaultCloseOperation(JFrame.DO_NOTHING_ON_CLOSE)
+        self.windowClosing = self.close
+        self.setResizable(False)
+        self.setLayout(GridLayout(3, 1))
+
+        pathPanel = JPanel()
+        pathPanel.setLayout(BoxLayout(pathPanel, BoxLayout.X_AXIS))
+        pathPanel.add(JLabel(' File: '))
+        self._text_path = JTextField(40)
+        self._text_path.setMaximumSize(self._text_path.getPreferredSize())
+        pathPanel.add(self._text_path)
+        b = JButton("...")
+        b.setActionCommand("FILE_CHOOSER")
+        b.addActionListener(self)
+        pathPanel.add(b)
+
+        self.status = JLabel(' ')
+
+        buttonPanel = JPanel()
+        self.ok_button = JButton("OK")
+        self.ok_button.setActionCommand("OK")
+        self.ok_button.addActionListener(self)
+        buttonPanel.add(self.ok_button)
+        self.cancel_button = JButton("CANCEL")
+        self.cancel_button.setActionCommand("CANCEL")
+        self.cancel_button.addActionListener(self)
+        buttonPanel.add(self.cancel_button)
+
+        self.timer = Timer(500, self)
+        self.timer.setActionCommand('PROGRESS')
+
+        self.add(pathPanel)
+        self.add(self.status)
+        self.add(buttonPanel)
+        self.pack()
+        dialog_layout(self, parent)
+        self.setVisible(True)
+
+    def show_progress(self):
+        e = self.extractor
+        self.status.setText(' %d objects  %.1f s' % (e.objects,
+                                                time.time() - e.started))
+
+    def finished(self, objects):
+        self.timer.stop()
+        self.show_progress()
+        if self.extractor.cancelled:
+            self.status.setText(self.status.getText() + '  cancelled')
+        self.extractor = None
+        self.cancel_button.setText('CLOSE')
+
+    def failed(self, e):
+        self.timer.stop()
+        self.extractor = None
+        self.status.setText(' ' + str(e))
+        self.cancel_button.setText('CLOSE')
+
+    def close(self, e=None):
+        if self.extractor:
+            self.extractor.cancel()
+        else:
+            self.setVisible(False)
+            self.dispose()
+
+    def actionPerformed(self, ae):
+        ac = ae.getActionCommand()
+        if ac == 'OK' and self._text_path.getText():
+            self.extractor = fbutil.DdlExtractor(self.db,
+                                                self._text_path.getText())
+            self.ok_button.setEnabled(False)
+            BackgroundTask(self.extractor.run, (),
+                                self.finished, self.failed).execute()
+            self.timer.start()
+        elif ac == 'CANCEL':
+            self.close()
+        elif ac == 'PROGRESS':
+            if self.extractor and self.extractor.started:
+                self.show_progress()
+        elif ac == 'FILE_CHOOSER':
+            dlg = JFileChooser()
+            if dlg.showSaveDialog(self) == JFileChooser.APPROVE_OPTION:
+                self._text_path.setText(dlg.getSelectedFile().getPath())
+
+
+class ImportDialog(JDialog, ActionListener):
+    "Import a CSV file into a table, with progress and cancel."
+    def __init__(self, parent, db, table_name):
+        JDialog.__init__(self, parent, "Import " + table_name, True)
+        self.db = db
+        self.table_name = table_name
+        self.importer = None
+        self.setDefaultCloseOperation(JFrame.DO_NOTHING_ON_CLOSE)
+        self.windowClosing = self.close
+        self.setResizable(False)
+        self.setLayout(GridLayout(4, 1))
+
+        pathPanel = JPanel()
+        pathPanel.setLayout(BoxLayout(pathPanel, BoxLayout.X_AXIS))
+        pathPanel.add(JLabel(' File: '))
+        self._text_path = JTextField(40)
+        self._text_path.setMaximumSize(self._text_path.getPreferredSize())
+        pathPanel.add(self._text_path)
+        b = JButton("...")
+        b.setActionCommand("FILE_CHOOSER")
+        b.addActionListener(self)
+        pathPanel.add(b)
+
+        miscPanel = JPanel()
+        miscPanel.setLayout(BoxLayout(miscPanel, BoxLayout.X_AXIS))
+        self._check_header = JCheckBox('Header', True)
+        miscPanel.add(self._check_header)
+        miscPanel.add(JLabel(' Batch Size: '))
+        self._text_batch = JTextField(6)
+        self._text_batch.setMaximumSize(self._text_batch.getPreferredSize())
+        self._text_batch.setText(str(fbutil.IMPORT_BATCH_SIZE))
+        miscPanel.add(self._text_batch)
+        miscPanel.add(JLabel(' Commit Every: '))
+        self._text_commit = JTextField(8)
+        self._text_commit.setMaximumSize(self._text_commit.getPreferredSize())
+        self._text_commit.setText(str(fbutil.IMPORT_COMMIT_INTERVAL))
+        miscPanel.add(self._text_commit)
+        miscPanel.add(JLabel(' rows'))
+
+        self.status = JLabel(' ')
+
+        buttonPanel = JPanel()
+        self.ok_button = JButton("OK")
+        self.ok_button.setActionCommand("OK")
+        self.ok_button.addActionListener(self)
+        buttonPanel.add(self.ok_button)
+        self.cancel_button = JButton("CANCEL")
+        self.cancel_button.setActionCommand("CANCEL")
+        self.cancel_button.addActionListener(self)
+        buttonPanel.add(self.cancel_button)
+
+        self.timer = Timer(500, self)
+        self.timer.setActionCommand('PROGRESS')
+
+        self.add(pathPanel)
+        self.add(miscPanel)
+        self.add(self.status)
+        self.add(buttonPanel)
+        self.pack()
+        dialog_layout(self, parent)
+        self.setVisible(True)
+
+    def show_progress(self):
+        self.status.setText(' ' + self.importer.report())
+
+    def finished(self, rows):
+        self.timer.stop()
+        self.show_progress()
+        if self.importer.cancelled:
+            self.status.setText(self.status.getText() + '  cancelled')
+        if self.importer.rejected:
+            self.status.setToolTipText(self.importer.reject_path)
+        self.importer = None
+        self.cancel_button.setText('CLOSE')
+
+    def failed(self, e):
+        self.timer.stop()
+        self.importer = None
+        self.status.setText(' ' + str(e))
+        self.cancel_button.setText('CLOSE')
+
+    def close(self, e=None):
+        if self.importer:
+            self.importer.cancel()
+        else:
+            self.setVisible(False)
+            self.dispose()
+
+    def actionPerformed(self, ae):
+        ac = ae.getActionCommand()
+        if ac == 'OK' and self._text_path.getText():
+            self.importer = fbutil.Importer(self.db, self.table_name,
+                    self._text_path.getText(),
+                    header=self._check_header.isSelected(),
+                    batch_size=int(self._text_batch.getText()),
+                    commit_interval=int(self._text_commit.getText()))
+            self.ok_button.setEnabled(False)
+            BackgroundTask(self.importer.run, (),
+                                self.finished, self.failed).execute()
+            self.timer.start()
+        elif ac == 'CANCEL':
+            self.close()
+        elif ac == 'PROGRESS':
+            if self.importer and self.importer.started:
+                self.show_progress()
+        elif ac == 'FILE_CHOOSER':
+            dlg = JFileChooser()
+            if dlg.showOpenDialog(self) == JFileChooser.APPROVE_OPTION:
+                self._text_path.setText(dlg.getSelectedFile().getPath())
+
+
+class MonitorTableModel(AbstractTableModel):
+    """Rows of an ActivitySampler sample; counters sort as numbers.
+
+    Counters are held as java.lang.Long, the class getColumnClass()
+    gives the row sorter.
+    """
+    def __init__(self):
+        self.head = []
+        self.rows = []
+
+    def set_rows(self, head, rows):
+        structure_changed = head != self.head
+        counters = [i for i in range(len(head))
+                            if head[i] in fbutil.ActivitySampler.COUNTERS]
+        rows = [r[:] for r in rows]
+        for r in rows:
+            for i in counters:
+                r[i] = Long.valueOf(long(r[i]))
+        self.head = head
+        self.rows = rows
+        if structure_changed:
+            self.fireTableStructureChanged()
+        else:
+            self.fireTableDataChanged()
+
+    def getRowCount(self):
+        return len(self.rows)
+
+    def getColumnCount(self):
+        return len(self.head)
+
+    def getColumnName(self, col):
+        return head_titles(self.head)[col]
+
+    def getColumnClass(self, col):
+        if self.head[col] in fbutil.ActivitySampler.COUNTERS:
+            return Long
+        return Object
+
+    def getValueAt(self, row, col):
+        return self.rows[row][col]
+
+
+class MonitorPanel(JPanel, ActionListener):
+    """Top statements of the other attachments of a database, sampled
+    from the MON$ tables every few seconds while the panel is shown.
+    """
+    def __init__(self, db):
+        JPanel.__init__(self, BorderLayout())
+        self.db = db
+        self.sampler = None
+        self.sample = None
+
+        bar = JToolBar()
+        bar.add(JLabel(' Every '))
+        self._text_interval = JTextField(3)
+        self._text_interval.setMaximumSize(
+                                    self._text_interval.getPreferredSize())
+        self._text_interval.setText(str(fbutil.MONITOR_INTERVAL))
+        bar.add(self._text_interval)
+        bar.add(JLabel(' s  Top '))
+        self._text_top = JTextField(4)
+        self._text_top.setMaximumSize(self._text_top.getPreferredSize())
+        self._text_top.setText(str(MONITOR_TOP_N))
+        bar.add(self._text_top)
+        bar.add(JLabel(' by '))
+        self._combo_key = JComboBox(list(fbutil.ActivitySampler.COUNTERS))
+        self._combo_key.setSelectedItem('PAGE_FETCHES')
+        self._combo_key.setMaximumSize(self._combo_key.getPreferredSize())
+        self._combo_key.setActionCommand('TOP')
+        self._combo_key.addActionListener(self)
+        bar.add(self._combo_key)
+        self._check_active = JCheckBox('Active only')
+        bar.add(self._check_active)
+        b = JButton('Apply')
+        b.setActionCommand('RESTART')
+        b.addActionListener(self)
+        bar.add(b)
+        self.cancel_button = JButton('Cancel Statement')
+        self.cancel_button.setActionCommand('CANCEL_STATEMENT')
+        self.cancel_button.addActionListener(self)
+        bar.add(self.cancel_button)
+        self.status = JLabel(' Connecting ...')
+        bar.add(self.status)
+        self.add(bar, BorderLayout.NORTH)
+
+        self.model = MonitorTableModel()
+        self.table = JTable(self.model)
+        self.table.setAutoCreateRowSorter(True)
+        self.table.setAutoResizeMode(JTable.AUTO_RESIZE_OFF)
+        self.add(JScrollPane(self.table))
+        self.start()
+
+    def start(self):
+        self.sampler = fbutil.ActivitySampler(self.db,
+                            float(self._text_interval.getText()),
+                            self._check_active.isSelected())
+        sampler = self.sampler
+        def sampled(sample):
+            if sampler is self.sampler:
+                self.sampled(sample)
+        def failed(e):
+            if sampler is self.sampler:
+                self.status.setText(' ' + str(e))
+        self.sampler.start(
+            lambda sample: SwingUtilities.invokeLater(Call(sampled, sample)),
+            lambda e: SwingUtilities.invokeLater(Call(failed, e)))
+
+    def stop(self):
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler = None
+
+    def sampled(self, sample):
+        self.sample = sample
+        self.show_top()
+        s = self.sampler
+        self.status.setText(' %s  %d attachments  %d transactions' % (
+                time.strftime('%H:%M:%S', time.localtime(s.sampled_at)),
+                s.attachments, s.transactions))
+
+    def show_top(self):
+        if not self.sample:
+            return
+        h, d = self.sample
+        k = h.index(self._combo_key.getSelectedItem())
+        d = d[:]
+        d.sort(lambda a, b: cmp(b[k], a[k]))
+        width = self.table.getColumnModel().getTotalColumnWidth()
+        self.model.set_rows(h, d[:int(self._text_top.getText())])
+        if not width:
+            adjust_column_width(self.table)
+
+    def cancel_statement(self):
+        row = self.table.getSelectedRow()
+        if row < 0 or not self.sampler:
+            return
+        r = self.model.rows[self.table.convertRowIndexToModel(row)]
+        statement_id = r[self.model.head.index('STATEMENT_ID')]
+        if JOptionPane.showConfirmDialog(self,
+                'Cancel statement %s?\n%s' % (statement_id, r[-1] or ''),
+                'Cancel Statement', JOptionPane.YES_NO_OPTION
+                                            ) != JOptionPane.YES_OPTION:
+            return
+        def cancelled(result):
+            self.status.setText(' Statement %s cancelled' % statement_id)
+        def failed(e):
+            self.status.setText(' ' + str(e))
+        BackgroundTask(self.sampler.cancel_statement, (statement_id, ),
+                                            cancelled, failed).execute()
+
+    def actionPerformed(self, ae):
+        ac = ae.getActionCommand()
+        if ac == 'TOP':
+            self.show_top()
+        elif ac == 'RESTART':
+            self.stop()
+            self.start()
+        elif ac == 'CANCEL_STATEMENT':
+            self.cancel_statement()
+
+
+class IndexHealthPanel(JPanel, ActionListener):
+    """Index statistics of a whole database checked against samples of
+    the data, with SET STATISTICS run on the selected indexes.
+    """
+    head = ['RELATION_NAME', 'INDEX_NAME', 'FIELD_NAME', 'UNIQUE_FLAG',
+        'INACT', 'STATISTICS', 'STORED_KEYS', 'SAMPLED_KEYS', 'PROBLEMS']
+
+    def __init__(self, db):
+        JPanel.__init__(self, BorderLayout())
+        self.db = db
+        self.indexes = []
+        self.buttons = []
+        bar = JToolBar()
+        for ac, label in (('RELOAD', 'Reload'),
+                            ('SELECT_FLAGGED', 'Select Flagged'),
+                            ('RECOMPUTE', 'Recompute Selected')):
+            b = JButton(label)
+            b.setActionCommand(ac)
+            b.addActionListener(self)
+            bar.add(b)
+            self.buttons.append(b)
+        self.progress_bar = JProgressBar()
+        self.progress_bar.setStringPainted(True)
+        self.progress_bar.setMaximumSize(self.progress_bar.getPreferredSize())
+        bar.add(self.progress_bar)
+        self.status = JLabel(' ')
+        bar.add(self.status)
+        self.add(bar, BorderLayout.NORTH)
+        self.table = JTable()
+        self.add(JScrollPane(self.table))
+        self.load()
+
+    def start(self, text):
+        for b in self.buttons:
+            b.setEnabled(False)
+        self.progress_bar.setValue(0)
+        self.status.setText(' ' + text)
+
+    def finish(self, text):
+        for b in self.buttons:
+            b.setEnabled(True)
+        self.status.setText(' ' + text)
+
+    def progress(self, done, total):
+        "Called from the worker threads."
+        def show():
+            self.progress_bar.setMaximum(total)
+            self.progress_bar.setValue(done)
+        SwingUtilities.invokeLater(Call(show))
+
+    def load(self):
+        self.start('Sampling index keys ...')
+        BackgroundTask(self.db.index_health,
+                    (fbutil.INDEX_SAMPLE_ROWS, fbutil.POOL_MAX_SIZE,
+                                    self.progress), self.loaded, self.failed
+                    ).execute()
+
+    def loaded(self, indexes):
+        self.indexes = indexes
+        d = []
+        for i in indexes:
+            r = [i[k] for k in self.head]
+            r[2] = ', '.join(i['FIELD_NAME'] or [i['EXPRESSION'] or ''])
+            r[5] = '%.6g' % i['STATISTICS']
+            r[-1] = '; '.join(i['PROBLEMS'])
+            d.append(r)
+        self.table = JTable(d, head_titles(self.head))
+        self.table.setDefaultRenderer(Object, WarningTableCellRenderer())
+        self.table.setAutoResizeMode(JTable.AUTO_RESIZE_OFF)
+        self.remove(1)
+        self.add(JScrollPane(self.table))
+        self.revalidate()
+        adjust_column_width(self.table)
+        flagged = len([i for i in indexes if i['PROBLEMS']])
+        self.finish('%d indexes, %d flagged' % (len(indexes), flagged))
+
+    def failed(self, e):
+        self.finish(str(e))
+
+    def recompute(self):
+        names = [self.indexes[row]['INDEX_NAME']
+                                for row in self.table.getSelectedRows()]
+        if not names:
+            return
+        self.start('Recomputing %d indexes ...' % len(names))
+        BackgroundTask(self.db.recompute_statistics,
+                    (names, fbutil.POOL_MAX_SIZE, self.progress),
+                                        self.recomputed, self.failed).execute()
+
+    def recomputed(self, results):
+        errors = ['%s: %s' % (name, e) for name, r, e in results if e]
+        if errors:
+            JOptionPane.showMessageDialog(self, '\n'.join(errors),
+                        'Set Statistics', JOptionPane.ERROR_MESSAGE)
+        self.load()
+
+    def actionPerformed(self, ae):
+        ac = ae.getActionCommand()
+        if ac == 'RELOAD':
+            self.load()
+        elif ac == 'SELECT_FLAGGED':
+            self.table.clearSelection()
+            for row in range(len(self.indexes)):
+                if self.indexes[row]['PROBLEMS']:
+                    self.table.addRowSelectionInterval(row, row)
+        elif ac == 'RECOMPUTE':
+            self.recompute()
+
+
+class DiagnosticsPanel(JPanel, ActionListener):
+    "Statement timings from fbutil.profiler: percentiles and slowest calls."
+    SQL_WIDTH = 120     # characters of SQL shown per statement
+
+    def __init__(self):
+        JPanel.__init__(self, BorderLayout())
+        bar = JToolBar()
+        for ac, label in (('REFRESH', 'Refresh'), ('RESET', 'Reset')):
+            b = JButton(label)
+            b.setActionCommand(ac)
+            b.addActionListener(self)
+            bar.add(b)
+        self.add(bar, BorderLayout.NORTH)
+        self.tabs = JTabbedPane()
+        self.add(self.tabs)
+        self.refresh()
+
+    def slowest_rows(self):
+        h = ['TAG', 'TOTAL_MS', 'PREPARE_MS', 'EXECUTE_MS', 'FIRST_ROW_MS',
+                'FETCH_MS', 'ROWS', 'BYTES', 'STARTED', 'SQL', 'ERROR']
+        ms = lambda t: t is not None and '%.1f' % (t * 1000) or ''
+        d = []
+        for r in fbutil.profiler.slowest():
+            d.append([r.tag, ms(r.elapsed()), ms(r.prepare), ms(r.execute),
+                ms(r.first_row), ms(r.fetch), r.rows, r.bytes,
+                time.strftime('%H:%M:%S', time.localtime(r.started)),
+                ' '.join(r.sql.split())[:self.SQL_WIDTH], r.error])
+        return h, d
+
+    def refresh(self):
+        selected = max(self.tabs.getSelectedIndex(), 0)
+        self.tabs.removeAll()
+        for title, (h, d) in (('Percentiles', fbutil.profiler.summary()),
+                                ('Slowest', self.slowest_rows())):
             table = JTable(d, head_titles(h))
-            self.split.setBottomComponent(JScrollPane(table))
-        except Exception, e:
-            text = JTextArea(str(e))
-            text.setEditable(False)
-            self.split.setBottomComponent(JScrollPane(text))
+            table.setAutoResizeMode(JTable.AUTO_RESIZE_OFF)
+            self.tabs.addTab(title, JScrollPane(table))
+            adjust_column_width(table)
+        self.tabs.setSelectedIndex(selected)
+
+    def actionPerformed(self, ae):
+        if ae.getActionCommand() == 'RESET':
+            fbutil.profiler.reset()
+        self.refresh()
 
 
 class ConnParamDialog(JDialog, ActionListener):
@@ -208,6 +1283,11 @@ class ConnParamDialog(JDialog, ActionListener):
         self._text_port = JTextField(5)
         self._text_port.setMaximumSize(self._text_port.getPreferredSize())
         miscPanel.add(self._text_port)
+        miscPanel.add(JLabel(' Query Timeout: '))
+        self._text_timeout = JTextField(4)
+        self._text_timeout.setMaximumSize(
+                    self._text_timeout.getPreferredSize())
+        miscPanel.add(self._text_timeout)
         self._check_savepass = JCheckBox('Save Password')
         miscPanel.add(self._check_savepass)
 
@@ -233,8 +1313,10 @@ class ConnParamDialog(JDialog, ActionListener):
             self._check_savepass.setSelected(conn_param.save_password)
             self._combo_charset.setSelectedItem(conn_param.charset)
             self._text_port.setText(str(conn_param.port))
+            self._text_timeout.setText(str(conn_param.query_timeout))
         else:
             self._text_port.setText('3050')
+            self._text_timeout.setText('0')
 
         dialog_layout(self, parent)
         self.setVisible(True)
@@ -247,7 +1329,8 @@ class ConnParamDialog(JDialog, ActionListener):
                     self._text_user.getText(), self._text_password.getText(),
                     charset = self._combo_charset.getSelectedItem(),
                     port = int(self._text_port.getText()),
-                    save_password = self._check_savepass.isSelected())
+                    save_password = self._check_savepass.isSelected(),
+                    query_timeout = int(self._text_timeout.getText() or 0))
             self.setVisible(False)
             self.dispose()
         elif ac == 'FILE_CHOOSER':
@@ -257,10 +1340,13 @@ class ConnParamDialog(JDialog, ActionListener):
 
 
 class TreeNode(Object):
+    filter = ''         # name prefix of the visible children, LazyTreeModel
     def __init__(self, name, node_type):
         self.name = name
         self.node_type = node_type
     def toString(self):
+        if self.filter:
+            return '%s [%s]' % (self.name, self.filter)
         return self.name
 
 
@@ -300,6 +1386,112 @@ class ShowIndexTableCellRenderer(DefaultTableCellRenderer):
         return self
 ShowConstraintsTableCellRenderer = ShowIndexTableCellRenderer
 
+class WarningTableCellRenderer(DefaultTableCellRenderer):
+    "Highlights the rows with a warning in their last column."
+    def getTableCellRendererComponent(self, t, v, i, h, row, col):
+        DefaultTableCellRenderer.getTableCellRendererComponent(
+                                                    self, t, v, i, h, row, col)
+        model = t.getModel()
+        if model.getValueAt(row, model.getColumnCount() - 1):
+            self.setBackground(WARNING_COLOR)
+        else:
+            self.setBackground(t.getBackground())
+        return self
+
+class LazyTreeModel(DefaultTreeModel):
+    """DefaultTreeModel whose category nodes get children on demand.
+
+    Nodes of lazy_types count as expandable until set_children() gives
+    them their children; then a sorted index of the child names lets
+    set_filter() narrow the visible children to a name prefix.
+    """
+    def __init__(self, root, lazy_types):
+        DefaultTreeModel.__init__(self, root)
+        self.lazy_types = lazy_types
+        self.names = {}         # loaded node -> (upper names, children)
+        self.filtered = {}      # filtered node -> visible children
+
+    def is_loaded(self, c):
+        return self.names.has_key(c)
+
+    def isLeaf(self, c):
+        if (self.lazy_types.has_key(c.getUserObject().node_type)
+                                                and not self.is_loaded(c)):
+            return False
+        return self.getChildCount(c) == 0
+
+    def getChildCount(self, c):
+        if self.filtered.has_key(c):
+            return len(self.filtered[c])
+        return c.getChildCount()
+
+    def getChild(self, c, i):
+        if self.filtered.has_key(c):
+            return self.filtered[c][i]
+        return c.getChildAt(i)
+
+    def getIndexOfChild(self, c, child):
+        if self.filtered.has_key(c):
+            try:
+                return self.filtered[c].index(child)
+            except ValueError:
+                return -1
+        return c.getIndex(child)
+
+    def set_children(self, c, children):
+        "Make children those of c, unfiltered, and tell the listeners."
+        had_children = c.getChildCount()
+        self._forget(c)
+        c.removeAllChildren()
+        for child in children:
+            c.add(child)
+        keyed = [(children[i].getUserObject().name.upper(), i)
+                                            for i in range(len(children))]
+        keyed.sort()
+        self.names[c] = ([k for k, i in keyed],
+                            [children[i] for k, i in keyed])
+        if had_children:
+            self.nodeStructureChanged(c)
+        else:
+            self.nodesWereInserted(c, jarray.array(range(len(children)), 'i'))
+        self.nodeChanged(c)
+
+    def remove_children(self, c):
+        "Drop the children of c, which becomes lazy again."
+        for i in range(c.getChildCount()):
+            self._forget(c.getChildAt(i))
+        self._forget(c)
+        if c.getChildCount():
+            c.removeAllChildren()
+            self.nodeStructureChanged(c)
+
+    def _forget(self, c):
+        if self.names.has_key(c):
+            del self.names[c]
+        if self.filtered.has_key(c):
+            del self.filtered[c]
+        c.getUserObject().filter = ''
+
+    def set_filter(self, c, prefix):
+        "Show only the children of c whose name starts with prefix."
+        c.getUserObject().filter = prefix
+        if prefix:
+            names, children = self.names[c]
+            key = prefix.upper()
+            lo = bisect.bisect_left(names, key)
+            hi = bisect.bisect_left(names, key + u'\uffff')
+            self.filtered[c] = children[lo:hi]
+        elif self.filtered.has_key(c):
+            del self.filtered[c]
+        self.nodeStructureChanged(c)
+
+
+class JbTree(JTree):
+    "JTree leaving typed keys to the filter of MainFrame.tree_key_typed()."
+    def getNextMatch(self, prefix, row, bias):
+        return None
+
+
 class JbTreeCellRenderer(DefaultTreeCellRenderer):
     icon_map = {'ROOT' : icons['root'],
                 'SERVER' : icons['server'], 
@@ -321,6 +1513,7 @@ class JbTreeCellRenderer(DefaultTreeCellRenderer):
                 'TRIGGER_INACT' : icons['trigger_inact'],
                 'VIEWS' : icons['view'],
                 'VIEW' : icons['view'],
+                'MONITOR' : icons['server'],
     }
     def getTreeCellRendererComponent(self, t, v, s, e, l, r, h):
         c = DefaultTreeCellRenderer.getTreeCellRendererComponent(
@@ -346,28 +1539,25 @@ class TreeMouseListener(MouseAdapter):
             return
         if hasattr(node, 'db') and node.db:
             return
-        param = node.conn_param
-        if param.password == None:
-            pwd = JPasswordField(10)
-            if JOptionPane.showConfirmDialog(self.frame, pwd,
-                    "Enter %s's password" % (param.user), 
-                    JOptionPane.YES_NO_OPTION) == JOptionPane.YES_OPTION:
-                param.password = String(pwd.getPassword())
-            else:
-                return
-        node.db = fbutil.FbDatabase(host=c.getParent().getUserObject().name,
-                    path=param.path, user=param.user, password=param.password,
-                    charset=param.charset, port=param.port)
-        try:
-            node.db.open()
-        except Exception, e:
-            node.db = None
-            JOptionPane.showMessageDialog(self.frame, str(e), 
-                            "Can't Open Database", JOptionPane.ERROR_MESSAGE)
-        self.frame.update_menu_tree(c)
-        self.frame.tree.updateUI()
+        self.frame.open_database(c)
+
+class FindResultMouseListener(MouseAdapter):
+    "Select the tree node of a double clicked search result."
+    def __init__(self, frame, db_node, hits):
+        self.frame = frame
+        self.db_node = db_node
+        self.hits = hits
 
-class MainFrame(JFrame, ActionListener, TreeSelectionListener):
+    def mouseClicked(self, me):
+        if not SwingUtilities.isLeftMouseButton(me) or me.getClickCount() != 2:
+            return
+        row = me.getSource().getSelectedRow()
+        if row >= 0:
+            kind, name, where, category, node_name = self.hits[row]
+            self.frame.select_object(self.db_node, category, node_name)
+
+class MainFrame(JFrame, ActionListener, TreeSelectionListener,
+                                                    TreeWillExpandListener):
     def update_menu_tree(self, path_comp):
         node = path_comp.getUserObject()
 
@@ -396,26 +1586,41 @@ class MainFrame(JFrame, ActionListener, TreeSelectionListener):
             if hasattr(node, "db") and getattr(node, "db"): # Opened
                 self.menu['OPEN_DB'].setEnabled(False)
                 self.menu['CLOSE_DB'].setEnabled(True)
+                self.menu['REFRESH_DB'].setEnabled(True)
                 self.menu['ISQL'].setEnabled(True)
+                self.menu['INDEX_HEALTH'].setEnabled(True)
+                self.menu['EXTRACT_DDL'].setEnabled(True)
+                self.menu['COMPARE_DB'].setEnabled(True)
                 if not path_comp.getChildCount():
                     nk = [('Domains', 'DOMAINS'), ('Exceptions', 'EXCEPTIONS'), 
                       ('Functions', 'FUNCTIONS'), ('Generators', 'GENERATORS'),
                       ('Procedures', 'PROCEDURES'), ('Roles', 'ROLES'),
                       ('System Tables', 'SYSTEMTABLES'), ('Tables', 'TABLES'),
-                      ('Triggers', 'TRIGGERS'), ('Views', 'VIEWS')]
+                      ('Triggers', 'TRIGGERS'), ('Views', 'VIEWS'),
+                      ('Monitor', 'MONITOR')]
                     for (n, k) in nk:
                         path_comp.add(DefaultMutableTreeNode(TreeNode(n, k)))
+                    self.tree.getModel().nodesWereInserted(path_comp,
+                                        jarray.array(range(len(nk)), 'i'))
             else:                                           # Closed
                 self.menu['OPEN_DB'].setEnabled(True)
                 self.menu['CLOSE_DB'].setEnabled(False)
+                self.menu['REFRESH_DB'].setEnabled(False)
                 self.menu['ISQL'].setEnabled(False)
-                path_comp.removeAllChildren()
+                self.menu['INDEX_HEALTH'].setEnabled(False)
+                self.menu['EXTRACT_DDL'].setEnabled(False)
+                self.menu['COMPARE_DB'].setEnabled(False)
+                self.tree.getModel().remove_children(path_comp)
         else:
             self.menu['EDIT_DB'].setEnabled(False)
             self.menu['UNREG_DB'].setEnabled(False)
             self.menu['OPEN_DB'].setEnabled(False)
             self.menu['CLOSE_DB'].setEnabled(False)
+            self.menu['REFRESH_DB'].setEnabled(False)
             self.menu['ISQL'].setEnabled(False)
+            self.menu['INDEX_HEALTH'].setEnabled(False)
+            self.menu['EXTRACT_DDL'].setEnabled(False)
+            self.menu['COMPARE_DB'].setEnabled(False)
 
         if (node.node_type == 'TABLE' or node.node_type == 'VIEW'
                                             or node.node_type == 'PROCEDURE'):
@@ -426,6 +1631,14 @@ class MainFrame(JFrame, ActionListener, TreeSelectionListener):
             self.menu['VIEW_SOURCE'].setEnabled(True)
         else:
             self.menu['VIEW_SOURCE'].setEnabled(False)
+        if node.node_type in ('TABLE', 'SYSTEMTABLE', 'VIEW'):
+            self.menu['EXPORT_DATA'].setEnabled(True)
+        else:
+            self.menu['EXPORT_DATA'].setEnabled(False)
+        if node.node_type == 'TABLE':
+            self.menu['IMPORT_DATA'].setEnabled(True)
+        else:
+            self.menu['IMPORT_DATA'].setEnabled(False)
 
     def save_pref(self):
         pref = {}
@@ -470,6 +1683,7 @@ class MainFrame(JFrame, ActionListener, TreeSelectionListener):
 
     def quit_app(self, e):
         self.save_pref()
+        fbutil.close_pools()
         self.dispose()
 
     def __init__(self):
@@ -520,18 +1734,327 @@ class MainFrame(JFrame, ActionListener, TreeSelectionListener):
                 server.add(DefaultMutableTreeNode(o))
             root.add(server)
 
-        self.tree = JTree(root)
+        self.tree = JbTree(LazyTreeModel(root, self.child_types))
+        self.tree.addTreeWillExpandListener(self)
+        self.tree.keyTyped = self.tree_key_typed
         self.tree.setCellRenderer(JbTreeCellRenderer())
         self.tree.addTreeSelectionListener(self)
         self.tree.addMouseListener(TreeMouseListener(self))
+        self.find_text = JTextField()
+        self.find_text.setToolTipText('Find in names and sources')
+        self.find_text.keyReleased = self.find
+        find_bar = JPanel(BorderLayout())
+        find_bar.add(JLabel(icons['search']), BorderLayout.WEST)
+        find_bar.add(self.find_text, BorderLayout.CENTER)
+        left = JPanel(BorderLayout())
+        left.add(find_bar, BorderLayout.NORTH)
+        left.add(JScrollPane(self.tree), BorderLayout.CENTER)
         self.split = JSplitPane(JSplitPane.HORIZONTAL_SPLIT, True, 
-                            JScrollPane(self.tree), JScrollPane(JTable()))
+                            left, JScrollPane(JTable()))
         self.add(self.split)
         self.setLocation(Point(self.pref['X'], self.pref['Y']))
         self.setSize(Dimension(self.pref['WIDTH'], self.pref['HEIGHT']))
         self.split.setDividerLocation(self.pref['DIVIDER'])
+        self.executor = Executors.newSingleThreadExecutor(
+                                                        DaemonThreadFactory())
+        self.request_token = 0
+        self.data_tab_selected = False  # open tables on their Data tab
         self.update_menu_tree(root)
 
+    # Background work
+    def cancel_pending_load(self):
+        "Drop the result of a pending load; returns the new request token."
+        self.request_token += 1
+        return self.request_token
+
+    def run_task(self, func, args, on_done, on_error=None, stale_check=True):
+        """Run database work on the metadata thread (see BackgroundTask).
+
+        With stale_check the right pane shows a placeholder until on_done
+        is called, and a later run_task() call supersedes this one.
+        """
+        is_current = None
+        if stale_check:
+            token = self.cancel_pending_load()
+            is_current = lambda: token == self.request_token
+            self.set_right(JLabel(' Loading ...'))
+        if not on_error:
+            on_error = self.show_error
+        self.executor.execute(
+                    BackgroundTask(func, args, on_done, on_error, is_current))
+
+    def table_task(self, func, args, renderer=None):
+        def done(result):
+            h, d = result
+            self.show_table(h, d, renderer)
+        self.run_task(func, args, done)
+
+    # Right pane
+    def set_right(self, comp):
+        old = self.split.getRightComponent()
+        if isinstance(old, MonitorPanel) and old is not comp:
+            old.stop()
+        loc = self.split.getDividerLocation()
+        self.split.setRightComponent(comp)
+        self.split.setDividerLocation(loc)
+
+    def show_table(self, h, d, renderer=None):
+        table = JTable(d, head_titles(h))
+        self.set_right(JScrollPane(table))
+        adjust_column_width(table)
+        if renderer:
+            table.setDefaultRenderer(Object, renderer)
+        return table
+
+    def show_text(self, s):
+        text = JTextArea(s)
+        text.setEditable(False)
+        self.set_right(JScrollPane(text))
+
+    def show_error(self, e):
+        self.show_text(str(e))
+
+    def open_database(self, c):
+        node = c.getUserObject()
+        param = node.conn_param
+        if param.password == None:
+            pwd = JPasswordField(10)
+            if JOptionPane.showConfirmDialog(self, pwd,
+                    "Enter %s's password" % (param.user), 
+                    JOptionPane.YES_NO_OPTION) != JOptionPane.YES_OPTION:
+                return
+            param.password = String(pwd.getPassword())
+        db = fbutil.FbDatabase(host=c.getParent().getUserObject().name,
+                    path=param.path, user=param.user, password=param.password,
+                    charset=param.charset, port=param.port,
+                    query_timeout=param.query_timeout)
+        def open_db():
+            db.open()
+            db.load_snapshot(CACHE_DIR)
+        def opened(result):
+            node.db = db
+            self.build_search_index(c)
+            self.update_menu_tree(c)
+        def failed(e):
+            JOptionPane.showMessageDialog(self, str(e), 
+                            "Can't Open Database", JOptionPane.ERROR_MESSAGE)
+        self.run_task(open_db, (), opened, failed, stale_check=False)
+
+    def refresh_database(self, c):
+        "Reload the catalog and forget the tree nodes built from it."
+        placeholder = JLabel(' Refreshing ...')
+        def refreshed(snapshot):
+            model = self.tree.getModel()
+            for i in range(c.getChildCount()):
+                model.remove_children(c.getChildAt(i))
+            if self.split.getRightComponent() is placeholder:
+                self.set_right(JScrollPane())
+            self.build_search_index(c)
+        # Not stale_check: the new catalog must reach the tree whatever
+        # is selected meanwhile
+        self.cancel_pending_load()
+        self.set_right(placeholder)
+        self.run_task(c.getUserObject().db.load_snapshot,
+                        (CACHE_DIR, False), refreshed, stale_check=False)
+
+    def open_databases(self):
+        "(label, tree node) of every opened database."
+        a = []
+        root = self.tree.getModel().getRoot()
+        for i in range(root.getChildCount()):
+            server = root.getChildAt(i)
+            for j in range(server.getChildCount()):
+                c = server.getChildAt(j)
+                if getattr(c.getUserObject(), 'db', None):
+                    a.append((server.getUserObject().name + ':'
+                                    + c.getUserObject().name, c))
+        return a
+
+    def compare_database(self, c):
+        "Show the ALTER script that makes another database like this one."
+        others = [(label, other) for label, other in self.open_databases()
+                                                            if other is not c]
+        if not others:
+            JOptionPane.showMessageDialog(self,
+                    'Open the database to compare with first.', 'Compare',
+                    JOptionPane.INFORMATION_MESSAGE)
+            return
+        labels = [label for label, other in others]
+        label = JOptionPane.showInputDialog(self,
+                    'Make this database like ' + c.getUserObject().name,
+                    'Compare Schema', JOptionPane.QUESTION_MESSAGE, None,
+                    jarray.array(labels, Object), labels[0])
+        if not label:
+            return
+        target = dict(others)[label].getUserObject()
+        def diff(source, target):
+            t = time.time()
+            statements, counts = fbutil.schema_diff(source.db, target.db)
+            head = ('/* %s -> %s: %d same, %d changed, %d added, '
+                '%d dropped, %.1f s */' % (source.name, label,
+                    counts['same'], counts['changed'], counts['added'],
+                    counts['dropped'], time.time() - t))
+            return '\n'.join([head] + statements)
+        # A task of its own: reading two catalogs must not hold up the
+        # metadata thread, nor be dropped when another node is selected
+        self.cancel_pending_load()
+        self.set_right(JLabel(' Comparing %s with %s ...' % (
+                                            c.getUserObject().name, label)))
+        BackgroundTask(diff, (c.getUserObject(), target), self.show_text,
+                                                self.show_error).execute()
+
+    # Find box
+    def build_search_index(self, c):
+        "Index the catalog of an open database on a background thread."
+        node = c.getUserObject()
+        db = node.db
+        node.search_index = node.search_index_error = None
+        def built(index):
+            if node.db is db:
+                node.search_index = index
+        def failed(e):
+            if node.db is db:
+                node.search_index_error = e     # find() shows it
+        BackgroundTask(fbutil.MetadataIndex().load, (db, ),
+                                                    built, failed).execute()
+
+    def selected_database(self):
+        "Tree node of the open database the selection is in, or None."
+        path = self.tree.getSelectionPath()
+        if not path:
+            return None
+        c = path.getLastPathComponent()
+        while c and c.getUserObject().node_type != 'DATABASE':
+            c = c.getParent()
+        if c and getattr(c.getUserObject(), 'db', None):
+            return c
+        return None
+
+    def find(self, e=None):
+        text = self.find_text.getText().strip()
+        db_node = self.selected_database()
+        if not text or not db_node:
+            return
+        self.cancel_pending_load()
+        node = db_node.getUserObject()
+        index = getattr(node, 'search_index', None)
+        error = getattr(node, 'search_index_error', None)
+        if error:
+            self.set_right(JLabel(' Indexing failed: %s; indexing again ...'
+                                                                    % error))
+            self.build_search_index(db_node)
+            return
+        if not index:
+            self.set_right(JLabel(' Indexing ...'))
+            return
+        hits = index.search(text)
+        table = self.show_table(['KIND', 'NAME', 'MATCH'],
+                                    [list(hit[:3]) for hit in hits])
+        table.addMouseListener(FindResultMouseListener(self, db_node, hits))
+
+    def select_object(self, db_node, category, name):
+        "Select the tree node of an object, loading its category first."
+        for i in range(db_node.getChildCount()):
+            c = db_node.getChildAt(i)
+            if c.getUserObject().node_type == category:
+                break
+        else:
+            return
+        model = self.tree.getModel()
+        def select(result=None):
+            if result:
+                self.node_loaded(c, result)
+            if c.getUserObject().filter:
+                model.set_filter(c, '')
+            target = c
+            for j in range(c.getChildCount()):
+                if c.getChildAt(j).getUserObject().name == name:
+                    target = c.getChildAt(j)
+                    break
+            path = TreePath(target.getPath())
+            self.tree.setSelectionPath(path)
+            self.tree.scrollPathToVisible(path)
+        if name is None or model.is_loaded(c):
+            select()
+        else:
+            self.run_task(self.load_node, (db_node.getUserObject().db,
+                            category, c.getUserObject().name), select)
+
+    def close_database(self, c):
+        node = c.getUserObject()
+        db = node.db
+        node.db = None
+        node.search_index = node.search_index_error = None
+        self.cancel_pending_load()
+        self.set_right(JScrollPane())   # Stops a showing MonitorPanel
+        self.update_menu_tree(c)
+        self.run_task(db.close, (), None, stale_check=False)
+
+    # Loaders for the right pane. They run on the metadata thread.
+    def load_constraints(self, db, name):
+        h = ['NAME', 'CONDITION', 'TYPE', 'FIELDS']
+        d = []
+        for row in db.constraints(name):
+            d.append([row[k] for k in h])
+        return h, d
+
+    def load_index(self, db, name):
+        h = ['INDEX_NAME', 'CONST_NAME', 'CONST_TYPE', 'FOREIGN_KEY', 
+                'FIELD_NAME', 'UNIQUE_FLAG', 'UPDATE_RULE', 'DELETE_RULE', 
+                'STATISTICS', 'INACT']
+        d = []
+        for row in db.key_constraints_and_index(name):
+            d.append([row[k] for k in h])
+        return h, d
+
+    def load_grants(self, db, name):
+        priv = {'S' : 'SELECT', 
+            'D' : 'DELETE', 
+            'I' : 'INSERT', 
+            'U' : 'UPDATE',
+            'R' : 'REFERENCES',
+            'X' : 'EXECUTE',
+            }
+        d = {}
+        has_field_name = False
+        h, rows = db.grant_users(name)
+        for row in rows:
+            r = dict(zip(h, row))
+            d.setdefault((r['NAME'], r['GRANT_OPTION'], r['FIELD_NAME']),
+                                        []).append(priv[r['PRIVILEGE']])
+            if r['FIELD_NAME']:
+                has_field_name = True
+
+        rh = ['NAME', 'PRIVIVILEGE', 'GRANT_OPTION']
+        if has_field_name:
+            rh.append('FIELD_NAME')
+        rd = []
+        for k in d:
+            r = [k[0], ','.join(d[k]), k[1]]
+            if has_field_name:
+                r.append(k[2])
+            rd.append(r)
+        return rh, rd
+
+    def load_source(self, db, node):
+        if node.node_type == 'VIEW':
+            sql = 'recreate view ' + node.name + ' as\n'
+            sql += db.view_source(node.name)
+        elif node.node_type == 'PROCEDURE':
+            proc = db.procedure_source(node.name)
+            sql = 'set term !! ;\n'
+            sql += 'alter procedure ' + proc['NAME'] + '('
+            sql += ','.join([in_p['NAME'] 
+                        + ' ' + fbutil.fieldtype_to_string(in_p) 
+                        for in_p in proc['IN_PARAMS']])
+            sql += ')\nreturns ('
+            sql += ','.join([out_p['NAME'] 
+                        + ' ' + fbutil.fieldtype_to_string(out_p)
+                        for out_p in proc['OUT_PARAMS']])
+            sql += ') as\n' + '\n'.join(proc['SOURCE'].split('\n'))
+            sql += '!!\nset term ; !!'
+        return sql
+
     # Menu selection
     def actionPerformed(self, ae):
         ac = ae.getActionCommand()
@@ -545,7 +2068,8 @@ class MainFrame(JFrame, ActionListener, TreeSelectionListener):
             s = JOptionPane.showInputDialog(self, "Server Name")
             if s != None:
                 root = self.tree.getModel().getRoot()
-                root.add(DefaultMutableTreeNode(TreeNode(s, 'SERVER')))
+                self.tree.getModel().insertNodeInto(DefaultMutableTreeNode(
+                        TreeNode(s, 'SERVER')), root, root.getChildCount())
         elif ac == 'UNREG_SERVER':
             if c.getParent().getUserObject().node_type == 'ROOT':
                 self.tree.getModel().removeNodeFromParent(c)
@@ -553,12 +2077,14 @@ class MainFrame(JFrame, ActionListener, TreeSelectionListener):
             s = JOptionPane.showInputDialog(self, "Server Name", node)
             if s != None:
                 node.name = s
+                self.tree.getModel().nodeChanged(c)
         elif ac == 'REG_DB':
             dlg = ConnParamDialog(self)
             if dlg.conn_param:
                 node = TreeNode(dlg.conn_param.path, 'DATABASE')
                 node.conn_param = dlg.conn_param
-                c.add(DefaultMutableTreeNode(node))
+                self.tree.getModel().insertNodeInto(
+                        DefaultMutableTreeNode(node), c, c.getChildCount())
         elif ac == 'UNREG_DB':
             if c.getParent().getUserObject().node_type == 'SERVER':
                 self.tree.getModel().removeNodeFromParent(c)
@@ -567,160 +2093,65 @@ class MainFrame(JFrame, ActionListener, TreeSelectionListener):
             if dlg.conn_param:
                 node.name = dlg.conn_param.path
                 node.conn_param = dlg.conn_param
-                c.setUserObject(node)
+                self.tree.getModel().nodeChanged(c)
         elif ac == 'OPEN_DB':
-            param = node.conn_param
-            cancel = False
-            if param.password == None:
-                pwd = JPasswordField(10)
-                if JOptionPane.showConfirmDialog(self, pwd,
-                        "Enter %s's password" % (param.user), 
-                        JOptionPane.YES_NO_OPTION) == JOptionPane.YES_OPTION:
-                    param.password = String(pwd.getPassword())
-                else:
-                    cancel = True
-            if not cancel:
-                node.db = fbutil.FbDatabase(
-                    host=c.getParent().getUserObject().name,
-                    path=param.path, user=param.user, password=param.password,
-                    charset=param.charset, port=param.port)
-                try:
-                    node.db.open()
-                except Exception, e:
-                    node.db = None
-                    JOptionPane.showMessageDialog(self, str(e), 
-                            "Can't Open Database", JOptionPane.ERROR_MESSAGE)
-            self.update_menu_tree(c)
+            self.open_database(c)
         elif ac == 'CLOSE_DB':
-            node.db.close()
-            node.db = None
-            self.update_menu_tree(c)
+            self.close_database(c)
+        elif ac == 'REFRESH_DB':
+            self.refresh_database(c)
         elif ac == 'ISQL':
-            dlg = SqlDialog(self, node.db)
+            dlg = SqlDialog(self, node.db.for_lane(fbutil.QUERY_LANE))
+        elif ac == 'INDEX_HEALTH':
+            self.cancel_pending_load()
+            self.set_right(IndexHealthPanel(node.db))
+        elif ac == 'EXTRACT_DDL':
+            dlg = ExtractDdlDialog(self, node.db)
+        elif ac == 'COMPARE_DB':
+            self.compare_database(c)
         elif ac == 'TABLE_CONSTRAINTS':
-            h = ['NAME', 'CONDITION', 'TYPE', 'FIELDS']
             db = c.getParent().getParent().getUserObject().db
-            d = []
-            for row in db.constraints(node.name):
-                r = []
-                for k in h:
-                    r.append(row[k])
-                d.append(r)
-            table = JTable(d, head_titles(h))
-            loc = self.split.getDividerLocation()
-            self.split.setRightComponent(JScrollPane(table))
-            adjust_column_width(table)
-            self.split.setDividerLocation(loc)
-            table.setDefaultRenderer(Object, ShowConstraintsTableCellRenderer())
+            self.table_task(self.load_constraints, (db, node.name),
+                                        ShowConstraintsTableCellRenderer())
         elif ac == 'SHOW_INDEX':
-            h = ['INDEX_NAME', 'CONST_NAME', 'CONST_TYPE', 'FOREIGN_KEY', 
-                    'FIELD_NAME', 'UNIQUE_FLAG', 'UPDATE_RULE', 'DELETE_RULE', 
-                    'STATISTICS', 'INACT']
             db = c.getParent().getParent().getUserObject().db
-            d = []
-            for row in db.key_constraints_and_index(node.name):
-                r = []
-                for k in h:
-                    r.append(row[k])
-                d.append(r)
-            table = JTable(d, head_titles(h))
-            loc = self.split.getDividerLocation()
-            self.split.setRightComponent(JScrollPane(table))
-            adjust_column_width(table)
-            self.split.setDividerLocation(loc)
-            table.setDefaultRenderer(Object, ShowIndexTableCellRenderer())
+            self.table_task(self.load_index, (db, node.name),
+                                        ShowIndexTableCellRenderer())
         elif ac == 'SHOW_REFERENCED_COLUMN':
             db = c.getParent().getParent().getUserObject().db
-            h, d = db.referenced_columns(node.name)
-            table = JTable(d, head_titles(h))
-            loc = self.split.getDividerLocation()
-            self.split.setRightComponent(JScrollPane(table))
-            adjust_column_width(table)
-            self.split.setDividerLocation(loc)
+            self.table_task(db.referenced_columns, (node.name, ))
         elif ac == 'SHOW_GRANT':
             db = c.getParent().getParent().getUserObject().db
-            priv = {'S' : 'SELECT', 
-                'D' : 'DELETE', 
-                'I' : 'INSERT', 
-                'U' : 'UPDATE',
-                'R' : 'REFERENCES',
-                'X' : 'EXECUTE',
-                }
-            d = {}
-            has_field_name = False
-            h, rows = db.grant_users(node.name)
-            for row in rows:
-                r = dict(zip(h, row))
-                d.setdefault((r['NAME'], r['GRANT_OPTION'], r['FIELD_NAME']),
-                                            []).append(priv[r['PRIVILEGE']])
-                if r['FIELD_NAME']:
-                    has_field_name = True
-
-            rh = ['NAME', 'PRIVIVILEGE', 'GRANT_OPTION']
-            if has_field_name:
-                rh.append('FIELD_NAME')
-            rd = []
-            for k in d:
-                r = [k[0], ','.join(d[k]), k[1]]
-                if has_field_name:
-                    r.append(k[2])
-                rd.append(r)
-            table = JTable(rd, head_titles(rh))
-            loc = self.split.getDividerLocation()
-            self.split.setRightComponent(JScrollPane(table))
-            adjust_column_width(table)
-            self.split.setDividerLocation(loc)
+            self.table_task(self.load_grants, (db, node.name))
         elif ac == 'VIEW_SOURCE':
             db = c.getParent().getParent().getUserObject().db
-            if node.node_type == 'VIEW':
-                sql = 'recreate view ' + node.name + ' as\n'
-                sql += db.view_source(node.name)
-            elif node.node_type == 'PROCEDURE':
-                proc = db.procedure_source(node.name)
-                sql = 'set term !! ;\n'
-                sql += 'alter procedure ' + proc['NAME'] + '('
-                sql += ','.join([in_p['NAME'] 
-                            + ' ' + fbutil.fieldtype_to_string(in_p) 
-                            for in_p in proc['IN_PARAMS']])
-                sql += ')\nreturns ('
-                sql += ','.join([out_p['NAME'] 
-                            + ' ' + fbutil.fieldtype_to_string(out_p)
-                            for out_p in proc['OUT_PARAMS']])
-                sql += ') as\n' + '\n'.join(proc['SOURCE'].split('\n'))
-                sql += '!!\nset term ; !!'
-            text = JTextArea(sql)
-            text.setEditable(False)
-            loc = self.split.getDividerLocation()
-            self.split.setRightComponent(JScrollPane(text))
-            self.split.setDividerLocation(loc)
+            self.run_task(self.load_source, (db, node), self.show_text)
+        elif ac == 'EXPORT_DATA':
+            db = c.getParent().getParent().getUserObject().db
+            dlg = ExportDialog(self, db.for_lane(fbutil.QUERY_LANE),
+                                                    table_name=node.name)
+        elif ac == 'IMPORT_DATA':
+            db = c.getParent().getParent().getUserObject().db
+            dlg = ImportDialog(self, db, node.name)
         elif ac == 'QUIT':
             self.quit_app(None)
+        elif ac == 'DIAGNOSTICS':
+            self.cancel_pending_load()
+            self.set_right(DiagnosticsPanel())
         elif ac == 'ABOUT':
             s = [APP_NAME, ' ', __version__, '\n', 'Jython', sys.version]
             JOptionPane.showMessageDialog(self, 
                 ''.join(s), 'Version', JOptionPane.INFORMATION_MESSAGE)
 
-        self.tree.updateUI()
-
     # Tree selection
-    def valueChanged(self, tse):
-        path = self.tree.getSelectionPath()
-        if not path:
-            c = self.tree.getModel().getRoot()
-        else:
-            c = path.getLastPathComponent()
-        node = c.getUserObject()
-        fill_table = False
-        fill_text = False
-        try:
-            db = c.getParent().getUserObject().db
-        except:
-            try:
-                db = c.getParent().getParent().getUserObject().db
-            except:
-                pass
+    def load_node(self, db, node_type, name):
+        """Fetch what the right pane shows for a tree node.
 
-        if node.node_type == 'DOMAINS':
+        Runs on the metadata thread. Returns (head, rows, key columns) for
+        a table or (None, text, None) for a source text.
+        """
+        keys = None
+        if node_type == 'DOMAINS':
             h, d = db.domains()
             th = ['NAME', 'TYPE', 'CHECK', 'DEFAULT', 'DESCRIPTION']
             td = []
@@ -730,55 +2161,37 @@ class MainFrame(JFrame, ActionListener, TreeSelectionListener):
                     row['VALIDATION_SOURCE'], fbutil.default_source_string(row),
                     row['DESCRIPTION']])
             h, d = th, td
-            fill_table = True
-        elif node.node_type == 'EXCEPTIONS':
+        elif node_type == 'EXCEPTIONS':
             h, d = db.exceptions()
-            fill_table = True
-        elif node.node_type == 'FUNCTIONS':
+        elif node_type == 'FUNCTIONS':
             h, d = db.functions()
-            fill_table = True
-        elif node.node_type == 'GENERATORS':
+        elif node_type == 'GENERATORS':
             h, d = db.generators()
             h.append('COUNT')
+            values = db.generator_values([r[0] for r in d])
             for r in d:
-                r.append(db.get_generator_id(r[0]))
-            fill_table = True
-        elif node.node_type == 'PROCEDURES':
+                r.append(values[r[0]])
+        elif node_type == 'PROCEDURES':
             h, d = db.procedures()
-            if not c.getChildCount():
-                for r in d:
-                    c.add(DefaultMutableTreeNode(TreeNode(r[0], 'PROCEDURE')))
-            fill_table = True
-        elif node.node_type == 'PROCEDURE':
+        elif node_type == 'PROCEDURE':
             h = ['NAME', 'I/O', 'TYPE', 'DESCRIPTION']
             d = []
-            p = db.procedure_source(node.name)
+            p = db.procedure_params(name)
             for in_p in p['IN_PARAMS']:
                 d.append([in_p['NAME'], 'IN', 
                     fbutil.fieldtype_to_string(in_p), in_p['DESCRIPTION']])
             for out_p in p['OUT_PARAMS']:
                 d.append([out_p['NAME'], 'OUT', 
                     fbutil.fieldtype_to_string(out_p), out_p['DESCRIPTION']])
-            fill_table = True
-        elif node.node_type == 'ROLES':
+        elif node_type == 'ROLES':
             h, d = db.roles()
-            if not c.getChildCount():
-                for r in d:
-                    c.add(DefaultMutableTreeNode(TreeNode(r[0], 'ROLE')))
-            fill_table = True
-        elif node.node_type == 'ROLE':
-            h, d = db.grant_users(node.name)
-            fill_table = True
-        elif node.node_type == 'TABLES' or node.node_type == 'SYSTEMTABLES':
-            system_flag = 0 if node.node_type == 'TABLES' else 1
+        elif node_type == 'ROLE':
+            h, d = db.grant_users(name)
+        elif node_type == 'TABLES' or node_type == 'SYSTEMTABLES':
+            system_flag = 0 if node_type == 'TABLES' else 1
             h, d = db.tables(system_flag)
-            if not c.getChildCount():
-                for r in d:
-                    k = 'TABLE' if node.node_type == 'TABLES' else 'SYSTEMTABLE'
-                    c.add(DefaultMutableTreeNode(TreeNode(r[0], k)))
-            fill_table = True
-        elif node.node_type == 'TABLE' or node.node_type == 'SYSTEMTABLE':
-            h, d = db.columns(node.name)
+        elif node_type == 'TABLE' or node_type == 'SYSTEMTABLE':
+            h, d = db.columns(name)
             th = ['NAME', 'TYPE', 'IS NULL', 'DEFAULT', 'DESCRIPTION']
             td = []
             for r in d:
@@ -787,26 +2200,25 @@ class MainFrame(JFrame, ActionListener, TreeSelectionListener):
                     row['NULL_FLAG'], row['DEFAULT_SOURCE'], 
                     row['DESCRIPTION']])
             h, d = th, td
-            fill_table = True
-        elif node.node_type == 'TRIGGERS':
+            pk = []
+            fk = []
+            uk = []
+            for r in db.key_constraints_and_index(name):
+                if r['CONST_TYPE'] == 'PRIMARY KEY':
+                    pk += r['FIELD_NAME']
+                elif r['CONST_TYPE'] == 'FOREIGN KEY':
+                    fk += r['FIELD_NAME']
+                elif r['CONST_TYPE'] == 'UNIQUE':
+                    uk += r['FIELD_NAME']
+            keys = (pk, fk, uk)
+        elif node_type == 'TRIGGERS':
             h, d = db.triggers()
-            if not c.getChildCount():
-                for r in d:
-                    k = 'TRIGGER_INACT' if r[4] == '1' else 'TRIGGER'
-                    c.add(DefaultMutableTreeNode(TreeNode(r[0], k)))
-            fill_table = True
-        elif node.node_type == 'TRIGGER' or node.node_type == 'TRIGGER_INACT':
-            s = db.trigger_source(node.name)
-            fill_text = True
-        elif node.node_type == 'VIEWS':
+        elif node_type == 'TRIGGER' or node_type == 'TRIGGER_INACT':
+            return (None, db.trigger_source(name), None)
+        elif node_type == 'VIEWS':
             h, d = db.views()
-            if not c.getChildCount():
-                for r in d:
-                    c.add(DefaultMutableTreeNode(TreeNode(r[0], 'VIEW')))
-            fill_table = True
-        elif node.node_type == 'VIEW':
-            h, d = db.columns(node.name)
-            fill_table = True
+        elif node_type == 'VIEW':
+            h, d = db.columns(name)
             th = ['NAME', 'TYPE', 'DESCRIPTION']
             td = []
             for r in d:
@@ -814,35 +2226,130 @@ class MainFrame(JFrame, ActionListener, TreeSelectionListener):
                 td.append([row['NAME'], 
                         fbutil.fieldtype_to_string(row), row['DESCRIPTION']])
             h, d = th, td
-            fill_table = True
-        loc = self.split.getDividerLocation()
-        if fill_table:
-            table = JTable(d, head_titles(h))
-            self.split.setRightComponent(JScrollPane(table))
-            adjust_column_width(table)
-        elif fill_text:
-            text = JTextArea(s)
-            text.setEditable(False)
-            loc = self.split.getDividerLocation()
-            self.split.setRightComponent(JScrollPane(text))
-            self.split.setDividerLocation(loc)
+        return (h, d, keys)
+
+    def node_loaded(self, c, result):
+        h, d, keys = result
+        if h is None:
+            self.show_text(d)
+            return
+        node_type = c.getUserObject().node_type
+        self.add_children(c, d)
+        renderer = None
+        if keys:
+            renderer = ColumnTableCellRenderer(*keys)
+        self.show_table(h, d, renderer)
+        if node_type in ('TABLE', 'SYSTEMTABLE', 'VIEW'):
+            self.show_data_tab(c)
+
+    def show_data_tab(self, c):
+        "Put the right pane under a Columns tab, next to a Data tab."
+        db = c.getParent().getParent().getUserObject().db
+        data = DataPanel(self, db, c.getUserObject().name)
+        tabs = JTabbedPane()
+        tabs.addTab('Columns', self.split.getRightComponent())
+        tabs.addTab('Data', data)
+        def tab_changed(e):
+            self.data_tab_selected = tabs.getSelectedComponent() is data
+            if self.data_tab_selected:
+                data.load()
+        tabs.stateChanged = tab_changed
+        if self.data_tab_selected:
+            tabs.setSelectedComponent(data)
+        self.set_right(tabs)
+
+    def add_children(self, c, rows):
+        "Give a category node its children, the first time only."
+        model = self.tree.getModel()
+        node_type = c.getUserObject().node_type
+        child_type = self.child_types.get(node_type)
+        if not child_type or model.is_loaded(c):
+            return
+        children = []
+        for r in rows:
+            k = child_type
+            if node_type == 'TRIGGERS' and r[4] == '1':
+                k = 'TRIGGER_INACT'
+            children.append(DefaultMutableTreeNode(TreeNode(r[0], k)))
+        model.set_children(c, children)
+
+    def treeWillExpand(self, e):
+        "Load the children of a category before it opens."
+        path = e.getPath()
+        c = path.getLastPathComponent()
+        node = c.getUserObject()
+        model = self.tree.getModel()
+        if not self.child_types.has_key(node.node_type) or model.is_loaded(c):
+            return
+        db = c.getParent().getUserObject().db
+        def loaded(result):
+            self.add_children(c, result[1])
+            self.tree.expandPath(path)
+        self.run_task(self.load_node, (db, node.node_type, node.name),
+                                                    loaded, stale_check=False)
+        raise ExpandVetoException(e)
+
+    def treeWillCollapse(self, e):
+        pass
+
+    def tree_key_typed(self, e):
+        "Typing narrows the children of the selected category by prefix."
+        path = self.tree.getSelectionPath()
+        if not path:
+            return
+        model = self.tree.getModel()
+        c = path.getLastPathComponent()
+        if not model.is_loaded(c):
+            c = c.getParent()
+            if not c or not model.is_loaded(c):
+                return
+            self.tree.setSelectionPath(TreePath(c.getPath()))
+        prefix = c.getUserObject().filter
+        ch = e.getKeyChar()
+        if ch == '\b':
+            prefix = prefix[:-1]
+        elif ch == '\x1b':
+            prefix = ''
+        elif ch.isalnum() or ch in '_$':
+            prefix += ch
         else:
-            self.split.setRightComponent(JScrollPane())
-        self.split.setDividerLocation(loc)
+            return
+        e.consume()
+        model.set_filter(c, prefix)
+        self.tree.expandPath(TreePath(c.getPath()))
 
-        if node.node_type == 'TABLE' or node.node_type == 'SYSTEMTABLE':
-            pk = []
-            fk = []
-            uk = []
-            for r in db.key_constraints_and_index(node.name):
-                if r['CONST_TYPE'] == 'PRIMARY KEY':
-                    pk += r['FIELD_NAME']
-                elif r['CONST_TYPE'] == 'FOREIGN KEY':
-                    fk += r['FIELD_NAME']
-                elif r['CONST_TYPE'] == 'UNIQUE':
-                    uk += r['FIELD_NAME']
-            table.setDefaultRenderer(Object,
-                    ColumnTableCellRenderer(pk, fk, uk))
+    child_types = {'PROCEDURES': 'PROCEDURE', 'ROLES': 'ROLE',
+                'TABLES': 'TABLE', 'SYSTEMTABLES': 'SYSTEMTABLE',
+                'TRIGGERS': 'TRIGGER', 'VIEWS': 'VIEW'}
+    loaded_types = ('DOMAINS', 'EXCEPTIONS', 'FUNCTIONS', 'GENERATORS',
+                'PROCEDURES', 'PROCEDURE', 'ROLES', 'ROLE', 
+                'TABLES', 'SYSTEMTABLES', 'TABLE', 'SYSTEMTABLE',
+                'TRIGGERS', 'TRIGGER', 'TRIGGER_INACT', 'VIEWS', 'VIEW')
+
+    def valueChanged(self, tse):
+        path = self.tree.getSelectionPath()
+        if not path:
+            c = self.tree.getModel().getRoot()
+        else:
+            c = path.getLastPathComponent()
+        node = c.getUserObject()
+        try:
+            db = c.getParent().getUserObject().db
+        except:
+            try:
+                db = c.getParent().getParent().getUserObject().db
+            except:
+                pass
+
+        if node.node_type in self.loaded_types:
+            self.run_task(self.load_node, (db, node.node_type, node.name),
+                            lambda result: self.node_loaded(c, result))
+        elif node.node_type == 'MONITOR':
+            self.cancel_pending_load()
+            self.set_right(MonitorPanel(db))
+        else:
+            self.cancel_pending_load()
+            self.set_right(JScrollPane())
 
         self.update_menu_tree(c)
 
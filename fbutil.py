@@ -26,12 +26,74 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 ##############################################################################
+import os, sys, re, time, threading, hashlib, itertools, bisect, Queue
+import cPickle as pickle
+import jarray
+PythonException = Exception     # from java.lang import * hides it
 from java.lang import *
 from java.sql import *
-from java.util import Properties
+from java.math import BigDecimal
+from java.util import Properties, BitSet
+from java.io import FileOutputStream, OutputStreamWriter, BufferedWriter
+from java.io import FileInputStream, InputStreamReader, BufferedReader
+from java.util.zip import GZIPOutputStream, GZIPInputStream
 
 Class.forName("org.firebirdsql.jdbc.FBDriver")
 
+FETCH_SIZE = 400        # rows per round-trip for streamed results
+STMT_CACHE_SIZE = 64    # prepared catalog statements kept per connection
+MAX_STMT_LENGTH = 60000 # Firebird limits a statement to 64KB
+MAX_SELECT_ITEMS = 1000 # columns per generated wide select
+SNAPSHOT_CACHE_VERSION = 4  # bump when SchemaSnapshot's attributes change
+META_LANE = 'META'      # pool lane for catalog browsing, read-only
+QUERY_LANE = 'QUERY'    # pool lane for user statements
+POOL_MIN_SIZE = 1       # idle connections kept per lane
+POOL_MAX_SIZE = 4       # connections per lane
+POOL_IDLE_TIMEOUT = 300 # seconds before an idle connection is closed
+POOL_WAIT_TIMEOUT = 60  # seconds to wait for a free connection
+POOL_VALIDATE_TIMEOUT = 5
+CSV = 'CSV'
+JSON_LINES = 'JSON Lines'
+EXPORT_FETCH_SIZE = 1000
+EXPORT_BUFFER_SIZE = 65536
+IMPORT_BATCH_SIZE = 500         # rows per executeBatch()
+IMPORT_COMMIT_INTERVAL = 10000  # rows per transaction
+IMPORT_QUEUE_BATCHES = 4        # parsed batches waiting for the inserter
+DATA_PAGE_SIZE = 200    # rows per page of KeysetPager
+STATS_RING_SIZE = 1000  # statements kept by the Profiler
+STATS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                10000, 30000, 60000)    # histogram bucket upper bounds, ms
+MONITOR_INTERVAL = 5    # seconds between ActivitySampler samples
+PLAN_BIG_TABLE_ROWS = 100000    # NATURAL scans from here on are flagged
+INDEX_SAMPLE_ROWS = 10000       # rows read to check index statistics
+INDEX_STATS_TOLERANCE = 2.0     # factor stored and sampled keys may differ
+SEARCH_LIMIT = 500      # documents returned by MetadataIndex.search()
+
+# Catalog texts hashed by FbDatabase.fingerprint()
+FINGERPRINT_TEXTS = (
+    '''select rdb$relation_name, rdb$view_source, rdb$description
+        from rdb$relations order by 1''',
+    '''select rdb$relation_name, rdb$field_name, rdb$field_source,
+        rdb$default_source, rdb$null_flag, rdb$collation_id, rdb$description
+        from rdb$relation_fields order by 1, 2''',
+    '''select rdb$field_name, rdb$field_type, rdb$field_sub_type,
+        rdb$field_length, rdb$field_scale, rdb$field_precision,
+        rdb$character_length, rdb$character_set_id, rdb$collation_id,
+        rdb$segment_length, rdb$null_flag, rdb$default_source,
+        rdb$validation_source, rdb$computed_source, rdb$description
+        from rdb$fields order by 1''',
+    '''select rdb$trigger_name, rdb$trigger_source, rdb$description
+        from rdb$triggers order by 1''',
+    '''select rdb$procedure_name, rdb$procedure_source, rdb$description
+        from rdb$procedures order by 1''',
+    '''select rdb$procedure_name, rdb$parameter_name, rdb$description
+        from rdb$procedure_parameters order by 1, 2''',
+    '''select rdb$exception_name, rdb$message, rdb$description
+        from rdb$exceptions order by 1''')
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
 def fieldtype_to_string(d, 
     resolve_typename = True, with_null_flag = False, with_default = False):
     if resolve_typename and d['FIELD_NAME'][:4] != 'RDB$':
@@ -42,34 +104,46 @@ def fieldtype_to_string(d,
         else:
             clen = ''
         type_name = d['TYPE_NAME']
-        if type_name == 'SHORT':
+        # Catalog values come as strings from execute(), ints elsewhere
+        sub_type = str(d['FIELD_SUB_TYPE'])
+        scale = int(d['FIELD_SCALE'] or 0)
+        if (type_name in ('SHORT', 'LONG', 'INT64')
+                                    and (sub_type in ('1', '2') or scale)):
+            if sub_type == '2':
+                s = 'DECIMAL('
+            else:
+                s = 'NUMERIC('
+            s += str(d['FIELD_PRECISION']
+                    or {'SHORT': 4, 'LONG': 9, 'INT64': 18}[type_name])
+            if scale:
+                s += ',' + str(-scale)
+            s += ')'
+        elif type_name == 'SHORT':
             s = 'SMALLINT'
         elif type_name == 'LONG':
             s = 'INTEGER'
+        elif type_name == 'INT64':
+            s = 'BIGINT'
         elif type_name == 'TEXT':
             s = 'CHAR(' + clen + ')'
         elif type_name == 'VARYING':
             s = 'VARCHAR(' + clen + ')'
-        elif type_name == 'INT64':
-            if d['FIELD_SUB_TYPE'] == 1:
-                s = 'NUMERIC'
-            else:
-                s = 'DECIMAL('
-            if d['FIELD_PRECISION']:
-                s += d['FIELD_PRECISION']
-                if d['FIELD_PRECISION'] and d['FIELD_SCALE']:
-                    s += ','+str(int(d['FIELD_SCALE'])*-1)
-            s += ')'
         elif type_name == 'BLOB':
             s = 'BLOB SUB_TYPE ' + str(d['FIELD_SUB_TYPE'])
+            if d.get('SEGMENT_LENGTH'):
+                s += ' SEGMENT SIZE ' + str(d['SEGMENT_LENGTH'])
         elif type_name == 'DOUBLE':
             s = 'DOUBLE PRECISION'
         else:
             s = type_name
+        # Rows of queries without the character set leave it out
+        if (d.get('CHARACTER_SET_NAME') and (type_name in ('TEXT', 'VARYING')
+                                or type_name == 'BLOB' and sub_type == '1')):
+            s += ' CHARACTER SET ' + d['CHARACTER_SET_NAME']
 
     if with_default and d['DEFAULT_SOURCE']:
         s += ' ' + d['DEFAULT_SOURCE']
-    if with_null_flag and d['NULL_FLAG'] == 1:
+    if with_null_flag and str(d['NULL_FLAG']) == '1':
         s += ' NOT NULL'
 
     return s
@@ -83,63 +157,1903 @@ def default_source_string(d):
         s = ''
     return s
 
+class StatementRecord(object):
+    """Timings of one statement, in seconds.
+
+    first_row is from the start of execution to the first row read and
+    fetch the time spent reading rows (not the caller's time between
+    them). bytes is an estimate of the data read.
+    """
+    def __init__(self, tag, sql):
+        self.tag = tag
+        self.sql = sql
+        self.started = time.time()
+        self.prepare = 0.0
+        self.execute = 0.0
+        self.first_row = None
+        self.fetch = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.error = None
+
+    def elapsed(self):
+        return self.prepare + self.execute + self.fetch
+
+
+class Profiler(object):
+    """Keeps the last ring_size StatementRecords and, per tag, a histogram
+    of statement latencies over STATS_BUCKETS plus running totals.
+    """
+    def __init__(self, ring_size=STATS_RING_SIZE):
+        self.ring_size = ring_size
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.ring = [None] * self.ring_size
+            self.next = 0
+            self.histograms = {}    # tag -> counts, one more than buckets
+            self.totals = {}        # tag -> [calls, seconds, max, rows, bytes]
+        finally:
+            self.lock.release()
+
+    def record(self, rec):
+        ms = rec.elapsed() * 1000
+        b = bisect.bisect_left(STATS_BUCKETS, ms)
+        self.lock.acquire()
+        try:
+            self.ring[self.next] = rec
+            self.next = (self.next + 1) % self.ring_size
+            if not self.histograms.has_key(rec.tag):
+                self.histograms[rec.tag] = [0] * (len(STATS_BUCKETS) + 1)
+                self.totals[rec.tag] = [0, 0.0, 0.0, 0, 0]
+            self.histograms[rec.tag][b] += 1
+            t = self.totals[rec.tag]
+            t[0] += 1
+            t[1] += rec.elapsed()
+            t[2] = max(t[2], rec.elapsed())
+            t[3] += rec.rows
+            t[4] += rec.bytes
+        finally:
+            self.lock.release()
+
+    def records(self):
+        "Records in the ring, oldest first."
+        self.lock.acquire()
+        try:
+            return [r for r in self.ring[self.next:] + self.ring[:self.next]
+                                                                if r]
+        finally:
+            self.lock.release()
+
+    def slowest(self, n=100):
+        a = [(r.elapsed(), r) for r in self.records()]
+        a.sort()
+        a.reverse()
+        return [r for e, r in a[:n]]
+
+    def percentile(self, tag, p):
+        """Upper bound in ms of the bucket holding the p-th percentile.
+
+        None when it falls beyond the last bucket.
+        """
+        counts = self.histograms[tag]
+        rank = sum(counts) * p / 100.0
+        n = 0
+        for i in range(len(STATS_BUCKETS)):
+            n += counts[i]
+            if n >= rank:
+                return STATS_BUCKETS[i]
+        return None
+
+    def summary(self):
+        "(head, rows) of calls, rows, bytes and latencies per tag."
+        h = ['TAG', 'CALLS', 'ROWS', 'KBYTES', 'TOTAL_S', 'AVG_MS',
+                                        'P50_MS', 'P90_MS', 'P99_MS', 'MAX_MS']
+        d = []
+        self.lock.acquire()
+        try:
+            tags = self.totals.keys()
+            tags.sort()
+            for tag in tags:
+                calls, seconds, slowest, rows, bytes = self.totals[tag]
+                r = [tag, calls, rows, bytes // 1024, '%.2f' % seconds,
+                                        '%.1f' % (seconds * 1000 / calls)]
+                for p in (50, 90, 99):
+                    ms = self.percentile(tag, p)
+                    r.append(ms is None and '>%d' % STATS_BUCKETS[-1]
+                                                    or '<=%d' % ms)
+                r.append('%.1f' % (slowest * 1000))
+                d.append(r)
+        finally:
+            self.lock.release()
+        return h, d
+
+profiler = Profiler()   # shared by every FbDatabase
+
+def _caller_tag(depth):
+    "Class.method (or function) name of the frame depth levels up."
+    f = sys._getframe(depth + 1)
+    obj = f.f_locals.get('self')
+    if obj is None:
+        return f.f_code.co_name
+    return '%s.%s' % (obj.__class__.__name__, f.f_code.co_name)
+
+
+class StatementCache(object):
+    """LRU of PreparedStatements of one connection, keyed by SQL text.
+
+    A statement is taken out of the cache while it is in use and given
+    back afterwards, so two threads never share one: a second user of the
+    same SQL text gets a freshly prepared statement.
+    """
+    def __init__(self, conn, size=STMT_CACHE_SIZE):
+        self.conn = conn
+        self.size = size
+        self.stmts = {}         # SQL text -> idle statements
+        self.lru = []           # SQL texts, most recently used last
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def take(self, sql):
+        self.lock.acquire()
+        try:
+            idle = self.stmts.get(sql)
+            if idle:
+                self.hits += 1
+                return idle.pop()
+            self.misses += 1
+        finally:
+            self.lock.release()
+        return self.conn.prepareStatement(sql)
+
+    def give(self, sql, stmt):
+        evicted = []
+        self.lock.acquire()
+        try:
+            self.stmts.setdefault(sql, []).append(stmt)
+            if sql in self.lru:
+                self.lru.remove(sql)
+            self.lru.append(sql)
+            while len(self.lru) > self.size:
+                evicted += self.stmts.pop(self.lru.pop(0))
+        finally:
+            self.lock.release()
+        for stmt in evicted:
+            stmt.close()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for sql in self.stmts:
+                for stmt in self.stmts[sql]:
+                    stmt.close()
+            self.stmts = {}
+            self.lru = []
+        finally:
+            self.lock.release()
+
+
+class PooledConnection(object):
+    "A connection of a ConnectionPool with its own StatementCache."
+    def __init__(self, conn, lane):
+        self.conn = conn
+        self.lane = lane
+        self.stmt_cache = StatementCache(conn)
+        self.last_used = time.time()
+
+    def is_valid(self):
+        try:
+            return self.conn.isValid(POOL_VALIDATE_TIMEOUT)
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self.stmt_cache.close()
+            self.conn.close()
+        except Exception:
+            pass        # Already broken
+
+
+class ConnectionPool(object):
+    """Connections to one database as one user with one charset.
+
+    Connections are kept in lanes, so a long user query (QUERY lane)
+    never holds up catalog browsing (META lane, read-only). Each lane
+    opens at most max_size connections; idle ones beyond min_size are
+    closed after idle_timeout seconds. A connection is validated when
+    it is borrowed.
+    """
+    def __init__(self, connect, min_size=POOL_MIN_SIZE,
+                        max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.connect = connect      # function returning a new Connection
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = {}              # lane -> idle connections, newest last
+        self.size = {}              # lane -> connections open
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def borrow(self, lane=META_LANE):
+        deadline = time.time() + POOL_WAIT_TIMEOUT
+        self.cond.acquire()
+        try:
+            while True:
+                idle = self.idle.setdefault(lane, [])
+                if idle:
+                    pooled = idle.pop()
+                    break
+                if self.size.get(lane, 0) < self.max_size:
+                    self.size[lane] = self.size.get(lane, 0) + 1
+                    pooled = None
+                    break
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise RuntimeError('No free connection in pool')
+                self.cond.wait(wait)
+        finally:
+            self.cond.release()
+
+        if pooled and not pooled.is_valid():
+            pooled.close()
+            pooled = None
+        if not pooled:
+            try:
+                conn = self.connect()
+                if lane == META_LANE:
+                    conn.setReadOnly(True)
+            except:
+                self._discard(lane)
+                raise
+            pooled = PooledConnection(conn, lane)
+        return pooled
+
+    def give_back(self, pooled):
+        pooled.last_used = time.time()
+        self.cond.acquire()
+        try:
+            if not self.closed:
+                self.idle.setdefault(pooled.lane, []).append(pooled)
+                self.cond.notify()
+                return
+        finally:
+            self.cond.release()
+        pooled.close()
+        self._discard(pooled.lane)
+
+    def _discard(self, lane):
+        self.cond.acquire()
+        try:
+            self.size[lane] -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def evict_idle(self):
+        expired = []
+        limit = time.time() - self.idle_timeout
+        self.cond.acquire()
+        try:
+            for lane in self.idle:
+                idle = self.idle[lane]
+                while (idle and idle[0].last_used < limit
+                                        and self.size[lane] > self.min_size):
+                    expired.append(idle.pop(0))
+                    self.size[lane] -= 1
+        finally:
+            self.cond.release()
+        for pooled in expired:
+            pooled.close()
+
+    def close(self):
+        "Close the idle connections; borrowed ones close when given back."
+        self.cond.acquire()
+        try:
+            self.closed = True
+            for lane in self.idle:
+                for pooled in self.idle[lane]:
+                    pooled.close()
+                    self.size[lane] -= 1
+                self.idle[lane] = []
+        finally:
+            self.cond.release()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def connection_pool(host, port, path, user, password, charset,
+                                                    max_size=POOL_MAX_SIZE):
+    """The ConnectionPool for a database, user and charset; made on first
+    use, and grown to max_size connections per lane if it is smaller.
+    """
+    key = (host, port, path, user, charset)
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(key)
+        if not pool:
+            if not _pools:
+                reaper = threading.Thread(target=_evict_idle_connections)
+                reaper.setDaemon(True)
+                reaper.start()
+            pool = _pools[key] = ConnectionPool(None)
+        # Under both locks: another open, borrow(), give_back() or the
+        # eviction thread may be using the pool
+        pool.cond.acquire()
+        try:
+            pool.max_size = max(pool.max_size, max_size)
+            pool.closed = False
+            # The password may have been changed since the pool was made;
+            # callers check it first, see FbDatabase.open().
+            pool.connect = lambda: connect(host, port, path, user,
+                                                        password, charset)
+        finally:
+            pool.cond.release()
+    finally:
+        _pools_lock.release()
+    return pool
+
+def _evict_idle_connections():
+    while True:
+        time.sleep(POOL_IDLE_TIMEOUT / 2)
+        for pool in _pools.values():
+            pool.evict_idle()
+
+def close_pools():
+    _pools_lock.acquire()
+    try:
+        for pool in _pools.values():
+            pool.close()
+    finally:
+        _pools_lock.release()
+
+def run_parallel(func, items, workers=POOL_MAX_SIZE, progress=None,
+                                                            on_result=None):
+    """Call func(item) for every item on up to workers threads.
+
+    Returns [(item, result, error)] in the order of items, error being
+    None or the exception func raised. progress(done, total) and
+    on_result(item, result, error) are called from the worker threads
+    as items complete.
+    """
+    results = [None] * len(items)
+    queue = Queue.Queue()
+    for i in range(len(items)):
+        queue.put(i)
+    lock = threading.Lock()
+    done = [0]
+    def work():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (items[i], func(items[i]), None)
+            except (PythonException, Exception), e:
+                results[i] = (items[i], None, e)
+            if on_result:
+                on_result(*results[i])
+            lock.acquire()
+            try:
+                done[0] += 1
+                n = done[0]
+            finally:
+                lock.release()
+            if progress:
+                progress(n, len(items))
+    threads = [threading.Thread(target=work)
+                                for i in range(min(workers, len(items)))]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def connect(host, port, path, user, password, charset):
+    "A new, unpooled connection."
+    s = 'jdbc:firebirdsql:%s/%d:%s' % (host, port, path)
+    props = Properties()
+    props.setProperty("user", user)
+    props.setProperty("password", password)
+    props.setProperty("encoding", charset)
+    return DriverManager.getConnection(s, props)
+
+
+class ColumnarResult(object):
+    """Rows of a result set stored column by column.
+
+    Values are read with the getter of their SQL type. Integers, scaled
+    NUMERIC/DECIMAL (as unscaled longs), dates and times (as epoch
+    milliseconds) are kept in long arrays and approximate numbers in
+    double arrays, each with a BitSet marking NULLs. Times and timestamps
+    also keep their nanoseconds in an int array, as Firebird stores
+    1/10000 s that milliseconds cut off. Other columns keep
+    the stripped getString() value. Cells become strings only through
+    format_value(), when they are displayed.
+    For the columns labelled in key_columns the unconverted getObject()
+    values of the first and last row are kept in first_key and last_key.
+    """
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, md, key_columns=()):
+        self.head = []
+        self.kinds = []
+        self.scales = []
+        self.columns = []
+        self.nanos = []
+        self.nulls = []
+        self.row_count = 0
+        self.capacity = self.INITIAL_CAPACITY
+        for i in range(1, md.getColumnCount()+1):
+            t = md.getColumnType(i)
+            scale = md.getScale(i)
+            if t in (Types.SMALLINT, Types.INTEGER, Types.BIGINT,
+                                                            Types.TINYINT):
+                kind = 'l'
+            elif t in (Types.NUMERIC, Types.DECIMAL):
+                kind = scale and 'n' or 'l'
+            elif t in (Types.FLOAT, Types.REAL, Types.DOUBLE):
+                kind = 'd'
+            elif t == Types.DATE:
+                kind = 'D'
+            elif t == Types.TIME:
+                kind = 'T'
+            elif t == Types.TIMESTAMP:
+                kind = 'S'
+            else:
+                kind = 'o'
+            self.head.append(md.getColumnLabel(i))
+            self.kinds.append(kind)
+            self.scales.append(scale)
+            if kind == 'o':
+                self.columns.append([])
+            elif kind == 'd':
+                self.columns.append(jarray.zeros(self.capacity, 'd'))
+            else:
+                self.columns.append(jarray.zeros(self.capacity, 'l'))
+            if kind in ('T', 'S'):
+                self.nanos.append(jarray.zeros(self.capacity, 'i'))
+            else:
+                self.nanos.append(None)
+            self.nulls.append(BitSet())
+        labels = [h.strip().upper() for h in self.head]
+        self.key_index = [labels.index(k.upper()) for k in key_columns]
+        self.first_key = self.last_key = None
+
+    def __len__(self):
+        return self.row_count
+
+    def _grow(self):
+        self.capacity *= 2
+        for i in range(len(self.kinds)):
+            old = self.columns[i]
+            if self.kinds[i] == 'o':
+                continue
+            elif self.kinds[i] == 'd':
+                new = jarray.zeros(self.capacity, 'd')
+            else:
+                new = jarray.zeros(self.capacity, 'l')
+            System.arraycopy(old, 0, new, 0, self.row_count)
+            self.columns[i] = new
+            if self.nanos[i] is not None:
+                new = jarray.zeros(self.capacity, 'i')
+                System.arraycopy(self.nanos[i], 0, new, 0, self.row_count)
+                self.nanos[i] = new
+
+    def append(self, rs):
+        "Add the current row of rs."
+        r = self.row_count
+        if r == self.capacity:
+            self._grow()
+        if self.key_index:
+            self.last_key = [rs.getObject(i+1) for i in self.key_index]
+            if r == 0:
+                self.first_key = self.last_key
+        for i in range(len(self.kinds)):
+            kind = self.kinds[i]
+            if kind == 'o':
+                s = rs.getString(i+1)
+                if s:
+                    s = s.strip()
+                self.columns[i].append(s)
+                continue
+            if kind == 'l':
+                v = rs.getLong(i+1)
+            elif kind == 'd':
+                v = rs.getDouble(i+1)
+            elif kind == 'n':
+                v = rs.getBigDecimal(i+1)
+                if v is not None:
+                    v = v.setScale(self.scales[i]).unscaledValue().longValue()
+            elif kind == 'D':
+                v = rs.getDate(i+1)
+                if v is not None:
+                    v = v.getTime()
+            else:       # a Time has no nanoseconds, read TIME as Timestamp
+                v = rs.getTimestamp(i+1)
+                if v is not None:
+                    self.nanos[i][r] = v.getNanos()
+                    v = v.getTime()
+            if rs.wasNull():
+                self.nulls[i].set(r)
+            else:
+                self.columns[i][r] = v
+        self.row_count += 1
+
+    def value(self, row, col):
+        "The cell as long, float, BigDecimal, java.sql date/time or string."
+        kind = self.kinds[col]
+        if kind == 'o':
+            return self.columns[col][row]
+        if self.nulls[col].get(row):
+            return None
+        v = self.columns[col][row]
+        if kind == 'n':
+            return BigDecimal.valueOf(v, self.scales[col])
+        elif kind == 'D':
+            return Date(v)
+        elif kind == 'T':
+            return Time(v)
+        elif kind == 'S':
+            return self._timestamp(row, col)
+        return v
+
+    def _timestamp(self, row, col):
+        t = Timestamp(self.columns[col][row])
+        t.setNanos(self.nanos[col][row])
+        return t
+
+    def format_value(self, row, col):
+        v = self.value(row, col)
+        if v is None or self.kinds[col] == 'o':
+            return v
+        elif self.kinds[col] == 'n':
+            return v.toPlainString()
+        elif self.kinds[col] == 'T':   # the time part, with its fraction
+            return unicode(self._timestamp(row, col)).split(' ')[1]
+        elif self.kinds[col] == 'd':
+            return Double.toString(v)   # unicode() keeps 12 digits
+        return unicode(v)
+
+    def row(self, row):
+        return [self.format_value(row, col) for col in range(len(self.kinds))]
+
+    def approx_bytes(self):
+        "Rough size of the data, 8 bytes a number and 1 a character."
+        n = 0
+        for i in range(len(self.kinds)):
+            if self.kinds[i] != 'o':
+                n += 8 * self.row_count
+                continue
+            for s in self.columns[i]:
+                if s:
+                    n += len(s)
+        return n
+
+    def reverse(self):
+        "Reverse the order of the rows in place."
+        n = self.row_count
+        for i in range(len(self.kinds)):
+            column = self.columns[i]
+            if self.kinds[i] == 'o':
+                column.reverse()
+            else:
+                for r in range(n // 2):
+                    column[r], column[n-1-r] = column[n-1-r], column[r]
+            nanos = self.nanos[i]
+            if nanos is not None:
+                for r in range(n // 2):
+                    nanos[r], nanos[n-1-r] = nanos[n-1-r], nanos[r]
+            old = self.nulls[i]
+            nulls = BitSet()
+            r = old.nextSetBit(0)
+            while r >= 0:
+                nulls.set(n-1-r)
+                r = old.nextSetBit(r+1)
+            self.nulls[i] = nulls
+        self.first_key, self.last_key = self.last_key, self.first_key
+
+
+_json_escapes = {'"': '\\"', '\\': '\\\\', '\n': '\\n', '\r': '\\r',
+                                        '\t': '\\t', '\b': '\\b', '\f': '\\f'}
+_json_special = re.compile(u'[\\\\"\\x00-\\x1f]')
+
+def _json_escape(m):
+    c = m.group(0)
+    return _json_escapes.get(c, u'\\u%04x' % ord(c))
+
+def json_string(s):
+    return u'"' + _json_special.sub(_json_escape, unicode(s)) + u'"'
+
+def json_value(v):
+    "JSON text of None, a number, a list, a dict or anything as string."
+    if v is None:
+        return u'null'
+    elif isinstance(v, bool):
+        return v and u'true' or u'false'
+    elif isinstance(v, (int, long)):
+        return unicode(v)
+    elif isinstance(v, float):
+        if v - v != 0:          # NaN or infinite
+            return u'null'
+        return repr(v)
+    elif isinstance(v, (list, tuple)):
+        return u'[' + u','.join([json_value(x) for x in v]) + u']'
+    elif isinstance(v, dict):
+        return u'{' + u','.join([json_string(k) + u':' + json_value(v[k])
+                                                        for k in v]) + u'}'
+    return json_string(v)
+
+def csv_field(s):
+    if s is None:
+        return u''
+    if (u',' in s or u'"' in s or u'\n' in s or u'\r' in s):
+        return u'"' + s.replace(u'"', u'""') + u'"'
+    return s
+
+
+class Exporter(object):
+    """Streams the result of a query into a CSV or JSON Lines file.
+
+    Rows go from the cursor through a buffered (optionally gzip'ed)
+    writer in batches of fetch_size, so memory use does not depend on
+    the size of the result. rows and bytes can be read from another
+    thread while run() works, and cancel() stops it.
+    """
+    def __init__(self, db, sqlStmt, path, format=CSV, compress=False,
+                                                fetch_size=EXPORT_FETCH_SIZE):
+        self.db = db.for_lane(db.lane)  # own current_stmt for cancel()
+        self.sqlStmt = sqlStmt
+        self.path = path
+        self.format = format
+        self.compress = compress
+        self.fetch_size = fetch_size
+        self.rows = 0
+        self.bytes = 0          # characters written, before compression
+        self.started = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True           # before the fetch fails, see write()
+        self.db.cancel()
+
+    def _csv_line(self, batch, r):
+        return u','.join([csv_field(batch.format_value(r, c))
+                                    for c in range(len(batch.head))]) + u'\n'
+
+    def _json_line(self, keys, batch, r):
+        items = []
+        for c in range(len(keys)):
+            v = batch.value(r, c)
+            kind = batch.kinds[c]
+            if v is None:
+                s = u'null'
+            elif kind == 'l' or kind == 'd':
+                s = json_value(v)
+            elif kind == 'n':
+                s = v.toPlainString()
+            else:
+                s = json_string(batch.format_value(r, c))
+            items.append(keys[c] + s)
+        return u'{' + u','.join(items) + u'}\n'
+
+    def run(self):
+        "Write the file; returns the number of rows written."
+        out = FileOutputStream(self.path)
+        if self.compress:
+            out = GZIPOutputStream(out, EXPORT_BUFFER_SIZE)
+        writer = BufferedWriter(OutputStreamWriter(out, 'UTF-8'),
+                                                        EXPORT_BUFFER_SIZE)
+        done = False
+        try:
+            done = self.write(writer)
+        finally:
+            writer.close()
+            if not done:                # Do not leave a partial file
+                os.remove(self.path)
+        return self.rows
+
+    def write(self, writer):
+        """Write the rows to a java.io.Writer, which is left open.
+
+        Returns False when cancelled.
+        """
+        self.started = time.time()
+        it = self.db.iter_execute(self.sqlStmt, fetch_size=self.fetch_size,
+                                    batch_size=self.fetch_size, columnar=True)
+        try:
+            head = it.next()
+            if self.format == CSV:
+                line = u','.join([csv_field(h) for h in head]) + u'\n'
+                writer.write(line)
+                self.bytes += len(line)
+            else:
+                keys = [json_string(h) + u':' for h in head]
+            for batch in it:
+                if self.cancelled:
+                    break
+                for r in range(len(batch)):
+                    if self.format == CSV:
+                        line = self._csv_line(batch, r)
+                    else:
+                        line = self._json_line(keys, batch, r)
+                    writer.write(line)
+                    self.bytes += len(line)
+                self.rows += len(batch)
+        except SQLException:
+            if not self.cancelled:
+                raise
+            # cancel() closed the statement under the fetch
+        finally:
+            it.close()
+        return not self.cancelled
+
+    def export_table(cls, db, table_name, path, **kw):
+        return cls(db, 'select * from ' + quote_identifier(table_name),
+                                                                path, **kw)
+    export_table = classmethod(export_table)
+
+
+def csv_records(reader):
+    """Generator over the records of CSV text, as lists of field strings.
+
+    reader is a java.io.BufferedReader. Quoted fields may hold commas,
+    doubled quotes and line breaks.
+    """
+    line = reader.readLine()
+    while line is not None:
+        if u'"' not in line:
+            yield line.split(u',')
+            line = reader.readLine()
+            continue
+        fields, field, quoted, i = [], [], False, 0
+        while True:
+            if i == len(line):
+                if not quoted:
+                    break
+                line = reader.readLine()
+                if line is None:
+                    raise ValueError('Unterminated quoted field')
+                field.append(u'\n')
+                i = 0
+                continue
+            c = line[i]
+            if quoted:
+                if c != u'"':
+                    field.append(c)
+                elif line[i+1:i+2] == u'"':
+                    field.append(c)
+                    i += 1
+                else:
+                    quoted = False
+            elif c == u'"':
+                quoted = True
+            elif c == u',':
+                fields.append(u''.join(field))
+                field = []
+            else:
+                field.append(c)
+            i += 1
+        fields.append(u''.join(field))
+        yield fields
+        line = reader.readLine()
+
+_sql_types = {'SHORT': Types.SMALLINT, 'LONG': Types.INTEGER,
+    'INT64': Types.BIGINT, 'FLOAT': Types.FLOAT, 'DOUBLE': Types.DOUBLE,
+    'D_FLOAT': Types.DOUBLE, 'DATE': Types.DATE, 'TIME': Types.TIME,
+    'TIMESTAMP': Types.TIMESTAMP, 'TEXT': Types.CHAR,
+    'VARYING': Types.VARCHAR, 'CSTRING': Types.VARCHAR, 'BLOB': Types.BLOB}
+
+def value_converter(d):
+    """Function from a CSV field to the value bound for a column.
+
+    d is a row of FbDatabase.columns() as a dict; an empty field is NULL.
+    """
+    type_name = d['TYPE_NAME']
+    scale = -int(d['FIELD_SCALE'] or 0)
+    if type_name in ('SHORT', 'LONG', 'INT64') and scale:
+        convert = lambda s: BigDecimal(s.strip()).setScale(scale)
+    elif type_name in ('SHORT', 'LONG'):
+        convert = lambda s: int(s)
+    elif type_name == 'INT64':
+        convert = lambda s: long(s)
+    elif type_name in ('FLOAT', 'DOUBLE', 'D_FLOAT'):
+        convert = lambda s: float(s)
+    elif type_name == 'DATE':
+        convert = lambda s: Date.valueOf(s.strip())
+    elif type_name == 'TIME':
+        convert = lambda s: Time.valueOf(s.strip())
+    elif type_name == 'TIMESTAMP':
+        convert = lambda s: Timestamp.valueOf(s.strip())
+    else:
+        convert = lambda s: s
+    def f(s):
+        if s == u'':
+            return None
+        return convert(s)
+    return f
+
+
+class Importer(object):
+    """Loads a CSV file into a table with batched prepared INSERTs.
+
+    File fields are matched to table columns by the header record (or by
+    position without one) and converted by a value_converter() chosen
+    once per column. A parser thread reads and converts records while
+    run() binds them and executes the INSERT every batch_size rows,
+    committing every commit_interval rows. Records that fail conversion
+    or insertion are written with the reason to reject_path.
+    rows and rejected can be read from another thread while run() works,
+    and cancel() stops it after rolling back the uncommitted rows.
+    """
+    def __init__(self, db, table_name, path, reject_path=None, header=True,
+                    batch_size=IMPORT_BATCH_SIZE,
+                    commit_interval=IMPORT_COMMIT_INTERVAL):
+        self.db = db.for_lane(QUERY_LANE)
+        self.table_name = table_name
+        self.path = path
+        self.reject_path = reject_path or path + '.rejected'
+        self.header = header
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.rows = 0
+        self.rejected = 0
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+        self.stopping = False   # tells the parser thread to give up
+        self.reject_writer = None
+        self.reject_lock = threading.Lock()
+
+    def cancel(self):
+        self.cancelled = self.stopping = True
+
+    def reject(self, record_no, fields, reason):
+        self.reject_lock.acquire()
+        try:
+            if not self.reject_writer:
+                self.reject_writer = BufferedWriter(OutputStreamWriter(
+                        FileOutputStream(self.reject_path), 'UTF-8'))
+            self.reject_writer.write(u'%d,%s,%s\n' % (record_no,
+                    csv_field(unicode(reason)),
+                    u','.join([csv_field(f) for f in fields])))
+            self.rejected += 1
+        finally:
+            self.reject_lock.release()
+
+    def _reader(self):
+        stream = FileInputStream(self.path)
+        if self.path.endswith('.gz'):
+            stream = GZIPInputStream(stream, EXPORT_BUFFER_SIZE)
+        return BufferedReader(InputStreamReader(stream, 'UTF-8'),
+                                                        EXPORT_BUFFER_SIZE)
+
+    def _columns(self, file_head, field_count):
+        "Table column dicts and the file field position of each."
+        h, d = self.db.columns(self.table_name)
+        cols = [dict(zip(h, r)) for r in d]
+        if file_head is None:
+            cols = cols[:field_count]
+            return cols, range(len(cols))
+        by_name = {}
+        for c in cols:
+            by_name[c['NAME'].strip().upper()] = c
+        matched, positions = [], []
+        for i in range(len(file_head)):
+            c = by_name.get(file_head[i].strip().upper())
+            if c:
+                matched.append(c)
+                positions.append(i)
+        if not matched:
+            raise ValueError('No field of %s matches a column of %s' % (
+                                            self.path, self.table_name))
+        return matched, positions
+
+    def _parse(self, records, record_no, positions, converters, queue):
+        "Parser thread: puts lists of (record_no, fields, values) on queue."
+        batch = []
+        try:
+            for fields in records:
+                record_no += 1
+                if self.stopping:
+                    break
+                try:
+                    values = [converters[i](fields[positions[i]])
+                                    for i in range(len(positions))]
+                except (PythonException, Exception), e:
+                    self.reject(record_no, fields, e)
+                    continue
+                batch.append((record_no, fields, values))
+                if len(batch) == self.batch_size:
+                    queue.put(batch)
+                    batch = []
+            if batch:
+                queue.put(batch)
+            queue.put(None)
+        except (PythonException, Exception), e:
+            queue.put(e)                # ends run() like None
+
+    def _bind(self, stmt, sql_types, values):
+        for i in range(len(values)):
+            v = values[i]
+            if v is None:
+                stmt.setNull(i+1, sql_types[i])
+            elif isinstance(v, int):
+                stmt.setInt(i+1, v)
+            elif isinstance(v, long):   # setObject() would pass a BigInteger
+                stmt.setLong(i+1, v)
+            else:
+                stmt.setObject(i+1, v)
+
+    def _insert(self, stmt, sql_types, batch):
+        "Insert a batch; returns the number of rows inserted."
+        for record_no, fields, values in batch:
+            for f in fields:
+                self.rec.bytes += len(f)
+        t = time.time()
+        try:
+            return self._insert_batch(stmt, sql_types, batch)
+        finally:
+            self.rec.execute += time.time() - t
+
+    def _insert_batch(self, stmt, sql_types, batch):
+        conn = stmt.getConnection()
+        # Rows before a failing one are inserted; the savepoint undoes them
+        savepoint = conn.setSavepoint()
+        try:
+            for record_no, fields, values in batch:
+                self._bind(stmt, sql_types, values)
+                stmt.addBatch()
+            stmt.executeBatch()
+            conn.releaseSavepoint(savepoint)
+            return len(batch)
+        except SQLException:
+            stmt.clearBatch()
+            conn.rollback(savepoint)
+        # Redo the batch row by row to tell the bad rows from the good.
+        n = 0
+        for record_no, fields, values in batch:
+            try:
+                self._bind(stmt, sql_types, values)
+                stmt.executeUpdate()
+                n += 1
+            except SQLException, e:
+                self.reject(record_no, fields, e.getMessage())
+        return n
+
+    def run(self):
+        "Load the file; returns the number of rows inserted."
+        self.started = time.time()
+        reader = self._reader()
+        records = csv_records(reader)
+        try:
+            file_head = None
+            record_no = 0
+            try:
+                if self.header:
+                    file_head = records.next()
+                    record_no = 1
+                    cols, positions = self._columns(file_head, None)
+                else:
+                    first = records.next()
+                    cols, positions = self._columns(None, len(first))
+                    records = itertools.chain([first], records)
+            except StopIteration:
+                raise ValueError('%s is an empty file' % self.path)
+        except:
+            reader.close()
+            raise
+        converters = [value_converter(c) for c in cols]
+        sql_types = [_sql_types.get(c['TYPE_NAME'], Types.VARCHAR)
+                                                            for c in cols]
+        sqlStmt = 'insert into %s (%s) values (%s)' % (
+                    quote_identifier(self.table_name),
+                    ','.join([quote_identifier(c['NAME'].strip())
+                                                            for c in cols]),
+                    ','.join(['?'] * len(cols)))
+
+        self.rec = StatementRecord(_caller_tag(0), sqlStmt)
+        queue = Queue.Queue(IMPORT_QUEUE_BATCHES)
+        parser = threading.Thread(target=self._parse,
+                        args=(records, record_no, positions, converters, queue))
+        parser.setDaemon(True)
+        pooled = self.db.borrow()
+        conn = pooled.conn
+        stmt = None
+        try:
+            conn.setAutoCommit(False)
+            t = time.time()
+            stmt = conn.prepareStatement(sqlStmt)
+            self.rec.prepare = time.time() - t
+            parser.start()
+            uncommitted = 0
+            while not self.cancelled:
+                try:
+                    batch = queue.get(True, 1)
+                except Queue.Empty:
+                    if parser.isAlive() or not queue.empty():
+                        continue
+                    raise RuntimeError('CSV parser thread stopped')
+                if batch is None:
+                    break
+                if not isinstance(batch, list):
+                    raise batch
+                n = self._insert(stmt, sql_types, batch)
+                self.rows += n
+                uncommitted += n
+                if uncommitted >= self.commit_interval:
+                    conn.commit()
+                    uncommitted = 0
+            if not self.cancelled:
+                conn.commit()
+                uncommitted = 0
+            self.rows -= uncommitted
+        finally:
+            self.stopping = True
+            while parser.isAlive():     # unblock a parser waiting on put()
+                try:
+                    queue.get(True, 0.1)
+                except Queue.Empty:
+                    pass
+            reader.close()
+            try:
+                conn.rollback()         # nothing is left after a commit
+                conn.setAutoCommit(True)
+            finally:
+                if stmt:
+                    stmt.close()
+                self.db.give_back(pooled)
+                if self.reject_writer:
+                    self.reject_writer.close()
+                self.finished = time.time()
+                self.rec.rows = self.rows
+                profiler.record(self.rec)
+        return self.rows
+
+    def report(self):
+        elapsed = max((self.finished or time.time()) - self.started, 0.001)
+        return '%d rows inserted, %d rejected in %.1f s (%d rows/s)' % (
+                    self.rows, self.rejected, elapsed, self.rows / elapsed)
+
+
+class KeysetPager(object):
+    """Pages through the rows of a table or view in primary key order.
+
+    A page after (or before) the one shown is read with
+    'where key > last key shown order by key rows n', so the index finds
+    page 10000 as quickly as page 1. A compound key (k1, k2) becomes
+    'k1 >= ? and (k1 > ? or (k1 = ? and k2 > ?))'. Relations without a
+    primary key fall back to FIRST/SKIP, which reads every skipped row.
+    page is the ColumnarResult shown (None while the relation is empty)
+    and page_no its zero based number, None after last() when unknown.
+    """
+    def __init__(self, db, table_name, page_size=DATA_PAGE_SIZE):
+        self.db = db
+        self.table_name = table_name
+        self.page_size = page_size
+        self.keys = db.primary_keys(table_name)
+        self.head = []
+        self.page = None
+        self.page_no = 0
+        self.at_start = self.at_end = True
+
+    def _read(self, sqlStmt, params=()):
+        it = self.db.iter_execute(sqlStmt, params, fetch_size=self.page_size,
+                                    columnar=True, key_columns=self.keys)
+        try:
+            self.head = it.next()
+            for page in it:
+                return page
+            return None
+        finally:
+            it.close()
+
+    def _keyset_select(self, values=None, op='>'):
+        """Select of the page after (op '>') or before (op '<') a key.
+
+        values are the raw key values kept by the page (first_key or
+        last_key): the displayed ones are stripped and cut to milliseconds.
+        """
+        desc = op == '<' and ' desc' or ''
+        names = [quote_identifier(k) for k in self.keys]
+        where, params = '', []
+        if values is not None:
+            terms = []
+            for i in range(len(names)):
+                t = ['%s = ?' % n for n in names[:i]]
+                t.append('%s %s ?' % (names[i], op))
+                terms.append('(' + ' and '.join(t) + ')')
+                params += values[:i+1]
+            where = ' or '.join(terms)
+            if len(names) > 1:  # Lets the optimizer start the index scan
+                where = '%s %s= ? and (%s)' % (names[0], op, where)
+                params.insert(0, values[0])
+            where = ' where ' + where
+        return ('select * from %s%s order by %s rows %d' % (
+                    quote_identifier(self.table_name), where,
+                    ', '.join([n + desc for n in names]), self.page_size),
+                params)
+
+    def _skip_select(self, page_no):
+        return 'select first %d skip %d * from %s' % (self.page_size,
+                page_no * self.page_size, quote_identifier(self.table_name))
+
+    def first(self):
+        if self.keys:
+            page = self._read(*self._keyset_select())
+        else:
+            page = self._read(self._skip_select(0))
+        self.page, self.page_no = page, 0
+        self.at_start = True
+        self.at_end = page is None or len(page) < self.page_size
+        return page
+
+    def next(self):
+        if self.at_end:
+            return self.page
+        if self.keys:
+            page = self._read(*self._keyset_select(self.page.last_key, '>'))
+        else:
+            page = self._read(self._skip_select(self.page_no + 1))
+        if page is None:        # The page shown was the last, and full
+            self.at_end = True
+            return self.page
+        self.page = page
+        if self.page_no is not None:
+            self.page_no += 1
+        self.at_start = False
+        self.at_end = len(page) < self.page_size
+        return page
+
+    def prev(self):
+        if self.at_start:
+            return self.page
+        if not self.keys:
+            page = self._read(self._skip_select(self.page_no - 1))
+        else:
+            page = self._read(*self._keyset_select(self.page.first_key, '<'))
+            if page is None or len(page) < self.page_size:
+                return self.first()
+            page.reverse()
+        self.page = page
+        if self.page_no is not None:
+            self.page_no -= 1
+        self.at_start = self.page_no == 0
+        self.at_end = False
+        return page
+
+    def last(self):
+        """Without a primary key the rows are counted first, then skipped,
+        which reads the relation twice."""
+        if not self.keys:
+            count = self.db.execute('select count(*) from %s'
+                            % quote_identifier(self.table_name))[1][0][0]
+            page_no = max(0, (int(count) - 1) // self.page_size)
+            page = self._read(self._skip_select(page_no))
+            self.page, self.page_no = page, page_no
+            self.at_start, self.at_end = page_no == 0, True
+            return page
+        page = self._read(*self._keyset_select(None, '<'))
+        if page is None or len(page) < self.page_size:
+            return self.first()
+        page.reverse()
+        self.page, self.page_no = page, None
+        self.at_start, self.at_end = False, True
+        return page
+
+
+class ActivitySampler(object):
+    """Samples the MON$ tables of a database in a daemon thread.
+
+    Runs on a dedicated connection of its own, outside the pool, and
+    commits after each sample, so every sample sees a fresh MON$
+    snapshot. A sample is (head, rows) of the statements of the other
+    attachments, with the I/O and record counters given as deltas since
+    the previous sample (totals for statements seen for the first time).
+    """
+    COUNTERS = ('PAGE_READS', 'PAGE_FETCHES', 'PAGE_WRITES', 'PAGE_MARKS',
+            'SEQ_READS', 'IDX_READS', 'INSERTS', 'UPDATES', 'DELETES')
+    INFO = ('STATEMENT_ID', 'ATTACHMENT_ID', 'TRANSACTION_ID', 'USER_NAME',
+            'REMOTE_ADDRESS', 'REMOTE_PROCESS', 'STATE', 'STARTED',
+            'ISOLATION')
+    states = {0: 'IDLE', 1: 'ACTIVE', 2: 'STALLED'}
+    isolation_modes = {0: 'CONSISTENCY', 1: 'CONCURRENCY',
+            2: 'READ COMMITTED REC_VERSION', 3: 'READ COMMITTED NO_REC_VERSION'}
+    sqlStmt = '''select
+        S.mon$statement_id STATEMENT_ID,
+        S.mon$attachment_id ATTACHMENT_ID,
+        S.mon$transaction_id TRANSACTION_ID,
+        A.mon$user USER_NAME,
+        A.mon$remote_address REMOTE_ADDRESS,
+        A.mon$remote_process REMOTE_PROCESS,
+        S.mon$state STATE,
+        S.mon$timestamp STARTED,
+        T.mon$isolation_mode ISOLATION,
+        I.mon$page_reads PAGE_READS,
+        I.mon$page_fetches PAGE_FETCHES,
+        I.mon$page_writes PAGE_WRITES,
+        I.mon$page_marks PAGE_MARKS,
+        R.mon$record_seq_reads SEQ_READS,
+        R.mon$record_idx_reads IDX_READS,
+        R.mon$record_inserts INSERTS,
+        R.mon$record_updates UPDATES,
+        R.mon$record_deletes DELETES,
+        S.mon$sql_text SQL_TEXT
+        from mon$statements S
+            join mon$attachments A
+                on A.mon$attachment_id = S.mon$attachment_id
+            left join mon$transactions T
+                on T.mon$transaction_id = S.mon$transaction_id
+            left join mon$io_stats I on I.mon$stat_id = S.mon$stat_id
+            left join mon$record_stats R on R.mon$stat_id = S.mon$stat_id
+        where S.mon$attachment_id <> current_connection'''
+    countStmt = '''select
+        (select count(*) from mon$attachments),
+        (select count(*) from mon$transactions)
+        from rdb$database'''
+
+    def __init__(self, db, interval=MONITOR_INTERVAL, active_only=False):
+        self.db = db
+        self.interval = interval
+        self.active_only = active_only
+        self.conn = None
+        self.lock = threading.Lock()    # one user of conn at a time
+        self.stopped = threading.Event()
+        self.previous = {}      # statement id -> counters of the last sample
+        self.sampled_at = None
+        self.attachments = self.transactions = 0
+
+    def start(self, on_sample, on_error):
+        """Sample every interval seconds until stop().
+
+        on_sample(sample) and on_error(e) are called on the sampler thread.
+        """
+        t = threading.Thread(target=self._run, args=(on_sample, on_error))
+        t.setDaemon(True)
+        t.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self, on_sample, on_error):
+        try:
+            try:
+                self.conn = self.db.connect()
+                self.conn.setAutoCommit(False)
+            except (PythonException, Exception), e:
+                on_error(e)
+                return
+            while not self.stopped.isSet():
+                try:
+                    on_sample(self.sample())
+                except (PythonException, Exception), e:
+                    on_error(e)
+                self.stopped.wait(self.interval)
+        finally:
+            if self.conn:
+                self.conn.close()
+
+    def _query(self, sqlStmt):
+        stmt = self.conn.createStatement()
+        try:
+            rs = stmt.executeQuery(sqlStmt)
+            md = rs.getMetaData()
+            n = md.getColumnCount()
+            texts = [md.getColumnType(i) in (Types.LONGVARCHAR, Types.CLOB,
+                            Types.BLOB, Types.LONGVARBINARY)
+                                                    for i in range(1, n+1)]
+            rows = []
+            while rs.next():
+                rows.append([texts[i-1] and rs.getString(i) or rs.getObject(i)
+                                                    for i in range(1, n+1)])
+            return [md.getColumnLabel(i) for i in range(1, n+1)], rows
+        finally:
+            stmt.close()
+
+    def sample(self):
+        self.lock.acquire()
+        try:
+            try:
+                h, d = self._query(self.sqlStmt)
+                (self.attachments, self.transactions), = self._query(
+                                                        self.countStmt)[1]
+            finally:
+                self.conn.commit()      # next sample gets a new snapshot
+        finally:
+            self.lock.release()
+        self.sampled_at = time.time()
+        col = dict([(h[i], i) for i in range(len(h))])
+        head = list(self.INFO) + list(self.COUNTERS) + ['SQL_TEXT']
+        rows = []
+        previous = self.previous
+        self.previous = {}
+        for r in d:
+            if self.active_only and r[col['STATE']] != 1:
+                continue
+            sid = r[col['STATEMENT_ID']]
+            # long() throughout: a zero counter would otherwise be an int
+            # among longs in its column
+            counters = [long(r[col[k]] or 0) for k in self.COUNTERS]
+            self.previous[sid] = counters
+            last = previous.get(sid)
+            if last:
+                deltas = [long(c - l) for c, l in zip(counters, last)]
+                if min(deltas) < 0:     # statement was prepared again
+                    deltas = counters
+            else:
+                deltas = counters
+            info = [r[col[k]] for k in self.INFO]
+            info[self.INFO.index('STATE')] = self.states.get(
+                                        r[col['STATE']], r[col['STATE']])
+            info[self.INFO.index('ISOLATION')] = self.isolation_modes.get(
+                                    r[col['ISOLATION']], r[col['ISOLATION']])
+            sql = r[col['SQL_TEXT']]
+            rows.append(info + deltas + [sql and unicode(sql).strip()])
+        return head, rows
+
+    def cancel_statement(self, statement_id):
+        "Cancel a running statement of another attachment."
+        self.lock.acquire()
+        try:
+            stmt = self.conn.prepareStatement(
+                    'delete from mon$statements where mon$statement_id = ?')
+            try:
+                stmt.setObject(1, statement_id)
+                stmt.executeUpdate()
+                self.conn.commit()
+            finally:
+                stmt.close()
+        finally:
+            self.lock.release()
+
+
+# A retrieval in a plan: stream names, then NATURAL, INDEX (...) or
+# ORDER index [INDEX (...)]
+_plan_retrieval = re.compile(r'([\w$" ]+?)\s+(NATURAL|INDEX\s*\(([^)]*)\)|'
+                    r'ORDER\s+([\w$"]+)(?:\s+INDEX\s*\(([^)]*)\))?)', re.I)
+_relation_ref = re.compile(r'(?:\bfrom|\bjoin|,)\s+("[^"]+"|[\w$]+)'
+                                r'(?:\s+(?:as\s+)?("[^"]+"|[\w$]+))?', re.I)
+_not_alias = ('WHERE', 'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER',
+            'CROSS', 'NATURAL', 'ON', 'GROUP', 'ORDER', 'HAVING', 'UNION',
+            'PLAN', 'ROWS', 'FOR', 'FROM')
+
+def _plan_name(s):
+    s = s.strip()
+    if s.startswith('"'):
+        return s[1:-1]
+    return s.upper()
+
+def relation_aliases(sqlStmt):
+    "Guess {alias: relation} from the FROM and JOIN clauses of a query."
+    aliases = {}
+    for relation, alias in _relation_ref.findall(sqlStmt):
+        relation = _plan_name(relation)
+        if relation in _not_alias:
+            continue
+        aliases[relation] = relation
+        if alias and _plan_name(alias) not in _not_alias:
+            aliases[_plan_name(alias)] = relation
+    return aliases
+
+def plan_retrievals(plan):
+    """[(stream, access, [index names])] of the retrievals in a plan,
+    access being NATURAL, INDEX or ORDER.
+    """
+    a = []
+    for m in _plan_retrieval.finditer(plan):
+        stream = _plan_name(m.group(1).split()[-1])
+        access = m.group(2).split()[0].split('(')[0].upper()
+        indexes = []
+        if m.group(4):
+            indexes.append(m.group(4))
+        for s in (m.group(3), m.group(5)):
+            if s:
+                indexes += s.split(',')
+        a.append((stream, access, [_plan_name(i) for i in indexes]))
+    return a
+
+
 # Database connection wrapper
 class FbDatabase(object):
-    def __init__(self, host, path, user, password, charset='UNICODE_FSS', port=3050):
+    def __init__(self, host, path, user, password, charset='UNICODE_FSS', port=3050,
+                                                            query_timeout=0):
         self.host = host
         self.path = path
         self.user = user
         self.password = password
         self.port = port
         self.charset = charset
-        self.conn = None
+        self.query_timeout = query_timeout  # seconds, 0 is no limit
+        self.lane = META_LANE
+        self.pool = None
+        self.current_stmt = None    # Statement whose cursor is open
+        self.snapshot = None        # SchemaSnapshot answering catalog calls
+        self._forget_catalog()
 
-    def open(self):
-        s = 'jdbc:firebirdsql:%s/%d:%s' % (self.host, self.port, self.path)
-        props = Properties()
-        props.setProperty("user", self.user)
-        props.setProperty("password", self.password)
-        props.setProperty("encoding", self.charset)
-        self.conn = DriverManager.getConnection(s, props)
-        return self.conn
+    def open(self, max_size=POOL_MAX_SIZE):
+        "Attach through the pool of this database; statements borrow from it."
+        # Authenticate with a connection of our own: the pool may hand out
+        # idle connections made with an earlier password.
+        self.connect().close()
+        self.pool = connection_pool(self.host, self.port, self.path,
+                        self.user, self.password, self.charset, max_size)
+        return self.pool
 
     def close(self):
-        self.conn.close()
-        self.conn = None
+        "Detach from the pool; its idle connections stay for a while."
+        self.pool = None
+        self.snapshot = None
+        self._forget_catalog()
 
-    def execute(self, sqlStmt):
-        cname = []
-        result = []
-        stmt = self.conn.createStatement()
-        rs = stmt.executeQuery(sqlStmt)
-        md = rs.getMetaData()
-        num_column = md.getColumnCount()
-        for i in range(1, num_column+1):
-            cname.append(md.getColumnLabel(i))
-
-        while rs.next():
-            r = []
-            for i in range(1, num_column+1):
-                s = rs.getString(i)
-                if s:
-                    s = s.strip()
-                r.append(s)
-            result.append(r)
+    def connect(self):
+        "A connection of its own, outside the pool."
+        return connect(self.host, self.port, self.path,
+                                    self.user, self.password, self.charset)
+
+    def for_lane(self, lane):
+        "An opened FbDatabase using the same pool, but another lane."
+        db = FbDatabase(self.host, self.path, self.user, self.password,
+                        self.charset, self.port, self.query_timeout)
+        db.pool = self.pool
+        db.lane = lane
+        return db
+
+    def borrow(self):
+        return self.pool.borrow(self.lane)
+
+    def give_back(self, pooled):
+        self.pool.give_back(pooled)
+
+    def cancel(self):
+        "Cancel the statement currently executing (from another thread)."
+        stmt = self.current_stmt
+        if stmt:
+            stmt.cancel()
+
+    def iter_execute(self, sqlStmt, params=(), fetch_size=FETCH_SIZE,
+                    batch_size=0, cached=False, columnar=False, tag=None,
+                    key_columns=()):
+        """Generator over a query result while the cursor stays open.
 
-        rs.close()
-        stmt.close()
+        The first item yielded is the list of column labels, then each row
+        (or, when batch_size > 0, lists of up to batch_size rows; with
+        columnar, ColumnarResults of up to batch_size rows, or of all
+        rows if batch_size is 0, keeping the raw values of key_columns
+        for their first and last row).
+        The Statement and ResultSet are closed when the generator is
+        exhausted or closed, so callers that stop early should call close().
+        While it runs the statement is current_stmt, see cancel().
+        With cached, the statement is prepared once and kept in the
+        StatementCache of the connection borrowed for it.
+        Timings go to the profiler as a StatementRecord tagged with tag,
+        by default the method that first reads from the generator.
+        """
+        rec = StatementRecord(tag or _caller_tag(1), sqlStmt)
+        pooled = self.borrow()
+        stmt = rs = None
+        done = False
+        try:
+            t = time.time()
+            if cached:
+                stmt = pooled.stmt_cache.take(sqlStmt)
+            elif params:
+                stmt = pooled.conn.prepareStatement(sqlStmt)
+            else:
+                stmt = pooled.conn.createStatement()
+            self.current_stmt = stmt
+            for i in range(len(params)):
+                stmt.setObject(i+1, params[i])
+            if self.query_timeout:
+                stmt.setQueryTimeout(self.query_timeout)
+            stmt.setFetchSize(fetch_size)
+            rec.prepare = time.time() - t
+            t = time.time()
+            if cached or params:
+                rs = stmt.executeQuery()
+            else:       # prepared and executed in one go
+                rs = stmt.executeQuery(sqlStmt)
+            md = rs.getMetaData()
+            num_column = md.getColumnCount()
+            rec.execute = time.time() - t
+            yield [md.getColumnLabel(i) for i in range(1, num_column+1)]
+
+            t = time.time()
+            if columnar:
+                batch = ColumnarResult(md, key_columns)
+                while rs.next():
+                    batch.append(rs)
+                    if rec.first_row is None:
+                        rec.first_row = rec.execute + time.time() - t
+                    if len(batch) == batch_size:
+                        rec.fetch += time.time() - t
+                        rec.rows += len(batch)
+                        rec.bytes += batch.approx_bytes()
+                        yield batch
+                        t = time.time()
+                        batch = ColumnarResult(md, key_columns)
+                if batch:
+                    rec.rows += len(batch)
+                    rec.bytes += batch.approx_bytes()
+            else:
+                batch = []
+            while not columnar and rs.next():
+                r = []
+                for i in range(1, num_column+1):
+                    s = rs.getString(i)
+                    if s:
+                        s = s.strip()
+                        rec.bytes += len(s)
+                    r.append(s)
+                rec.rows += 1
+                if rec.first_row is None:
+                    rec.first_row = rec.execute + time.time() - t
+                if not batch_size:
+                    rec.fetch += time.time() - t
+                    yield r
+                    t = time.time()
+                    continue
+                batch.append(r)
+                if len(batch) == batch_size:
+                    rec.fetch += time.time() - t
+                    yield batch
+                    t = time.time()
+                    batch = []
+            rec.fetch += time.time() - t
+            if batch:
+                yield batch
+            done = True
+        except SQLException, e:
+            rec.error = e.getMessage()
+            raise
+        finally:
+            if self.current_stmt is stmt:
+                self.current_stmt = None
+            if rs:
+                rs.close()
+            if cached and done:
+                pooled.stmt_cache.give(sqlStmt, stmt)
+            elif stmt:
+                stmt.close()
+            self.give_back(pooled)
+            profiler.record(rec)
+
+    def execute(self, sqlStmt, params=(), tag=None):
+        "(head, rows) of a catalog query, profiled under the caller's name."
+        it = self.iter_execute(sqlStmt, params, cached=True,
+                                            tag=tag or _caller_tag(1))
+        try:
+            cname = it.next()
+            result = list(it)
+        finally:
+            it.close()
         return (cname, result)
 
+    def plan(self, sqlStmt):
+        "Execution plan of a statement, prepared but not executed."
+        rec = StatementRecord(_caller_tag(1), sqlStmt)
+        pooled = self.borrow()
+        try:
+            t = time.time()
+            stmt = pooled.conn.prepareStatement(sqlStmt)
+            rec.prepare = time.time() - t
+            try:
+                return stmt.getExecutionPlan()
+            finally:
+                stmt.close()
+        finally:
+            self.give_back(pooled)
+            profiler.record(rec)
+
+    def estimated_cardinality(self, indexes):
+        """Rows of a relation guessed from its index statistics.
+
+        (rows, exact) where exact tells that a unique index gave it (the
+        count as of the last statistics update); otherwise rows is only
+        the most distinct keys of any index, a lower bound, or None.
+        """
+        rows, exact = None, False
+        for d in indexes:
+            selectivity = float(d['STATISTICS'] or 0)
+            if selectivity <= 0:
+                continue
+            n = int(round(1 / selectivity))
+            if d['UNIQUE_FLAG'] == '1':
+                return n, True
+            rows = max(rows or 0, n)
+        return rows, exact
+
+    def index_statistics(self):
+        """Every index of the user relations with its stored selectivity,
+        from one query. Dicts with FIELD_NAME the list of key fields.
+        """
+        sqlStmt = '''select
+            A.rdb$relation_name RELATION_NAME,
+            A.rdb$index_name INDEX_NAME,
+            A.rdb$unique_flag UNIQUE_FLAG,
+            A.rdb$index_inactive INACT,
+            A.rdb$index_type INDEX_TYPE,
+            A.rdb$statistics STATISTICS,
+            A.rdb$expression_source EXPRESSION,
+            C.rdb$constraint_type CONST_TYPE,
+            B.rdb$field_name FIELD_NAME
+            from rdb$indices A
+                join rdb$relations R
+                    on R.rdb$relation_name = A.rdb$relation_name
+                left join rdb$index_segments B
+                    on B.rdb$index_name = A.rdb$index_name
+                left join rdb$relation_constraints C
+                    on C.rdb$index_name = A.rdb$index_name
+            where coalesce(R.rdb$system_flag, 0) = 0
+            order by A.rdb$relation_name, A.rdb$index_name,
+                B.rdb$field_position'''
+        h, d = self.execute(sqlStmt)
+        indexes = []
+        for r in d:
+            row = dict(zip(h, r))
+            if not indexes or indexes[-1]['INDEX_NAME'] != row['INDEX_NAME']:
+                row['STATISTICS'] = float(row['STATISTICS'] or 0)
+                row['INDEX_TYPE'] = row['INDEX_TYPE'] or '0'  # 1: descending
+                row['FIELD_NAME'] = row['FIELD_NAME'] and [row['FIELD_NAME']]
+                indexes.append(row)
+            else:
+                indexes[-1]['FIELD_NAME'].append(row['FIELD_NAME'])
+        return indexes
+
+    def sample_index_keys(self, index, sample_rows=INDEX_SAMPLE_ROWS):
+        """(distinct keys, rows) in the first sample_rows rows of the
+        relation of an index_statistics() dict, in storage order.
+        """
+        fields = ', '.join([quote_identifier(f) for f in index['FIELD_NAME']])
+        sqlStmt = 'select first %d %s from %s' % (sample_rows, fields,
+                                    quote_identifier(index['RELATION_NAME']))
+        keys = {}
+        rows = 0
+        it = self.iter_execute(sqlStmt, fetch_size=EXPORT_FETCH_SIZE)
+        try:
+            it.next()
+            for r in it:
+                keys[tuple(r)] = True
+                rows += 1
+        finally:
+            it.close()
+        return len(keys), rows
+
+    def index_health(self, sample_rows=INDEX_SAMPLE_ROWS,
+                                    workers=POOL_MAX_SIZE, progress=None):
+        """index_statistics() with PROBLEMS, a list of findings, and the
+        key counts STORED_KEYS (1 / selectivity) and SAMPLED_KEYS.
+
+        SAMPLED_KEYS is exact when the relation held fewer rows than
+        sample_rows, else the distinct ratio of the sample scaled to the
+        rows estimated from the unique indexes (or None without one).
+        Stats are stale when the two differ by more than a factor of
+        INDEX_STATS_TOLERANCE, or the sample alone holds more keys than
+        the stored count. Samples run on workers pooled connections of
+        the QUERY lane; progress(done, total) as in run_parallel().
+        """
+        indexes = self.index_statistics()
+        by_relation = {}
+        for i in indexes:
+            by_relation.setdefault(i['RELATION_NAME'], []).append(i)
+        db = self.for_lane(QUERY_LANE)
+        sampled = [i for i in indexes if i['FIELD_NAME']]
+        samples = {}
+        for i, result, error in run_parallel(
+                    lambda i: db.sample_index_keys(i, sample_rows),
+                    sampled, workers, progress):
+            samples[i['INDEX_NAME']] = (result, error)
+
+        for i in indexes:
+            problems = i['PROBLEMS'] = []
+            i['STORED_KEYS'] = i['STATISTICS'] and int(
+                                            round(1 / i['STATISTICS'])) or None
+            i['SAMPLED_KEYS'] = None
+            if i['INACT'] == '1':
+                problems.append('inactive')
+            result, error = samples.get(i['INDEX_NAME'], (None, None))
+            if error:
+                problems.append('sample failed: %s' % error)
+            elif result and result[1]:
+                distinct, rows = result
+                if rows < sample_rows:
+                    i['SAMPLED_KEYS'] = distinct
+                else:
+                    total, exact = self.estimated_cardinality(
+                                    by_relation[i['RELATION_NAME']])
+                    if exact:
+                        i['SAMPLED_KEYS'] = int(distinct * total / rows)
+                stored = i['STORED_KEYS']
+                estimated = i['SAMPLED_KEYS'] or distinct
+                if not stored:
+                    problems.append('no statistics')
+                elif stored * INDEX_STATS_TOLERANCE < distinct or (
+                        i['SAMPLED_KEYS'] and stored >
+                            i['SAMPLED_KEYS'] * INDEX_STATS_TOLERANCE):
+                    problems.append('stale statistics (%d keys stored, '
+                                        '~%d sampled)' % (stored, estimated))
+
+        for relation_indexes in by_relation.values():
+            for a in relation_indexes:
+                for b in relation_indexes:
+                    if (a is b or not a['FIELD_NAME'] or not b['FIELD_NAME']
+                            or a['INDEX_TYPE'] != b['INDEX_TYPE']
+                            or b['INACT'] == '1'):
+                        continue
+                    n = len(a['FIELD_NAME'])
+                    if a['FIELD_NAME'] == b['FIELD_NAME']:
+                        # Report the one without constraint, or the later
+                        if a['CONST_TYPE'] and not b['CONST_TYPE']:
+                            continue
+                        if (bool(a['CONST_TYPE']) == bool(b['CONST_TYPE'])
+                                    and a['INDEX_NAME'] < b['INDEX_NAME']):
+                            continue
+                        a['PROBLEMS'].append('duplicate of ' + b['INDEX_NAME'])
+                    elif (a['FIELD_NAME'] == b['FIELD_NAME'][:n]
+                            and a['UNIQUE_FLAG'] != '1'
+                            and not a['CONST_TYPE']):
+                        a['PROBLEMS'].append('prefix of ' + b['INDEX_NAME'])
+        return indexes
+
+    def set_index_statistics(self, index_name):
+        "Recompute the selectivity of an index (on a writable lane)."
+        pooled = self.borrow()
+        try:
+            stmt = pooled.conn.createStatement()
+            try:
+                stmt.execute('set statistics index ' +
+                                                quote_identifier(index_name))
+            finally:
+                stmt.close()
+        finally:
+            self.give_back(pooled)
+        self.index_memo.clear()
+
+    def recompute_statistics(self, index_names, workers=POOL_MAX_SIZE,
+                                                            progress=None):
+        """SET STATISTICS on index_names over workers pooled connections
+        of the QUERY lane. Returns [(index name, None, error)].
+        """
+        db = self.for_lane(QUERY_LANE)
+        results = run_parallel(db.set_index_statistics, index_names,
+                                                        workers, progress)
+        self.index_memo.clear()
+        if self.snapshot:               # Explain reads selectivity from it
+            self.snapshot.reload_statistics()
+        return results
+
+    def explain(self, sqlStmt):
+        """Plan of a statement and its retrievals annotated with index
+        selectivity and estimated rows. Returns (plan, head, rows).
+
+        WARNING is set on NATURAL scans of relations estimated to hold
+        PLAN_BIG_TABLE_ROWS rows or more.
+        """
+        plan = self.plan(sqlStmt)
+        aliases = relation_aliases(sqlStmt)
+        h = ['STREAM', 'RELATION', 'ACCESS', 'INDEX_NAME', 'SELECTIVITY',
+                                                'EST_ROWS', 'WARNING']
+        d = []
+        for stream, access, index_names in plan_retrievals(plan or ''):
+            relation = aliases.get(stream, stream)
+            indexes = self.key_constraints_and_index(relation)
+            rows, exact = self.estimated_cardinality(indexes)
+            if rows is None:
+                est = '?'
+            elif exact:
+                est = '%d' % rows
+            else:
+                est = '>=%d' % rows
+            if access == 'NATURAL':
+                warning = None
+                if rows is not None and rows >= PLAN_BIG_TABLE_ROWS:
+                    warning = 'full scan of a big table'
+                d.append([stream, relation, access, None, None, est, warning])
+                continue
+            by_name = dict([(i['INDEX_NAME'], i) for i in indexes])
+            for name in index_names:
+                i = by_name.get(name)
+                selectivity = i and float(i['STATISTICS'] or 0)
+                if i and i['INACT'] == '1':
+                    warning = 'index is inactive'
+                elif not selectivity:
+                    warning = 'no statistics'
+                else:
+                    warning = None
+                if selectivity and rows is not None:
+                    index_est = '%d' % max(1, int(selectivity * rows))
+                else:
+                    index_est = '?'
+                d.append([stream, relation, access, name,
+                    selectivity and '%.6g' % selectivity, index_est, warning])
+        return plan, h, d
+
+    def fingerprint(self):
+        """Summary of the catalog that changes with any DDL.
+
+        Object counts and an MD5 of the catalog texts (sources, defaults,
+        descriptions, domains, exception messages): reading these is far
+        cheaper than loading a SchemaSnapshot.
+        """
+        sqlStmt = '''select
+            (select max(rdb$relation_id) from rdb$relations),
+            (select count(*) from rdb$relations),
+            (select count(*) from rdb$formats),
+            (select count(*) from rdb$relation_fields),
+            (select count(*) from rdb$fields),
+            (select count(*) from rdb$indices),
+            (select sum(rdb$index_inactive) from rdb$indices),
+            (select sum(rdb$statistics) from rdb$indices),
+            (select count(*) from rdb$relation_constraints),
+            (select count(*) from rdb$triggers),
+            (select sum(rdb$trigger_inactive) from rdb$triggers),
+            (select count(*) from rdb$procedures),
+            (select count(*) from rdb$procedure_parameters),
+            (select count(*) from rdb$exceptions)
+            from rdb$database'''
+        counts = tuple(self.execute(sqlStmt)[1][0])
+        digest = hashlib.md5()
+        for sqlStmt in FINGERPRINT_TEXTS:
+            it = self.iter_execute(sqlStmt)
+            it.next()                   # the column labels
+            for r in it:
+                digest.update(repr(r))
+        return counts + (digest.hexdigest(), )
+
+    def cache_name(self):
+        key = '%s/%d:%s:%s:%s' % (self.host, self.port, self.path,
+                                                    self.user, self.charset)
+        return hashlib.md5(key.encode('utf-8')).hexdigest() + '.snapshot'
+
+    def load_snapshot(self, cache_dir=None, use_cache=True):
+        """(Re)load the whole catalog; catalog methods answer from it after.
+
+        With cache_dir the snapshot is also written to a file there, and
+        read back instead of the catalog while fingerprint() is unchanged.
+        """
+        path = fingerprint = snapshot = None
+        if cache_dir:
+            path = os.path.join(cache_dir, self.cache_name())
+            fingerprint = self.fingerprint()
+            if use_cache:
+                snapshot = SchemaSnapshot.read(path, fingerprint, self)
+        if not snapshot:
+            snapshot = SchemaSnapshot(self)
+            snapshot.load()
+            if path:
+                try:
+                    snapshot.write(path, fingerprint)
+                except (IOError, OSError):
+                    pass        # Without a cache the next open just reloads
+        self.snapshot = snapshot
+        self._forget_catalog()
+        return snapshot
+
+    def _forget_catalog(self):
+        self.index_memo = {}        # key_constraints_and_index() by relation
+        self.procedure_memo = None  # procedure_catalog()
+        self.source_memo = {}       # procedure_text() by procedure
+
     def tables(self, system_flag=0):
+        if self.snapshot:
+            return self.snapshot.tables(system_flag)
         sqlStmt = '''select rdb$relation_name NAME,
             rdb$owner_name OWNER,
             rdb$description DESCRIPTION
             from rdb$relations 
-            where rdb$system_flag=%d and rdb$view_source is null
-            order by rdb$relation_name''' % system_flag
-        return self.execute(sqlStmt)
+            where rdb$system_flag=? and rdb$view_source is null
+            order by rdb$relation_name'''
+        return self.execute(sqlStmt, (system_flag, ))
 
     def views(self, name=None):
+        if self.snapshot:
+            return self.snapshot.views(name)
         sqlStmt = '''select rdb$relation_name NAME,
             rdb$owner_name OWNER,
             rdb$description DESCRIPTION
@@ -149,12 +2063,14 @@ class FbDatabase(object):
         return self.execute(sqlStmt)
 
     def view_source(self, name):
+        if self.snapshot:
+            return self.snapshot.view_source(name)
         sqlStmt = '''select rdb$view_source VIEW_SOURCE
             from rdb$relations
-            where rdb$relation_name='%s' and 
+            where rdb$relation_name=? and 
                 rdb$flags=1 and rdb$view_source is not null
-            ''' % (name, )
-        return self.execute(sqlStmt)[1][0][0]
+            '''
+        return self.execute(sqlStmt, (name, ))[1][0][0]
 
     def roles(self):
         sqlStmt = '''select rdb$role_name NAME, rdb$owner_name OWNER
@@ -164,9 +2080,9 @@ class FbDatabase(object):
     def grant_users(self, relation_name):
         sqlStmt = '''select rdb$user NAME, rdb$privilege PRIVILEGE,
             rdb$grant_option GRANT_OPTION, rdb$field_name FIELD_NAME
-            from rdb$user_privileges where rdb$relation_name='%s'
-            order by rdb$user ''' % (relation_name, )
-        return self.execute(sqlStmt)
+            from rdb$user_privileges where rdb$relation_name=?
+            order by rdb$user '''
+        return self.execute(sqlStmt, (relation_name, ))
 
     def domains(self, dom_name=None):
         if dom_name:
@@ -179,11 +2095,23 @@ class FbDatabase(object):
                 B.rdb$field_name FIELD_NAME,
                 B.rdb$validation_source VALIDATION_SOURCE,
                 B.rdb$default_source DEFAULT_SOURCE,
+                B.rdb$null_flag NULL_FLAG,
+                B.rdb$segment_length SEGMENT_LENGTH,
+                (select rdb$character_set_name from rdb$character_sets
+                    where rdb$character_set_id = B.rdb$character_set_id)
+                    CHARACTER_SET_NAME,
+                (select rdb$collation_name from rdb$collations
+                    where rdb$collation_id = B.rdb$collation_id
+                        and rdb$character_set_id = B.rdb$character_set_id)
+                    COLLATION_NAME,
+                B.rdb$collation_id COLLATION_ID,
+                B.rdb$collation_id DOM_COLLATION_ID,
                 B.rdb$description DESCRIPTION
                 from rdb$fields B, rdb$types C 
                 where C.rdb$field_name='RDB$FIELD_TYPE'
                     and B.rdb$field_type=C.rdb$type
-                    and B.rdb$field_name ='%s' ''' % (dom_name,)
+                    and B.rdb$field_name =? '''
+            params = (dom_name, )
         else:
             sqlStmt = '''select B.rdb$field_name NAME,
                 C.rdb$type_name TYPE_NAME,
@@ -194,13 +2122,25 @@ class FbDatabase(object):
                 B.rdb$field_name FIELD_NAME,
                 B.rdb$validation_source VALIDATION_SOURCE,
                 B.rdb$default_source DEFAULT_SOURCE,
+                B.rdb$null_flag NULL_FLAG,
+                B.rdb$segment_length SEGMENT_LENGTH,
+                (select rdb$character_set_name from rdb$character_sets
+                    where rdb$character_set_id = B.rdb$character_set_id)
+                    CHARACTER_SET_NAME,
+                (select rdb$collation_name from rdb$collations
+                    where rdb$collation_id = B.rdb$collation_id
+                        and rdb$character_set_id = B.rdb$character_set_id)
+                    COLLATION_NAME,
+                B.rdb$collation_id COLLATION_ID,
+                B.rdb$collation_id DOM_COLLATION_ID,
                 B.rdb$description DESCRIPTION
                 from rdb$fields B, rdb$types C 
                 where C.rdb$field_name='RDB$FIELD_TYPE'
                     and B.rdb$field_type=C.rdb$type
                     and not B.rdb$field_name like 'RDB$%'
                 order by B.rdb$field_name'''
-        return self.execute(sqlStmt)
+            params = ()
+        return self.execute(sqlStmt, params)
 
     def exceptions(self):
         sqlStmt = '''select rdb$exception_name NAME,
@@ -210,6 +2150,8 @@ class FbDatabase(object):
         return self.execute(sqlStmt)
 
     def columns(self, table_name):
+        if self.snapshot:
+            return self.snapshot.columns(table_name)
         sqlStmt = '''select A.rdb$field_name NAME,
             A.rdb$null_flag NULL_FLAG, 
             A.rdb$default_source DEFAULT_SOURCE,
@@ -221,17 +2163,34 @@ class FbDatabase(object):
             B.rdb$character_length "CHARACTER_LENGTH",
             B.rdb$field_name FIELD_NAME,
             B.rdb$default_source DOM_DEFAULT_SOURCE, 
+            B.rdb$segment_length SEGMENT_LENGTH,
+            (select rdb$character_set_name from rdb$character_sets
+                where rdb$character_set_id = B.rdb$character_set_id)
+                CHARACTER_SET_NAME,
+            (select rdb$collation_name from rdb$collations
+                where rdb$collation_id
+                        = coalesce(A.rdb$collation_id, B.rdb$collation_id)
+                    and rdb$character_set_id = B.rdb$character_set_id)
+                COLLATION_NAME,
+            coalesce(A.rdb$collation_id, B.rdb$collation_id) COLLATION_ID,
+            B.rdb$collation_id DOM_COLLATION_ID,
             B.rdb$validation_source VALIDATION_SOURCE
             from rdb$relation_fields A, rdb$fields B, rdb$types C
             where C.rdb$field_name='RDB$FIELD_TYPE'
                 and A.rdb$field_source = B.rdb$field_name
                 and B.rdb$field_type=C.rdb$type 
-                and  upper(A.rdb$relation_name) = '%s'
+                and  upper(A.rdb$relation_name) = ?
             order by A.rdb$field_position, A.rdb$field_name
-            ''' % (table_name.upper(), )
-        return self.execute(sqlStmt)
+            '''
+        return self.execute(sqlStmt, (table_name.upper(), ))
     
     def key_constraints_and_index(self, table_name):
+        if self.snapshot:
+            return self.snapshot.key_constraints_and_index(table_name)
+        if self.index_memo.has_key(table_name):
+            return [dict(d) for d in self.index_memo[table_name]]
+        # Referenced relation and fields of a foreign key come from the
+        # same query, B2 paired with B by segment position.
         sqlStmt = '''select 
             A.rdb$index_name INDEX_NAME, 
             A.rdb$index_id INDEX_ID, 
@@ -243,7 +2202,9 @@ class FbDatabase(object):
             C.rdb$constraint_type CONST_TYPE, 
             C.rdb$constraint_name CONST_NAME,
             D.rdb$update_rule UPDATE_RULE, 
-            D.rdb$delete_rule DELETE_RULE
+            D.rdb$delete_rule DELETE_RULE,
+            A2.rdb$relation_name REF_RELATION,
+            B2.rdb$field_name REF_FIELD
             from rdb$indices A
                 left join rdb$index_segments B
                         on A.rdb$index_name=B.rdb$index_name 
@@ -251,10 +2212,17 @@ class FbDatabase(object):
                         on A.rdb$index_name=C.rdb$index_name
                 left join rdb$ref_constraints D 
                         on C.rdb$constraint_name=D.rdb$constraint_name
-            where A.rdb$relation_name='%s' ''' % table_name
-        head, rows = self.execute(sqlStmt)
+                left join rdb$indices A2
+                        on A2.rdb$index_name=A.rdb$foreign_key
+                left join rdb$index_segments B2
+                        on B2.rdb$index_name=A2.rdb$index_name
+                            and B2.rdb$field_position=B.rdb$field_position
+            where A.rdb$relation_name=?
+            order by A.rdb$index_id, B.rdb$field_position'''
+        head, rows = self.execute(sqlStmt, (table_name, ))
     
         d = {}
+        a = []
         for r in rows:
             row = dict(zip(head, r))
             if not d.has_key(row['INDEX_ID']):
@@ -269,30 +2237,21 @@ class FbDatabase(object):
                     'DELETE_RULE': row['DELETE_RULE'],
                     'FIELD_NAME': [],
                 }
-
-                if row['FOREIGN_KEY']:
-                    d[row['INDEX_ID']]['FOREIGN_KEY'] = \
-                            self._references(row['FOREIGN_KEY'])
+                if row['FOREIGN_KEY']:  #index,table,[fields]
+                    d[row['INDEX_ID']]['FOREIGN_KEY'] = (
+                            row['FOREIGN_KEY'], row['REF_RELATION'], [])
                 else:
                     d[row['INDEX_ID']]['FOREIGN_KEY'] = ''
+                a.append(d[row['INDEX_ID']])
             d[row['INDEX_ID']]['FIELD_NAME'].append(row['FIELD_NAME'])
-        # convert dict to array. Key value (INDEX_ID) is not need.
-        a = []
-        for k in d:
-            a.append(d[k])
-        return a
-    
-    def _references(self, index_name):
-        sqlStmt = '''select 
-            A.rdb$relation_name RELATION_NAME, 
-            B.rdb$field_name FIELD_NAME 
-            from rdb$indices A, rdb$index_segments B
-            where A.rdb$index_name='%s' 
-                and A.rdb$index_name=b.rdb$index_name''' % index_name
-        h, d = self.execute(sqlStmt)
-        return (index_name, d[0][0], [r[1] for r in d])  #index,table,[fields]
+            if row['FOREIGN_KEY']:
+                d[row['INDEX_ID']]['FOREIGN_KEY'][2].append(row['REF_FIELD'])
+        self.index_memo[table_name] = a
+        return [dict(d) for d in a]
     
     def check_constraints(self, tabname):
+        if self.snapshot:
+            return self.snapshot.check_constraints(tabname)
         sqlStmt = '''select 
             A.rdb$constraint_name CHECK_NAME, 
             C.rdb$trigger_source CHECK_SOURCE 
@@ -303,8 +2262,8 @@ class FbDatabase(object):
                 and A.rdb$constraint_name = B.rdb$constraint_name 
                 and B.rdb$trigger_name = C.rdb$trigger_name 
                 and C.rdb$trigger_type=1
-                and upper(A.rdb$relation_name) = '%s' ''' % tabname.upper()
-        head, data = self.execute(sqlStmt)
+                and upper(A.rdb$relation_name) = ? '''
+        head, data = self.execute(sqlStmt, (tabname.upper(), ))
         a = []
         for r in data:
             row = dict(zip(head, r))
@@ -351,6 +2310,8 @@ class FbDatabase(object):
         return a
 
     def _keys(self, tname, key_type):
+        if self.snapshot:
+            return self.snapshot.keys(tname, key_type)
         sqlStmt = '''select 
             a.rdb$index_name INDEX_NAME, 
             b.rdb$field_name F
@@ -361,10 +2322,12 @@ class FbDatabase(object):
                         on A.rdb$index_name=C.rdb$index_name
                 left join rdb$ref_constraints D 
                         on C.rdb$constraint_name=D.rdb$constraint_name
-            where upper(A.rdb$relation_name)='%s' 
-                and c.rdb$constraint_type='%s' 
-            ''' % (tname.upper(), key_type)
-        return [r[1].strip() for r in self.execute(sqlStmt)[1]]
+            where upper(A.rdb$relation_name)=? 
+                and c.rdb$constraint_type=? 
+            order by B.rdb$field_position
+            '''
+        return [r[1].strip()
+                for r in self.execute(sqlStmt, (tname.upper(), key_type))[1]]
 
     def primary_keys(self, tname):
         return self._keys(tname, 'PRIMARY KEY')
@@ -392,13 +2355,15 @@ class FbDatabase(object):
                         on C.rdb$constraint_name=D.rdb$constraint_name
                 ,
                 rdb$indices A2, rdb$index_segments B2
-            where upper(A.rdb$relation_name)='%s' 
+            where upper(A.rdb$relation_name)=? 
                 and A2.rdb$index_name=A.rdb$foreign_key
                 and A2.rdb$index_name=B2.rdb$index_name
-        ''' % tname.upper()
-        return self.execute(sqlStmt)
+        '''
+        return self.execute(sqlStmt, (tname.upper(), ))
 
     def referenced_columns(self, tname):
+        if self.snapshot:
+            return self.snapshot.referenced_columns(tname)
         sqlStmt = '''select 
             B2.rdb$field_name FIELD_NAME,
             C.rdb$constraint_name CONST_NAME,
@@ -412,9 +2377,9 @@ class FbDatabase(object):
             where A.rdb$index_name=B.rdb$index_name
                 and A2.rdb$index_name=B2.rdb$index_name
                 and A.rdb$foreign_key = A2.rdb$index_name
-                and A2.rdb$relation_name = '%s'
-            ''' % tname.upper()
-        return self.execute(sqlStmt)
+                and A2.rdb$relation_name = ?
+            '''
+        return self.execute(sqlStmt, (tname.upper(), ))
     
     def generators(self):
         sqlStmt = '''select 
@@ -425,11 +2390,42 @@ class FbDatabase(object):
         return self.execute(sqlStmt)
 
     def get_generator_id(self, gen_name):
-        sqlStmt = 'select gen_id(' + gen_name + ', 0) V from rdb$database'
+        sqlStmt = ('select gen_id(' + quote_identifier(gen_name)
+                                            + ', 0) V from rdb$database')
         (h, d) = self.execute(sqlStmt)
         return d[0][0]
     
+    def generator_values(self, names=None):
+        """Current value of every generator (or of those in names) by name.
+
+        They are read with wide single row selects of gen_id(), as few as
+        the statement length limit allows.
+        """
+        if names is None:
+            names = [r[0] for r in self.generators()[1]]
+        chunks = [[]]
+        length = 0
+        for name in names:
+            expr = 'gen_id(' + quote_identifier(name) + ', 0)'
+            if chunks[-1] and (length + len(expr) > MAX_STMT_LENGTH
+                                    or len(chunks[-1]) == MAX_SELECT_ITEMS):
+                chunks.append([])
+                length = 0
+            chunks[-1].append((name, expr))
+            length += len(expr) + 2
+        values = {}
+        for chunk in chunks:
+            if not chunk:
+                continue
+            sqlStmt = ('select ' + ', '.join([expr for name, expr in chunk])
+                                                    + ' from rdb$database')
+            h, d = self.execute(sqlStmt)
+            values.update(zip([name for name, expr in chunk], d[0]))
+        return values
+
     def triggers(self, tabname=None):
+        if self.snapshot:
+            return self.snapshot.triggers(tabname)
         if tabname:
             sqlStmt = '''select 
                 rdb$trigger_name NAME, 
@@ -439,10 +2435,11 @@ class FbDatabase(object):
                 rdb$trigger_inactive INACT
                     from rdb$triggers
                     where (rdb$system_flag is null or rdb$system_flag = 0)
-                        and rdb$relation_name='%s'
+                        and rdb$relation_name=?
                     order by rdb$relation_name, rdb$trigger_type, 
                         rdb$trigger_sequence
-            ''' % tabname
+            '''
+            params = (tabname, )
         else:
             sqlStmt = '''select 
                 rdb$trigger_name NAME, 
@@ -454,7 +2451,8 @@ class FbDatabase(object):
                     where (rdb$system_flag is null or rdb$system_flag = 0)
                     order by rdb$relation_name, rdb$trigger_type,
                         rdb$trigger_sequence'''
-        return self.execute(sqlStmt)
+            params = ()
+        return self.execute(sqlStmt, params)
 
     def trigger_source(self, name):
         sqlStmt = '''select 
@@ -464,77 +2462,94 @@ class FbDatabase(object):
             rdb$trigger_source SOURCE, 
             rdb$trigger_inactive INACT
                 from rdb$triggers
-                where rdb$trigger_name='%s' ''' % (name, )
-        (h, d) = self.execute(sqlStmt)
+                where rdb$trigger_name=? '''
+        (h, d) = self.execute(sqlStmt, (name, ))
         return 'recreate trigger ' + name + '\n' + d[0][3]
 
     def procedures(self):
+        catalog = self.procedure_catalog()
+        names = catalog.keys()
+        names.sort()
+        return (['NAME', 'DESCRIPTION'],
+                [[name, catalog[name]['DESCRIPTION']] for name in names])
+
+    def load_procedure_catalog(self):
+        """Every procedure with its IN and OUT parameters by name.
+
+        Read in two queries; procedure sources are left out, see
+        procedure_text().
+        """
         sqlStmt = '''select rdb$procedure_name NAME, 
             rdb$description DESCRIPTION
-            from rdb$procedures order by rdb$procedure_name'''
-        return self.execute(sqlStmt)
+            from rdb$procedures'''
+        catalog = {}
+        for r in self.execute(sqlStmt)[1]:
+            catalog[r[0]] = {'NAME': r[0], 'DESCRIPTION': r[1],
+                                            'IN_PARAMS': [], 'OUT_PARAMS': []}
+        sqlStmt = '''select 
+            A.rdb$parameter_name NAME, 
+            A.rdb$description DESCRIPTION,
+            C.rdb$type_name TYPE_NAME, 
+            B.rdb$field_sub_type FIELD_SUB_TYPE, 
+            B.rdb$field_precision FIELD_PRECISION,
+            B.rdb$field_scale FIELD_SCALE, 
+            B.rdb$character_length "CHARACTER_LENGTH",
+            B.rdb$field_name FIELD_NAME,
+            A.rdb$null_flag NULL_FLAG, A.rdb$default_source DEFAULT_SOURCE,
+            B.rdb$segment_length SEGMENT_LENGTH,
+            (select rdb$character_set_name from rdb$character_sets
+                where rdb$character_set_id = B.rdb$character_set_id)
+                CHARACTER_SET_NAME,
+            (select rdb$collation_name from rdb$collations
+                where rdb$collation_id = B.rdb$collation_id
+                    and rdb$character_set_id = B.rdb$character_set_id)
+                COLLATION_NAME,
+            B.rdb$collation_id COLLATION_ID,
+            B.rdb$collation_id DOM_COLLATION_ID,
+            A.rdb$procedure_name PROCEDURE_NAME,
+            A.rdb$parameter_type PARAMETER_TYPE
+            from rdb$procedure_parameters A, rdb$fields B, rdb$types C
+            where C.rdb$field_name='RDB$FIELD_TYPE' 
+                and A.rdb$field_source = B.rdb$field_name 
+                and B.rdb$field_type=C.rdb$type 
+            order by A.rdb$procedure_name, A.rdb$parameter_type,
+                A.rdb$parameter_number'''
+        head, params = self.execute(sqlStmt)
+        for r in params:
+            d = dict(zip(head[:-2], r[:-2]))
+            d['NAME'] = d['NAME'].strip()
+            proc = catalog.get(r[-2])
+            if proc:
+                proc[('IN_PARAMS', 'OUT_PARAMS')[int(r[-1])]].append(d)
+        return catalog
+
+    def procedure_catalog(self):
+        "load_procedure_catalog() memoized for the session."
+        if self.snapshot:
+            return self.snapshot.procedure_catalog
+        if self.procedure_memo is None:
+            self.procedure_memo = self.load_procedure_catalog()
+        return self.procedure_memo
+
+    def procedure_params(self, name):
+        proc = self.procedure_catalog()[name]
+        return {'NAME': proc['NAME'],
+                'DESCRIPTION': proc['DESCRIPTION'],
+                'IN_PARAMS': [dict(p) for p in proc['IN_PARAMS']],
+                'OUT_PARAMS': [dict(p) for p in proc['OUT_PARAMS']]}
+
+    def procedure_text(self, name):
+        "Source of a procedure, read on first use."
+        if not self.source_memo.has_key(name):
+            sqlStmt = '''select rdb$procedure_source SOURCE
+                from rdb$procedures where rdb$procedure_name=? '''
+            self.source_memo[name] = self.execute(sqlStmt, (name, ))[1][0][0]
+        return self.source_memo[name]
 
     def procedure_source(self, name):
-        sqlStmt = '''select rdb$procedure_name NAME, 
-                rdb$procedure_source SOURCE,
-                rdb$description DESCRIPTION
-            from rdb$procedures
-            where rdb$procedure_name='%s' ''' % (name,)
-        r = []
-        head, procs = self.execute(sqlStmt)
-        for row in procs:
-            sqlStmt = '''select 
-                A.rdb$parameter_name NAME, 
-                A.rdb$description DESCRIPTION,
-                C.rdb$type_name TYPE_NAME, 
-                B.rdb$field_sub_type FIELD_SUB_TYPE, 
-                B.rdb$field_precision FIELD_PRECISION,
-                B.rdb$field_scale FIELD_SCALE, 
-                B.rdb$character_length "CHARACTER_LENGTH",
-                B.rdb$field_name FIELD_NAME,
-                B.rdb$null_flag NULL_FLAG, B.rdb$default_source DEFAULT_SOURCE
-                from rdb$procedure_parameters A, rdb$fields B, rdb$types C
-                where C.rdb$field_name='RDB$FIELD_TYPE' 
-                    and A.rdb$field_source = B.rdb$field_name 
-                    and A.rdb$parameter_type = 0
-                    and B.rdb$field_type=C.rdb$type 
-                    and  A.rdb$procedure_name='%s'
-                order by A.rdb$parameter_number''' % row[0]
-            in_params = []
-            head, params = self.execute(sqlStmt)
-            for p in params:
-                d = dict(zip(head, p))
-                d['NAME'] = d['NAME'].strip()
-                in_params.append(d)
-            sqlStmt = ''' select 
-                A.rdb$parameter_name NAME, 
-                A.rdb$description DESCRIPTION,
-                C.rdb$type_name TYPE_NAME,
-                B.rdb$field_sub_type FIELD_SUB_TYPE, 
-                B.rdb$field_precision FIELD_PRECISION,
-                B.rdb$field_scale FIELD_SCALE, 
-                B.rdb$character_length "CHARACTER_LENGTH",
-                B.rdb$field_name FIELD_NAME,
-                B.rdb$null_flag NULL_FLAG, B.rdb$default_source DEFAULT_SOURCE
-                from rdb$procedure_parameters A, rdb$fields B, rdb$types C
-                where C.rdb$field_name='RDB$FIELD_TYPE' 
-                    and A.rdb$field_source = B.rdb$field_name 
-                    and A.rdb$parameter_type = 1
-                    and B.rdb$field_type=C.rdb$type 
-                    and  A.rdb$procedure_name='%s'
-                order by A.rdb$parameter_number''' % row[0]
-            out_params = []
-            head, params = self.execute(sqlStmt)
-            for p in params:
-                d = dict(zip(head, p))
-                d['NAME'] = d['NAME'].strip()
-                out_params.append(d)
-            r.append({'NAME': row[0].strip(),
-                    'SOURCE': row[1],
-                    'DESCRIPTION': row[2],
-                    'IN_PARAMS': in_params,
-                    'OUT_PARAMS':out_params})
-        return r[0] # only 1 record.
+        proc = self.procedure_params(name)
+        proc['SOURCE'] = self.procedure_text(name)
+        return proc
 
     def functions(self):
         sqlStmt = '''select rdb$function_name FUNCTION_NAME, 
@@ -546,129 +2561,1152 @@ class FbDatabase(object):
             '''
         return self.execute(sqlStmt)
 
+class SchemaSnapshot(object):
+    """The catalog of a database, loaded with one query per catalog table.
+
+    Relations, columns, indices with their segments and constraints,
+    check constraints, triggers, procedures and their parameters are read
+    in bulk by load() and indexed by relation, index and procedure name.
+    The methods answer like the FbDatabase methods of the same name;
+    FbDatabase delegates to them once load_snapshot() has been called.
+    Procedure sources are not part of it, see FbDatabase.procedure_text().
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def load(self):
+        db = self.db
+        h, d = db.execute('''select rdb$relation_name NAME,
+            rdb$owner_name OWNER,
+            rdb$description DESCRIPTION,
+            rdb$system_flag SYSTEM_FLAG,
+            rdb$flags FLAGS,
+            rdb$view_source VIEW_SOURCE
+            from rdb$relations
+            order by rdb$relation_name''')
+        self.relations = [dict(zip(h, r)) for r in d]
+        self.relation_names = {}        # upper(name) -> name
+        for r in self.relations:
+            self.relation_names[r['NAME'].upper()] = r['NAME']
+
+        h, d = db.execute('''select A.rdb$field_name NAME,
+            A.rdb$null_flag NULL_FLAG, 
+            A.rdb$default_source DEFAULT_SOURCE,
+            A.rdb$description DESCRIPTION,
+            C.rdb$type_name TYPE_NAME,
+            B.rdb$field_sub_type FIELD_SUB_TYPE, 
+            B.rdb$field_precision FIELD_PRECISION,
+            B.rdb$field_scale FIELD_SCALE, 
+            B.rdb$character_length "CHARACTER_LENGTH",
+            B.rdb$field_name FIELD_NAME,
+            B.rdb$default_source DOM_DEFAULT_SOURCE, 
+            B.rdb$validation_source VALIDATION_SOURCE,
+            B.rdb$segment_length SEGMENT_LENGTH,
+            (select rdb$character_set_name from rdb$character_sets
+                where rdb$character_set_id = B.rdb$character_set_id)
+                CHARACTER_SET_NAME,
+            (select rdb$collation_name from rdb$collations
+                where rdb$collation_id
+                        = coalesce(A.rdb$collation_id, B.rdb$collation_id)
+                    and rdb$character_set_id = B.rdb$character_set_id)
+                COLLATION_NAME,
+            coalesce(A.rdb$collation_id, B.rdb$collation_id) COLLATION_ID,
+            B.rdb$collation_id DOM_COLLATION_ID,
+            A.rdb$relation_name RELATION_NAME
+            from rdb$relation_fields A, rdb$fields B, rdb$types C
+            where C.rdb$field_name='RDB$FIELD_TYPE'
+                and A.rdb$field_source = B.rdb$field_name
+                and B.rdb$field_type=C.rdb$type 
+            order by A.rdb$relation_name, A.rdb$field_position,
+                A.rdb$field_name''')
+        self.column_head = h[:-1]
+        self.columns_by_relation = {}
+        for r in d:
+            self.columns_by_relation.setdefault(r[-1], []).append(r[:-1])
+
+        h, d = db.execute('''select 
+            A.rdb$index_name INDEX_NAME, 
+            A.rdb$index_id INDEX_ID, 
+            A.rdb$unique_flag UNIQUE_FLAG,
+            A.rdb$index_inactive INACT,
+            A.rdb$statistics STATISTIC,
+            A.rdb$foreign_key FOREIGN_KEY, 
+            B.rdb$field_name FIELD_NAME, 
+            C.rdb$constraint_type CONST_TYPE, 
+            C.rdb$constraint_name CONST_NAME,
+            D.rdb$update_rule UPDATE_RULE, 
+            D.rdb$delete_rule DELETE_RULE,
+            A.rdb$relation_name RELATION_NAME
+            from rdb$indices A
+                left join rdb$index_segments B
+                        on A.rdb$index_name=B.rdb$index_name 
+                left join rdb$relation_constraints C 
+                        on A.rdb$index_name=C.rdb$index_name
+                left join rdb$ref_constraints D 
+                        on C.rdb$constraint_name=D.rdb$constraint_name
+            order by A.rdb$relation_name, A.rdb$index_id,
+                B.rdb$field_position''')
+        self.indices = {}               # index name -> index
+        self.indices_by_relation = {}
+        for r in d:
+            row = dict(zip(h, r))
+            index = self.indices.get(row['INDEX_NAME'])
+            if not index:
+                index = {
+                    'INDEX_NAME': row['INDEX_NAME'], 
+                    'UNIQUE_FLAG': row['UNIQUE_FLAG'],
+                    'INACT' : row['INACT'],
+                    'STATISTICS' : row['STATISTIC'],
+                    'CONST_TYPE': row['CONST_TYPE'], 
+                    'CONST_NAME': row['CONST_NAME'],
+                    'UPDATE_RULE': row['UPDATE_RULE'],
+                    'DELETE_RULE': row['DELETE_RULE'],
+                    'FOREIGN_KEY': row['FOREIGN_KEY'],
+                    'RELATION_NAME': row['RELATION_NAME'],
+                    'FIELD_NAME': [],
+                }
+                self.indices[row['INDEX_NAME']] = index
+                self.indices_by_relation.setdefault(
+                                row['RELATION_NAME'], []).append(index)
+            index['FIELD_NAME'].append(row['FIELD_NAME'])
+
+        h, d = db.execute('''select 
+            A.rdb$constraint_name CHECK_NAME, 
+            C.rdb$trigger_source CHECK_SOURCE,
+            A.rdb$relation_name RELATION_NAME
+            from rdb$relation_constraints A, rdb$check_constraints B, 
+                rdb$triggers C
+            where 
+                A.rdb$constraint_type='CHECK' 
+                and A.rdb$constraint_name = B.rdb$constraint_name 
+                and B.rdb$trigger_name = C.rdb$trigger_name 
+                and C.rdb$trigger_type=1''')
+        self.checks_by_relation = {}
+        for r in d:
+            self.checks_by_relation.setdefault(r[2], []).append(
+                                {'CHECK_NAME': r[0], 'CHECK_SOURCE': r[1]})
+
+        self.trigger_head, self.trigger_rows = db.execute('''select 
+            rdb$trigger_name NAME, 
+            rdb$relation_name TABLE_NAME,
+            rdb$trigger_sequence SEQUENCE, 
+            rdb$trigger_type TRIGGER_TYPE, 
+            rdb$trigger_inactive INACT
+                from rdb$triggers
+                where (rdb$system_flag is null or rdb$system_flag = 0)
+                order by rdb$relation_name, rdb$trigger_type,
+                    rdb$trigger_sequence''')
+
+        self.procedure_catalog = db.load_procedure_catalog()
+
+    def reload_statistics(self):
+        "Read RDB$STATISTICS of the indices again, after SET STATISTICS."
+        h, d = self.db.execute(
+                    'select rdb$index_name, rdb$statistics from rdb$indices')
+        for name, statistics in d:
+            index = self.indices.get(name)
+            if index:
+                index['STATISTICS'] = statistics
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        del d['db']
+        return d
+
+    def read(cls, path, fingerprint, db):
+        "Snapshot cached in path if it was taken at fingerprint, else None."
+        try:
+            f = open(path, 'rb')
+            try:
+                version, cached_fingerprint, snapshot = pickle.load(f)
+            finally:
+                f.close()
+        except (PythonException, Exception):
+            return None
+        if (version != SNAPSHOT_CACHE_VERSION
+                                    or cached_fingerprint != fingerprint):
+            return None
+        snapshot.db = db
+        return snapshot
+    read = classmethod(read)
+
+    def write(self, path, fingerprint):
+        d = os.path.dirname(path)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            pickle.dump((SNAPSHOT_CACHE_VERSION, fingerprint, self), f,
+                                                    pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+
+    def _relation(self, name):
+        # Some catalog queries compare upper(rdb$relation_name)
+        return self.relation_names.get(name.upper(), name)
+
+    def tables(self, system_flag=0):
+        return (['NAME', 'OWNER', 'DESCRIPTION'],
+                [[r['NAME'], r['OWNER'], r['DESCRIPTION']]
+                    for r in self.relations
+                        if r['SYSTEM_FLAG'] == str(system_flag)
+                            and r['VIEW_SOURCE'] is None])
+
+    def views(self, name=None):
+        return (['NAME', 'OWNER', 'DESCRIPTION'],
+                [[r['NAME'], r['OWNER'], r['DESCRIPTION']]
+                    for r in self.relations
+                        if r['FLAGS'] == '1' and r['VIEW_SOURCE'] is not None])
+
+    def view_source(self, name):
+        for r in self.relations:
+            if r['NAME'] == name and r['VIEW_SOURCE'] is not None:
+                return r['VIEW_SOURCE']
+        raise IndexError(name)
+
+    def columns(self, table_name):
+        return (list(self.column_head), [list(r) for r in
+            self.columns_by_relation.get(self._relation(table_name), [])])
+
+    def key_constraints_and_index(self, table_name):
+        a = []
+        for index in self.indices_by_relation.get(
+                                        self._relation(table_name), []):
+            d = dict(index)
+            del d['RELATION_NAME']
+            d['FIELD_NAME'] = list(index['FIELD_NAME'])
+            if index['FOREIGN_KEY']:
+                ref = self.indices[index['FOREIGN_KEY']]
+                d['FOREIGN_KEY'] = (ref['INDEX_NAME'], ref['RELATION_NAME'],
+                                                    list(ref['FIELD_NAME']))
+            else:
+                d['FOREIGN_KEY'] = ''
+            a.append(d)
+        return a
+
+    def check_constraints(self, tabname):
+        return [dict(r) for r in
+            self.checks_by_relation.get(self._relation(tabname), [])]
+
+    def keys(self, tname, key_type):
+        a = []
+        for index in self.indices_by_relation.get(self._relation(tname), []):
+            if index['CONST_TYPE'] == key_type:
+                a += index['FIELD_NAME']
+        return a
+
+    def referenced_columns(self, tname):
+        d = []
+        for index in self.indices_by_relation.get(self._relation(tname), []):
+            for ref in self.indices.values():
+                if ref['FOREIGN_KEY'] != index['INDEX_NAME']:
+                    continue
+                for f, ref_f in zip(index['FIELD_NAME'], ref['FIELD_NAME']):
+                    d.append([f, ref['CONST_NAME'], ref['RELATION_NAME'], ref_f])
+        return (['FIELD_NAME', 'CONST_NAME', 'REFERENCED_TABLE',
+                                                    'REFERENCED_FIELD'], d)
+
+    def triggers(self, tabname=None):
+        return (list(self.trigger_head), [list(r) for r in self.trigger_rows
+                                    if tabname is None or r[1] == tabname])
+
+def sql_string(s):
+    return "'" + s.replace("'", "''") + "'"
+
+def ddl_type(d):
+    "Column or parameter type: the quoted domain, else the builtin type."
+    if d['FIELD_NAME'][:4] != 'RDB$':
+        return quote_identifier(d['FIELD_NAME'])
+    return fieldtype_to_string(d, False)
+
+def ddl_collation(d):
+    """' COLLATE name' unless the collation is the default of the
+    character set or comes with the domain, else ''."""
+    collation_id = d.get('COLLATION_ID')
+    if not d.get('COLLATION_NAME') or collation_id in (None, '0'):
+        return u''
+    if (d['FIELD_NAME'][:4] != 'RDB$'
+                            and collation_id == d.get('DOM_COLLATION_ID')):
+        return u''
+    return u' COLLATE ' + d['COLLATION_NAME']
+
+def topological_order(names, depends_on):
+    """names ordered so that each comes after those it depends on.
+
+    depends_on maps a name to the names it needs; others are ignored.
+    Names left in a cycle follow in name order.
+    """
+    names = sorted(names)
+    wanted = dict.fromkeys(names)
+    needs = {}
+    needed_by = {}
+    for name in names:
+        deps = [n for n in depends_on.get(name, ())
+                                    if n != name and wanted.has_key(n)]
+        needs[name] = len(deps)
+        for n in deps:
+            needed_by.setdefault(n, []).append(name)
+    ready = [name for name in names if not needs[name]]
+    order = []
+    while ready:
+        name = ready.pop(0)
+        order.append(name)
+        for n in needed_by.get(name, ()):
+            needs[n] -= 1
+            if not needs[n]:
+                bisect.insort(ready, n)
+    placed = dict.fromkeys(order)
+    return order + [name for name in names if not placed.has_key(name)]
+
+TRIGGER_ACTIONS = (None, 'INSERT', 'UPDATE', 'DELETE')
+DB_TRIGGER_EVENTS = {8192: 'CONNECT', 8193: 'DISCONNECT',
+    8194: 'TRANSACTION START', 8195: 'TRANSACTION COMMIT',
+    8196: 'TRANSACTION ROLLBACK'}
+PRIVILEGES = {'S': 'SELECT', 'I': 'INSERT', 'U': 'UPDATE', 'D': 'DELETE',
+    'R': 'REFERENCES', 'X': 'EXECUTE'}
+GRANTEE_TYPES = {'1': 'VIEW ', '2': 'TRIGGER ', '5': 'PROCEDURE '}
+
+def trigger_event(trigger_type):
+    """'BEFORE INSERT OR UPDATE' like text of rdb$trigger_type, 'ON ...'
+    for database triggers, None for types it does not know."""
+    v = int(trigger_type)
+    if DB_TRIGGER_EVENTS.has_key(v):
+        return 'ON ' + DB_TRIGGER_EVENTS[v]
+    if v < 1 or v > 114:
+        return None
+    phase = (v + 1) & 1
+    suffix = v + 1 - phase
+    actions = [TRIGGER_ACTIONS[(suffix >> shift) & 3] for shift in (1, 3, 5)]
+    return ('BEFORE ', 'AFTER ')[phase] + ' OR '.join(
+                                            [a for a in actions if a])
+
+class DdlExtractor(object):
+    """Writes a DDL script that recreates the schema of a database.
+
+    The catalog is read with a SchemaSnapshot and a few more bulk queries,
+    not one query per object, and each statement is written as soon as it
+    is generated. Procedures are first created empty, so that views and
+    procedure bodies can follow in the order of RDB$DEPENDENCIES. objects
+    can be read from another thread while run() works, and cancel() stops
+    it. External functions are not extracted.
+    """
+    def __init__(self, db, path):
+        self.db = db.for_lane(db.lane)  # own current_stmt for cancel()
+        self.path = path
+        self.objects = 0
+        self.started = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.db.cancel()
+
+    def run(self):
+        "Write the file; returns the number of objects written."
+        writer = BufferedWriter(OutputStreamWriter(
+                    FileOutputStream(self.path), 'UTF-8'), EXPORT_BUFFER_SIZE)
+        done = False
+        try:
+            done = self.write(writer)
+        finally:
+            writer.close()
+            if not done:                # Do not leave a partial file
+                os.remove(self.path)
+        return self.objects
+
+    def write(self, writer):
+        """Write the script to a java.io.Writer, which is left open.
+
+        Returns False when cancelled.
+        """
+        self.started = time.time()
+        for s in self.statements():
+            if self.cancelled:
+                break
+            writer.write(s + u'\n')
+        return not self.cancelled
+
+    def _read_catalog(self):
+        db = self.db
+        self.snap = SchemaSnapshot(db)
+        self.snap.load()
+        self.indexes = {}
+        for i in db.index_statistics():
+            self.indexes[i['INDEX_NAME']] = i
+        h, d = db.execute('''select A.rdb$relation_name, A.rdb$field_name,
+            B.rdb$computed_source
+            from rdb$relation_fields A, rdb$fields B
+            where A.rdb$field_source = B.rdb$field_name
+                and B.rdb$computed_source is not null''')
+        self.computed = {}
+        for r in d:
+            self.computed[(r[0], r[1])] = r[2]
+        h, d = db.execute('''select rdb$procedure_name, rdb$procedure_source
+            from rdb$procedures''')
+        self.procedure_sources = dict(d)
+        h, d = db.execute('''select distinct rdb$dependent_name,
+            rdb$depended_on_name
+            from rdb$dependencies
+            where rdb$dependent_type in (1, 5)''')
+        self.depends_on = {}
+        for r in d:
+            self.depends_on.setdefault(r[0], []).append(r[1])
+
+    def statements(self):
+        "Generator over the statements of the script, with their comments."
+        yield u'SET SQL DIALECT 3;\n'
+        for kind, name, text, info in self.definitions():
+            yield text
+
+    def definitions(self):
+        """Generator over (kind, name, text, info) of the schema objects,
+        in script order.
+
+        name is unique within kind and the same in any database with the
+        object; text is its DDL statement. info is a dict with the NAME
+        to drop it by and, for tables and domains, their parts. Items of
+        kind None are statements of no object, like SET TERM.
+        """
+        self._read_catalog()
+        for section in (self.domains, self.generators, self.exceptions,
+                        self.roles, self.tables, self.constraints,
+                        self.indices, self.procedures_and_views,
+                        self.checks, self.triggers, self.grants):
+            for item in section():
+                if self.cancelled:
+                    return
+                if item[0]:
+                    self.objects += 1
+                yield item
+
+    def domains(self):
+        h, d = self.db.domains()
+        for r in d:
+            row = dict(zip(h, r))
+            info = {'NAME': row['NAME'],
+                'TYPE': fieldtype_to_string(row, False),
+                'DEFAULT_SOURCE': row['DEFAULT_SOURCE'],
+                'NULL_FLAG': row['NULL_FLAG'] == '1',
+                'VALIDATION_SOURCE': row['VALIDATION_SOURCE']}
+            s = (u'CREATE DOMAIN ' + quote_identifier(row['NAME']) + u' AS '
+                            + fieldtype_to_string(row, False, True, True))
+            if row['VALIDATION_SOURCE']:
+                s += u'\n    ' + row['VALIDATION_SOURCE']
+            s += ddl_collation(row)
+            yield 'DOMAIN', row['NAME'], s + u';', info
+
+    def generators(self):
+        names = [r[0] for r in self.db.generators()[1]]
+        values = self.db.generator_values(names)
+        for name in names:
+            yield ('GENERATOR', name,
+                    u'CREATE GENERATOR %s;' % quote_identifier(name),
+                    {'NAME': name})
+            yield (None, None, u'SET GENERATOR %s TO %s;' % (
+                            quote_identifier(name), values[name]), None)
+
+    def exceptions(self):
+        for r in self.db.exceptions()[1]:
+            yield ('EXCEPTION', r[0], u'CREATE EXCEPTION %s %s;' % (
+                        quote_identifier(r[0]), sql_string(r[1] or '')),
+                    {'NAME': r[0]})
+
+    def roles(self):
+        for r in self.db.roles()[1]:
+            if r[0][:4] != 'RDB$':
+                yield ('ROLE', r[0], u'CREATE ROLE %s;' % quote_identifier(r[0]),
+                        {'NAME': r[0]})
+
+    def _column(self, relation_name, d):
+        computed = self.computed.get((relation_name, d['NAME']))
+        c = {'NAME': d['NAME'], 'TYPE': ddl_type(d),
+            'DEFAULT_SOURCE': d['DEFAULT_SOURCE'],
+            'NULL_FLAG': d['NULL_FLAG'] == '1', 'COMPUTED': computed}
+        s = quote_identifier(d['NAME']) + u' '
+        if computed:
+            s += u'COMPUTED BY ' + computed
+        else:
+            s += c['TYPE']
+            if d['DEFAULT_SOURCE']:
+                s += u' ' + d['DEFAULT_SOURCE']
+            if c['NULL_FLAG']:
+                s += u' NOT NULL'
+            s += ddl_collation(d)
+        c['DDL'] = s
+        return c
+
+    def tables(self):
+        h = self.snap.column_head
+        for r in self.snap.tables()[1]:
+            name = r[0]
+            columns = [self._column(name, dict(zip(h, c)))
+                        for c in self.snap.columns_by_relation.get(name, [])]
+            yield ('TABLE', name, u'CREATE TABLE %s (\n    %s\n);' % (
+                    quote_identifier(name),
+                    u',\n    '.join([c['DDL'] for c in columns])),
+                {'NAME': name, 'COLUMNS': columns})
+
+    def _fields(self, fields):
+        return u', '.join([quote_identifier(f) for f in fields])
+
+    def _constraint(self, index):
+        s = u'ALTER TABLE ' + quote_identifier(index['RELATION_NAME']) + u' ADD'
+        if index['CONST_NAME'].startswith('INTEG_'):
+            # Generated names differ between databases
+            name = '%s(%s)' % (index['CONST_TYPE'],
+                                            ','.join(index['FIELD_NAME']))
+        else:
+            name = index['CONST_NAME']
+            s += u' CONSTRAINT ' + quote_identifier(name)
+        s += u' %s (%s)' % (index['CONST_TYPE'],
+                                        self._fields(index['FIELD_NAME']))
+        if index['CONST_TYPE'] == 'FOREIGN KEY':
+            ref = self.snap.indices[index['FOREIGN_KEY']]
+            s += u' REFERENCES %s (%s)' % (
+                quote_identifier(ref['RELATION_NAME']),
+                self._fields(ref['FIELD_NAME']))
+            for rule in ('UPDATE', 'DELETE'):
+                action = index[rule + '_RULE']
+                if action and action != 'RESTRICT':
+                    s += u' ON %s %s' % (rule, action)
+        index_name = index['INDEX_NAME']
+        descending = self.indexes[index_name]['INDEX_TYPE'] == '1'
+        if descending or (index_name != index['CONST_NAME']
+                                            and index_name[:4] != 'RDB$'):
+            s += u' USING %sINDEX %s' % (descending and u'DESC ' or u'',
+                                            quote_identifier(index_name))
+        return ('CONSTRAINT', index['RELATION_NAME'] + '.' + name, s + u';',
+                {'NAME': index['CONST_NAME'],
+                    'RELATION_NAME': index['RELATION_NAME']})
+
+    def constraints(self):
+        # Primary and unique keys first, foreign keys refer to them
+        for const_types in (('PRIMARY KEY', 'UNIQUE'), ('FOREIGN KEY', )):
+            for r in self.snap.tables()[1]:
+                for index in self.snap.indices_by_relation.get(r[0], []):
+                    if index['CONST_TYPE'] in const_types:
+                        yield self._constraint(index)
+
+    def indices(self):
+        for r in self.snap.tables()[1]:
+            for index in self.snap.indices_by_relation.get(r[0], []):
+                if index['CONST_TYPE']:
+                    continue
+                i = self.indexes[index['INDEX_NAME']]
+                s = u'CREATE '
+                if i['UNIQUE_FLAG'] == '1':
+                    s += u'UNIQUE '
+                if i['INDEX_TYPE'] == '1':
+                    s += u'DESCENDING '
+                s += u'INDEX %s ON %s ' % (quote_identifier(i['INDEX_NAME']),
+                                        quote_identifier(i['RELATION_NAME']))
+                if i['EXPRESSION']:
+                    s += u'COMPUTED BY ' + i['EXPRESSION'] + u';'
+                else:
+                    s += u'(%s);' % self._fields(i['FIELD_NAME'])
+                if i['INACT'] == '1':
+                    s += u'\nALTER INDEX %s INACTIVE;' % (
+                                        quote_identifier(i['INDEX_NAME']))
+                yield 'INDEX', i['INDEX_NAME'], s, {'NAME': i['INDEX_NAME']}
+
+    def _parameter(self, p):
+        s = quote_identifier(p['NAME']) + u' ' + ddl_type(p)
+        if str(p['NULL_FLAG']) == '1':
+            s += u' NOT NULL'
+        s += ddl_collation(p)
+        if p['DEFAULT_SOURCE']:
+            s += u' ' + p['DEFAULT_SOURCE']
+        return s
+
+    def _procedure_head(self, proc):
+        s = quote_identifier(proc['NAME'])
+        if proc['IN_PARAMS']:
+            s += u' (\n    ' + u',\n    '.join([self._parameter(p)
+                                    for p in proc['IN_PARAMS']]) + u')'
+        if proc['OUT_PARAMS']:
+            s += u'\nRETURNS (\n    ' + u',\n    '.join([self._parameter(p)
+                                    for p in proc['OUT_PARAMS']]) + u')'
+        return s + u'\nAS\n'
+
+    def procedures_and_views(self):
+        catalog = self.snap.procedure_catalog
+        names = catalog.keys()
+        names.sort()
+        yield None, None, u'SET TERM ^ ;\n', None
+        for name in names:
+            yield (None, None, u'CREATE PROCEDURE '
+                + self._procedure_head(catalog[name]) + u'BEGIN EXIT; END^',
+                None)
+        views = {}
+        for r in self.snap.relations:
+            if r['VIEW_SOURCE'] is not None and r['SYSTEM_FLAG'] == '0':
+                views[r['NAME']] = r['VIEW_SOURCE']
+        for name in topological_order(names + views.keys(), self.depends_on):
+            if views.has_key(name):
+                columns = [quote_identifier(c[0]) for c in
+                            self.snap.columns_by_relation.get(name, [])]
+                yield ('VIEW', name, u'CREATE VIEW %s (%s)\nAS\n%s^' % (
+                    quote_identifier(name), u', '.join(columns), views[name]),
+                    {'NAME': name})
+            elif self.procedure_sources.get(name) is None:
+                yield (None, None,
+                        u'/* Procedure %s has no source */' % name, None)
+            else:
+                yield ('PROCEDURE', name, u'ALTER PROCEDURE '
+                        + self._procedure_head(catalog[name])
+                        + self.procedure_sources[name] + u'^', {'NAME': name})
+        yield None, None, u'SET TERM ; ^\n', None
+
+    def checks(self):
+        for r in self.snap.tables()[1]:
+            for check in self.snap.checks_by_relation.get(r[0], []):
+                s = u'ALTER TABLE ' + quote_identifier(r[0]) + u' ADD '
+                if check['CHECK_NAME'].startswith('INTEG_'):
+                    name = check['CHECK_SOURCE']
+                else:
+                    name = check['CHECK_NAME']
+                    s += u'CONSTRAINT ' + quote_identifier(name) + u' '
+                yield ('CHECK', r[0] + '.' + name,
+                        s + check['CHECK_SOURCE'] + u';',
+                        {'NAME': check['CHECK_NAME'], 'RELATION_NAME': r[0]})
+
+    def triggers(self):
+        h, d = self.db.execute('''select rdb$trigger_name,
+            rdb$relation_name, rdb$trigger_sequence, rdb$trigger_type,
+            rdb$trigger_inactive, rdb$trigger_source
+            from rdb$triggers T
+            where coalesce(rdb$system_flag, 0) = 0
+                and not exists (select 1 from rdb$check_constraints C
+                    where C.rdb$trigger_name = T.rdb$trigger_name)
+            order by rdb$relation_name, rdb$trigger_type,
+                rdb$trigger_sequence, rdb$trigger_name''')
+        yield None, None, u'SET TERM ^ ;\n', None
+        for name, relation, sequence, trigger_type, inactive, source in d:
+            event = trigger_event(trigger_type)
+            if not event or source is None:
+                yield (None, None,
+                    u'/* Trigger %s: type %s, no source or unknown type */' % (
+                                                name, trigger_type), None)
+                continue
+            s = u'CREATE TRIGGER ' + quote_identifier(name)
+            if relation:
+                s += u' FOR ' + quote_identifier(relation)
+            s += u'\n%s %s POSITION %s\n' % (
+                inactive == '1' and u'INACTIVE' or u'ACTIVE', event,
+                sequence or 0)
+            yield 'TRIGGER', name, s + source + u'^', {'NAME': name}
+        yield None, None, u'SET TERM ; ^\n', None
+
+    def grants(self):
+        h, d = self.db.execute('''select rdb$user, rdb$grantor,
+            rdb$privilege, rdb$grant_option, rdb$relation_name,
+            rdb$field_name, rdb$user_type, rdb$object_type
+            from rdb$user_privileges
+            where rdb$user <> rdb$grantor
+                and not rdb$relation_name like 'RDB$%'
+                and not rdb$relation_name like 'MON$%'
+            order by rdb$relation_name, rdb$user, rdb$privilege''')
+        for (user, grantor, privilege, option, relation, field,
+                                    user_type, object_type) in d:
+            to = GRANTEE_TYPES.get(user_type, u'') + quote_identifier(user)
+            if user == 'PUBLIC':
+                to = u'PUBLIC'
+            if privilege == 'M':
+                s = u'%s TO %s' % (quote_identifier(relation), to)
+                if option in ('1', '2'):
+                    s += u' WITH ADMIN OPTION'
+            else:
+                s = PRIVILEGES.get(privilege, privilege)
+                if field:
+                    s += u' (%s)' % quote_identifier(field)
+                s += u' ON '
+                if privilege == 'X' or object_type == '5':
+                    s += u'PROCEDURE '
+                s += u'%s TO %s' % (quote_identifier(relation), to)
+                if option == '1':
+                    s += u' WITH GRANT OPTION'
+            # Named by the grant itself: any difference is another grant
+            yield 'GRANT', s, u'GRANT ' + s + u';', {'NAME': s}
+
+DROP_STATEMENTS = {'DOMAIN': u'DROP DOMAIN %s;',
+    'GENERATOR': u'DROP GENERATOR %s;', 'EXCEPTION': u'DROP EXCEPTION %s;',
+    'ROLE': u'DROP ROLE %s;', 'TABLE': u'DROP TABLE %s;',
+    'INDEX': u'DROP INDEX %s;', 'VIEW': u'DROP VIEW %s;',
+    'PROCEDURE': u'DROP PROCEDURE %s;', 'TRIGGER': u'DROP TRIGGER %s;'}
+ALTERED_KINDS = ('DOMAIN', 'TABLE', 'EXCEPTION', 'VIEW', 'PROCEDURE',
+    'TRIGGER')      # changed in place, others are dropped and created
+
+def object_hash(text):
+    "md5 of a DDL statement, blind to differences in white space."
+    return hashlib.md5(u' '.join(text.split()).encode('utf-8')).hexdigest()
+
+def schema_objects(db):
+    """The schema objects of db as ([key], {key: (hash, text, info)}),
+    key being (kind, name) of DdlExtractor.definitions(), in script order.
+    """
+    order = []
+    objects = {}
+    for kind, name, text, info in DdlExtractor(db, None).definitions():
+        if kind:
+            order.append((kind, name))
+            objects[(kind, name)] = (object_hash(text), text, info)
+    return order, objects
+
+def _drop(kind, info):
+    if kind in ('CONSTRAINT', 'CHECK'):
+        return u'ALTER TABLE %s DROP CONSTRAINT %s;' % (
+            quote_identifier(info['RELATION_NAME']),
+            quote_identifier(info['NAME']))
+    if kind == 'GRANT':
+        s = info['NAME'].replace(u' WITH GRANT OPTION', u'').replace(
+                                                    u' WITH ADMIN OPTION', u'')
+        what, to = s.rsplit(u' TO ', 1)
+        return u'REVOKE %s FROM %s;' % (what, to)
+    return DROP_STATEMENTS[kind] % quote_identifier(info['NAME'])
+
+def _set_default(prefix, old, new):
+    if old['DEFAULT_SOURCE'] == new['DEFAULT_SOURCE']:
+        return []
+    if new['DEFAULT_SOURCE']:
+        return [prefix + u' SET ' + new['DEFAULT_SOURCE'] + u';']
+    return [prefix + u' DROP DEFAULT;']
+
+def _alter_domain(name, old, new):
+    d = u'ALTER DOMAIN ' + quote_identifier(name)
+    a = []
+    if old['TYPE'] != new['TYPE']:
+        a.append(d + u' TYPE ' + new['TYPE'] + u';')
+    a += _set_default(d, old, new)
+    if old['VALIDATION_SOURCE'] != new['VALIDATION_SOURCE']:
+        if old['VALIDATION_SOURCE']:
+            a.append(d + u' DROP CONSTRAINT;')
+        if new['VALIDATION_SOURCE']:
+            a.append(d + u' ADD ' + new['VALIDATION_SOURCE'] + u';')
+    if old['NULL_FLAG'] != new['NULL_FLAG']:
+        a.append(u'/* NOT NULL of domain %s differs */' % name)
+    return a
+
+def _alter_table(name, old, new):
+    t = u'ALTER TABLE ' + quote_identifier(name)
+    old_columns = dict([(c['NAME'], c) for c in old['COLUMNS']])
+    new_columns = dict([(c['NAME'], c) for c in new['COLUMNS']])
+    a = []
+    for c in old['COLUMNS']:
+        if not new_columns.has_key(c['NAME']):
+            a.append(t + u' DROP ' + quote_identifier(c['NAME']) + u';')
+    for c in new['COLUMNS']:
+        o = old_columns.get(c['NAME'])
+        column = t + u' ALTER ' + quote_identifier(c['NAME'])
+        if o is None:
+            a.append(t + u' ADD ' + c['DDL'] + u';')
+        elif o['DDL'] == c['DDL']:
+            continue
+        elif o['COMPUTED'] or c['COMPUTED']:
+            a.append(t + u' DROP ' + quote_identifier(c['NAME']) + u';')
+            a.append(t + u' ADD ' + c['DDL'] + u';')
+        else:
+            if o['TYPE'] != c['TYPE']:
+                a.append(column + u' TYPE ' + c['TYPE'] + u';')
+            a += _set_default(column, o, c)
+            if o['NULL_FLAG'] != c['NULL_FLAG']:
+                a.append(u'/* NOT NULL of %s.%s differs */' % (
+                                                        name, c['NAME']))
+    common = [c['NAME'] for c in new['COLUMNS']
+                                        if old_columns.has_key(c['NAME'])]
+    if common != [c['NAME'] for c in old['COLUMNS']
+                                        if new_columns.has_key(c['NAME'])]:
+        for i, c in enumerate(new['COLUMNS']):
+            a.append(u'%s ALTER %s POSITION %d;' % (t,
+                                        quote_identifier(c['NAME']), i + 1))
+    return a
+
+def _alter(kind, name, text, old, new):
+    if kind == 'DOMAIN':
+        return _alter_domain(name, old, new)
+    if kind == 'TABLE':
+        return _alter_table(name, old, new)
+    if kind == 'EXCEPTION':
+        return [text.replace(u'CREATE EXCEPTION', u'ALTER EXCEPTION', 1)]
+    if kind in ('VIEW', 'TRIGGER'):
+        return [u'RE' + text]
+    return [text]                       # ALTER PROCEDURE
+
+def _with_terminators(statements):
+    "statements with SET TERM wherever they change from ; to ^ or back."
+    a = []
+    term = u';'
+    for s in statements:
+        if s[-1:] in (u';', u'^') and s[-1:] != term:
+            if term == u';':
+                a.append(u'SET TERM ^ ;')
+            else:
+                a.append(u'SET TERM ; ^')
+            term = s[-1:]
+        a.append(s)
+    if term == u'^':
+        a.append(u'SET TERM ; ^')
+    return a
+
+def schema_diff(source, target, progress=None):
+    """The statements that make the schema of target like that of source.
+
+    Both catalogs are read at the same time, in bulk. Objects are
+    compared by object_hash() first, and only those whose hashes differ
+    are compared part by part. Drops come first, in reverse script order,
+    then creates and alters in script order. Returns (statements,
+    counts), counts by 'same', 'changed', 'added' and 'dropped'.
+    """
+    results = run_parallel(schema_objects, [source, target], 2, progress)
+    for db, r, e in results:
+        if e:
+            raise e
+    (source_order, source_objects), (target_order, target_objects) = [
+                                                    r[1] for r in results]
+    counts = {'same': 0, 'changed': 0, 'added': 0, 'dropped': 0}
+    statements = []
+    for key in reversed(target_order):
+        h, text, info = target_objects[key]
+        new = source_objects.get(key)
+        if new is None:
+            counts['dropped'] += 1
+            statements.append(_drop(key[0], info))
+        elif new[0] != h and key[0] not in ALTERED_KINDS:
+            statements.append(_drop(key[0], info))
+    for key in source_order:
+        h, text, info = source_objects[key]
+        old = target_objects.get(key)
+        if old is None:
+            counts['added'] += 1
+            if key[0] == 'PROCEDURE':
+                text = text.replace(u'ALTER PROCEDURE', u'CREATE PROCEDURE',
+                                                                        1)
+            statements.append(text)
+        elif old[0] == h:
+            counts['same'] += 1
+        else:
+            counts['changed'] += 1
+            if key[0] in ALTERED_KINDS:
+                statements += _alter(key[0], key[1], text, old[2], info)
+            else:
+                statements.append(text)
+    return _with_terminators(statements), counts
+
+class MetadataIndex(object):
+    """Inverted index over the names and source texts of a schema.
+
+    Documents are (kind, name, where, category, node name) tuples: the
+    object, whether its name or its source matched, and the tree node to
+    show it, node name None meaning the category itself. Tokens are the
+    upper cased words of the texts; load() reads them with a few bulk
+    queries, after which search() does not use the server.
+    """
+    token_re = re.compile(r'[\w$]+', re.UNICODE)
+
+    def __init__(self):
+        self.documents = []
+        self.postings = {}          # token -> [document index]
+        self.tokens = []            # sorted postings keys
+
+    def add(self, document, text):
+        if not text:
+            return
+        i = len(self.documents)
+        self.documents.append(document)
+        for token in dict.fromkeys(self.token_re.findall(text.upper())):
+            self.postings.setdefault(token, []).append(i)
+
+    def load(self, db):
+        "Index the catalog of db; returns self."
+        relations = {}              # name -> category
+        sources = []                # added after the names, to rank lower
+        h, d = db.execute('''select rdb$relation_name, rdb$system_flag,
+            rdb$view_source from rdb$relations''')
+        for name, system_flag, source in d:
+            if source is not None:
+                kind, category = 'VIEW', 'VIEWS'
+                sources.append(((kind, name, 'source', category, name),
+                                                                    source))
+            elif system_flag in (None, '0'):
+                kind, category = 'TABLE', 'TABLES'
+            else:
+                kind, category = 'SYSTEM TABLE', 'SYSTEMTABLES'
+            relations[name] = category
+            self.add((kind, name, 'name', category, name), name)
+        h, d = db.execute('''select rdb$relation_name, rdb$field_name
+            from rdb$relation_fields''')
+        for relation, field in d:
+            self.add(('COLUMN', relation + '.' + field, 'name',
+                        relations.get(relation, 'TABLES'), relation), field)
+        h, d = db.execute('''select rdb$index_name, rdb$relation_name
+            from rdb$indices''')
+        for name, relation in d:
+            self.add(('INDEX', name, 'name',
+                        relations.get(relation, 'TABLES'), relation), name)
+        h, d = db.execute('''select rdb$procedure_name, rdb$procedure_source
+            from rdb$procedures''')
+        for name, source in d:
+            self.add(('PROCEDURE', name, 'name', 'PROCEDURES', name), name)
+            sources.append((('PROCEDURE', name, 'source', 'PROCEDURES', name),
+                                                                    source))
+        h, d = db.execute('''select A.rdb$constraint_name,
+            A.rdb$relation_name, C.rdb$trigger_source
+            from rdb$relation_constraints A, rdb$check_constraints B,
+                rdb$triggers C
+            where A.rdb$constraint_type = 'CHECK'
+                and A.rdb$constraint_name = B.rdb$constraint_name
+                and B.rdb$trigger_name = C.rdb$trigger_name
+                and C.rdb$trigger_type = 1''')
+        for name, relation, source in d:
+            self.add(('CHECK', name, 'name', 'TABLES', relation), name)
+            sources.append((('CHECK', name, 'source', 'TABLES', relation),
+                                                                    source))
+        h, d = db.execute('''select rdb$trigger_name, rdb$trigger_source
+            from rdb$triggers T
+            where coalesce(rdb$system_flag, 0) = 0
+                and not exists (select 1 from rdb$check_constraints C
+                    where C.rdb$trigger_name = T.rdb$trigger_name)''')
+        for name, source in d:
+            self.add(('TRIGGER', name, 'name', 'TRIGGERS', name), name)
+            sources.append((('TRIGGER', name, 'source', 'TRIGGERS', name),
+                                                                    source))
+        for kind, category, (h, d) in (
+                        ('DOMAIN', 'DOMAINS', db.domains()),
+                        ('EXCEPTION', 'EXCEPTIONS', db.exceptions()),
+                        ('GENERATOR', 'GENERATORS', db.generators()),
+                        ('ROLE', 'ROLES', db.roles())):
+            for r in d:
+                node_name = None
+                if kind == 'ROLE':
+                    node_name = r[0]
+                self.add((kind, r[0], 'name', category, node_name), r[0])
+        for document, source in sources:
+            self.add(document, source)
+        self.tokens = self.postings.keys()
+        self.tokens.sort()
+        return self
+
+    def _prefixed(self, prefix):
+        "Indexes of the documents with a token starting with prefix."
+        found = {}
+        i = bisect.bisect_left(self.tokens, prefix)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefix):
+            for d in self.postings[self.tokens[i]]:
+                found[d] = True
+            i += 1
+        return found
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Documents with a token starting with each word of query, names
+        before sources, at most limit of them."""
+        found = None
+        for word in self.token_re.findall(query.upper()):
+            docs = self._prefixed(word)
+            if found is not None:
+                docs = dict([(d, True) for d in found if docs.has_key(d)])
+            found = docs
+        if not found:
+            return []
+        hits = found.keys()
+        hits.sort()
+        return [self.documents[d] for d in hits[:limit]]
+
 #------------------------------------------------------------------------------
-import sys, tempfile
-if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        testdir = sys.argv[1]
+# Command line: jython fbutil.py -d PATH [options] COMMAND [ARGS]
+
+class JsonLinesWriter(object):
+    "Writes one JSON value per line to a java.io.Writer, from any thread."
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+
+    def write(self, v):
+        line = json_value(v) + u'\n'
+        self.lock.acquire()
+        try:
+            self.writer.write(line)
+        finally:
+            self.lock.release()
+
+def _records(h, d):
+    return [dict(zip(h, r)) for r in d]
+
+def _table_metadata(db, kind, name):
+    "JSON-ready dict of a table or view, read with several queries."
+    obj = {'type': kind, 'name': name,
+            'columns': _records(*db.columns(name))}
+    if kind == 'view':
+        obj['source'] = db.view_source(name)
+        return obj
+    obj['constraints'] = db.constraints(name)
+    obj['indexes'] = db.key_constraints_and_index(name)
+    obj['checks'] = db.check_constraints(name)
+    h, d = db.triggers(name)
+    obj['triggers'] = []
+    for t in _records(h, d):
+        t['SOURCE'] = db.trigger_source(t['NAME'])
+        obj['triggers'].append(t)
+    return obj
+
+def dump_metadata(db, out, jobs=POOL_MAX_SIZE):
+    """Write the catalog as JSON Lines, one object per schema object.
+
+    Tables, views and procedures are read on jobs threads, each query
+    on a pooled connection; an object is written as soon as it is read.
+    """
+    for kind, (h, d) in (('domain', db.domains()),
+                        ('exception', db.exceptions()),
+                        ('function', db.functions()),
+                        ('role', db.roles())):
+        for r in _records(h, d):
+            r['type'] = kind
+            out.write(r)
+    h, d = db.generators()
+    values = db.generator_values([r[0] for r in d])
+    for r in _records(h, d):
+        r['type'] = 'generator'
+        r['VALUE'] = values[r['NAME']]
+        out.write(r)
+
+    work = [('table', r[0]) for r in db.tables()[1]]
+    work += [('view', r[0]) for r in db.views()[1]]
+    work += [('procedure', r[0]) for r in db.procedures()[1]]
+    def read(item):
+        kind, name = item
+        if kind == 'procedure':
+            obj = db.procedure_source(name)
+            obj.update({'type': kind, 'name': name})
+            return obj
+        return _table_metadata(db, kind, name)
+    def done(item, obj, error):
+        if error:
+            obj = {'type': item[0], 'name': item[1], 'error': unicode(error)}
+        out.write(obj)
+    errors = [r for r in run_parallel(read, work, jobs, on_result=done)
+                                                                    if r[2]]
+    return len(errors)
+
+def index_stats(db, out, jobs=POOL_MAX_SIZE, recompute=False):
+    "Write index_health() as JSON Lines, recomputing flagged statistics."
+    failed = 0
+    indexes = db.index_health(workers=jobs)
+    for i in indexes:
+        out.write({'type': 'index', 'relation': i['RELATION_NAME'],
+            'name': i['INDEX_NAME'], 'fields': i['FIELD_NAME'],
+            'expression': i['EXPRESSION'], 'unique': i['UNIQUE_FLAG'] == '1',
+            'inactive': i['INACT'] == '1', 'selectivity': i['STATISTICS'],
+            'stored_keys': i['STORED_KEYS'],
+            'sampled_keys': i['SAMPLED_KEYS'], 'problems': i['PROBLEMS']})
+    if recompute:
+        names = [i['INDEX_NAME'] for i in indexes
+                                if i['PROBLEMS'] and i['INACT'] != '1']
+        for name, r, e in db.recompute_statistics(names, jobs):
+            out.write({'type': 'set_statistics', 'name': name,
+                                        'error': e and unicode(e)})
+            failed += e is not None
+    return failed
+
+def main(argv):
+    import optparse
+    parser = optparse.OptionParser(usage='''%prog -d PATH [options] COMMAND
+
+commands:
+  dump-metadata          every schema object as a JSON line
+  query SQL              result rows as JSON lines
+  export TABLE|SQL FILE  rows to a CSV or JSON Lines file
+  stats                  index statistics health as JSON lines
+  extract-ddl FILE       DDL script of the whole schema''')
+    parser.add_option('-H', '--host', default='localhost')
+    parser.add_option('-p', '--port', type='int', default=3050)
+    parser.add_option('-d', '--database', help='database path on the server')
+    parser.add_option('-u', '--user',
+                            default=os.environ.get('ISC_USER', 'SYSDBA'))
+    parser.add_option('-P', '--password', default=os.environ.get(
+                        'ISC_PASSWORD'),
+                        help='default $ISC_PASSWORD, else asked for')
+    parser.add_option('-c', '--charset', default='UNICODE_FSS')
+    parser.add_option('-j', '--jobs', type='int', default=POOL_MAX_SIZE,
+                        help='worker threads, each with a connection')
+    parser.add_option('-o', '--output', help='write here, not to stdout')
+    parser.add_option('-f', '--format', default='csv',
+                        help='export format, csv or jsonl')
+    parser.add_option('-z', '--gzip', action='store_true',
+                        help='compress the export file')
+    parser.add_option('--recompute', action='store_true',
+                        help='stats: SET STATISTICS on the flagged indexes')
+    parser.add_option('--profile', action='store_true',
+                        help='statement timings to stderr at the end')
+    options, args = parser.parse_args(argv)
+    arity = {'dump-metadata': 1, 'query': 2, 'export': 3, 'stats': 1,
+                                                        'extract-ddl': 2}
+    if not args or arity.get(args[0]) != len(args):
+        parser.error('unknown command or wrong arguments')
+    if not options.database:
+        parser.error('--database is required')
+    formats = {'csv': CSV, 'jsonl': JSON_LINES}
+    if not formats.has_key(options.format.lower()):
+        parser.error('--format must be csv or jsonl')
+    if options.password is None:
+        import getpass
+        options.password = getpass.getpass('Password for %s: ' % options.user)
+
+    db = FbDatabase(options.host, options.database, options.user,
+                    options.password, options.charset, options.port)
+    if options.output:
+        stream = FileOutputStream(options.output)
     else:
-        testdir = tempfile.gettempdir()
-        
-    print('testdir=' + testdir)
-
-    db = FbDatabase(host='localhost', path = testdir + '/test.fdb',
-            user='sysdba', password='masterkey')
-    db.open()
-
-    print("\n[domains]")
-    h, d = db.domains()
-    print(h)
-    for r in d:
-        print(r)
-
-    print("\n[exceptions]")
-    h, d = db.exceptions()
-    print(h)
-    for r in d:
-        print(r)
-
-    print("\n[system tables]")
-    h, d = db.tables(system_flag=1)
-    print(h)
-    for r in d:
-        print(r)
-
-
-    print("\n[tables]")
-    th, ts = db.tables()
-    print(th)
-    for t in ts:
-        print('\n', t)
-        h, cs = db.columns(t[0])
-        print('\t', h)
-        print('\t',)
-        for c in cs:
-            print('\t' + c[0] + ' ' + fieldtype_to_string(dict(zip(h, c))),
-                                            c[1], c[2]) # owner, description
-        print('\t[key_constraints_and_index:]')
-        for kcs in db.key_constraints_and_index(t[0]):
-            for k in kcs:
-                print('\t'+k, kcs[k])
-            print('\n')
-                
-        print('\t[check_constraints:]')
-        for ccs in db.check_constraints(t[0]):
-            for k in ccs:
-                print('\t'+k, ccs[k])
-        print('\n')
-
-        print('\t[constraints:]')
-        for cs in db.constraints(t[0]):
-            print(cs)
-
-        print('\t[primary_keys:]')
-        for pk in db.primary_keys(t[0]):
-            print(pk)
-
-        print('\t[foreign_keys:]')
-        for fk in db.foreign_keys(t[0]):
-            print(fk)
-
-        print('\t[unique_keys:]')
-        for uk in db.unique_keys(t[0]):
-            print(uk)
-
-        print('\n  triggers:')
-        h, cs = db.triggers(t[0])
-        print(h)
-        for c in cs:
-            print(c)
-            print(db.trigger_source(c[0]))
-
-    print("\n[views]")
-    vh, vs = db.views()
-    print(vh)
-    for v in vs:
-        print(v)
-        h, cs = db.columns(v[0])
-        print('\t', h)
-        print('\t')
-        for c in cs:
-            print('\t' + c[0] + ' ' + fieldtype_to_string(dict(zip(h, c))),
-                                            c[1], c[2]) # owner, description
-        print(db.view_source(v[0]))
-
-    print("\n[generators]")
-    gh, gs = db.generators()
-    for g in gs:
-        print(g)
-        print(db.get_generator_id(g[0]))
-
-    print("\n[procedure]")
-    ph, ps = db.procedures()
-    for p in ps:
-        print(p[0])
-        q = db.procedure_source(p[0])
-        print(q['SOURCE'])
-        print("\n[in_params]")
-        for inp in q['IN_PARAMS']:
-            print(inp['NAME'], fieldtype_to_string(inp))
-        print("\n[out_params]")
-        for outp in q['OUT_PARAMS']:
-            print(outp['NAME'], fieldtype_to_string(outp))
-
-    print("\n[roles]")
-    rh, rs = db.roles()
-    for r in rs:
-        print(r[0] + ' ' + r[1])
-        print("\t[grant_users]")
-        uh, us = db.grant_users(r[0])
-        print(uh)
-        for u in us:
-            print(u)
-
-    print("\n[functions]")
-    fh, fs = db.functions()
-    print(fh)
-    for f in fs:
-        print(f)
+        stream = System.out
+    writer = BufferedWriter(OutputStreamWriter(stream, 'UTF-8'),
+                                                        EXPORT_BUFFER_SIZE)
+    out = JsonLinesWriter(writer)
+    status = 0
+    try:
+        try:
+            db.open(max(options.jobs, POOL_MAX_SIZE))
+            command = args[0]
+            if command == 'dump-metadata':
+                status = dump_metadata(db, out, options.jobs) and 1
+            elif command == 'stats':
+                status = index_stats(db, out, options.jobs,
+                                                options.recompute) and 1
+            elif command == 'query':
+                Exporter(db.for_lane(QUERY_LANE), args[1], None,
+                                                JSON_LINES).write(writer)
+            elif command == 'export':
+                source, path = args[1:]
+                format = formats[options.format.lower()]
+                query_db = db.for_lane(QUERY_LANE)
+                if re.match(r'\s*(select|with)\s', source, re.I):
+                    e = Exporter(query_db, source, path, format,
+                                                                options.gzip)
+                else:
+                    e = Exporter.export_table(query_db, source, path,
+                                format=format, compress=options.gzip)
+                e.run()
+                out.write({'type': 'export', 'path': path, 'rows': e.rows,
+                            'seconds': time.time() - e.started})
+            elif command == 'extract-ddl':
+                e = DdlExtractor(db, args[1])
+                e.run()
+                out.write({'type': 'extract-ddl', 'path': args[1],
+                    'objects': e.objects, 'seconds': time.time() - e.started})
+        except (PythonException, Exception), e:
+            sys.stderr.write('%s\n' % e)
+            status = 1
+    finally:
+        writer.flush()
+        if options.output:
+            writer.close()
+        db.close()
+        close_pools()
+    if options.profile:
+        h, d = profiler.summary()
+        for r in [h] + d:
+            sys.stderr.write('\t'.join([str(v) for v in r]) + '\n')
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))